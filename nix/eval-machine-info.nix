@@ -358,6 +358,19 @@ rec {
 
   };
 
+  # The same as ‘info’, but in a form that ‘nix-instantiate --json’
+  # prints like ‘--xml’ prints ‘info’: paths are not copied to the
+  # Nix store, and derivations are not reduced to their output path.
+  jsonInfo =
+    let
+      toJSONValue = v:
+        if isDerivation v then { inherit (v) drvPath outPath; }
+        else if isAttrs v then mapAttrs (n: toJSONValue) (removeAttrs v [ "_module" ])
+        else if isList v then map toJSONValue v
+        else if builtins.typeOf v == "path" then toString v
+        else v;
+    in toJSONValue info;
+
   # Phase 2: build complete machine configurations.
   machines = { names }:
     let nodes' = filterAttrs (n: v: elem n names) nodes; in
@@ -370,6 +383,10 @@ rec {
         '') nodes'))}
       '';
 
+  # The configuration of a single machine, so that machines can be
+  # instantiated and built independently of each other.
+  toplevel = { name }: (getAttr name nodes).config.system.build.toplevel;
+
 
   # Function needed to calculate the nixops arguments. This should work even when arguments
   # are not set yet, so we fake arguments to be able to evaluate the require attribute of
@@ -75,7 +75,10 @@ in
         <literal>--always-activate</literal> on deployment.
 
         If this is set to <literal>false</literal>, activation is done only if
-        the new system profile doesn't match the previous one.
+        the new system profile doesn't match the previous one, and machines
+        that NixOps has recorded as running the new configuration are not
+        activated at all unless <literal>--check</literal> is given.  Their
+        keys are still uploaded.
       '';
     };
 
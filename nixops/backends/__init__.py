@@ -2,6 +2,7 @@
 
 import os
 import re
+import pipes
 import subprocess
 
 import nixops.util
@@ -13,28 +14,22 @@ class MachineDefinition(nixops.resources.ResourceDefinition):
 
     def __init__(self, xml, config={}):
         nixops.resources.ResourceDefinition.__init__(self, xml, config)
-        self.encrypted_links_to = set([e.get("value") for e in xml.findall("attrs/attr[@name='encryptedLinksTo']/list/string")])
-        self.store_keys_on_machine = xml.find("attrs/attr[@name='storeKeysOnMachine']/bool").get("value") == "true"
-        self.ssh_port = int(xml.find("attrs/attr[@name='targetPort']/int").get("value"))
-        self.always_activate = xml.find("attrs/attr[@name='alwaysActivate']/bool").get("value") == "true"
-        self.owners = [e.get("value") for e in xml.findall("attrs/attr[@name='owners']/list/string")]
-        self.has_fast_connection = xml.find("attrs/attr[@name='hasFastConnection']/bool").get("value") == "true"
+        self.encrypted_links_to = set(config["encryptedLinksTo"])
+        self.store_keys_on_machine = config["storeKeysOnMachine"]
+        self.ssh_port = int(config["targetPort"])
+        self.always_activate = config["alwaysActivate"]
+        self.owners = config["owners"]
+        self.has_fast_connection = config["hasFastConnection"]
 
         def _extract_key_options(x):
-            opts = {}
-            for (key, xmlType) in (('text',        'string'),
-                                   ('keyFile',     'path'),
-                                   ('destDir',     'string'),
-                                   ('user',        'string'),
-                                   ('group',       'string'),
-                                   ('permissions', 'string')):
-                elem = x.find("attrs/attr[@name='{0}']/{1}".format(key, xmlType))
-                if elem is not None:
-                    opts[key] = elem.get("value")
-            return opts
-
-        self.keys = {k.get("name"): _extract_key_options(k) for k in
-                     xml.findall("attrs/attr[@name='keys']/attrs/attr")}
+            return {key: x[key] for key in ('text', 'keyFile', 'destDir', 'user', 'group', 'permissions')
+                    if x.get(key) is not None}
+
+        self.keys = {k: _extract_key_options(v) for k, v in config["keys"].iteritems()}
+
+
+# The largest number of store paths passed to nix-copy-closure.
+_max_missing_paths = 500
 
 
 class MachineState(nixops.resources.ResourceState):
@@ -72,6 +67,7 @@ class MachineState(nixops.resources.ResourceState):
         self.ssh.register_flag_fun(self.get_ssh_flags)
         self.ssh.register_host_fun(self.get_ssh_name)
         self.ssh.register_passwd_fun(self.get_ssh_password)
+        self.ssh.register_host_key_fun(lambda: self.public_host_key)
         self._ssh_private_key_file = None
 
     def prefix_definition(self, attr):
@@ -287,6 +283,11 @@ class MachineState(nixops.resources.ResourceState):
     def get_ssh_for_copy_closure(self):
         return self.ssh
 
+    def needs_closure_copy(self):
+        """Whether closures have to be copied to this machine at all,
+        i.e. whether it doesn't use the Nix store of the local machine."""
+        return True
+
     @property
     def public_host_key(self):
         return None
@@ -299,6 +300,22 @@ class MachineState(nixops.resources.ResourceState):
         """Return the IP address to be used to access resource "r" from this machine."""
         return r.public_ipv4
 
+    def address_scope(self):
+        """Return a value that is the same for all machines for which
+        address_to() returns the same address for every resource, or
+        None if this machine's view of the network may be unique.
+        Backends that override address_to() should override this too."""
+        if type(self).address_to.im_func is MachineState.address_to.im_func:
+            return "public"
+        return None
+
+    def peer_scope(self):
+        """Return a value that is the same for all machines that can
+        reach each other at the addresses returned by address_to(), or
+        None if this is unknown.  Machines only copy closures to peers
+        in the same scope."""
+        return self.address_scope()
+
     def wait_for_ssh(self, check=False):
         """Wait until the SSH port is open on this machine."""
         if self.ssh_pinged and (not check or self._ssh_pinged_this_time): return
@@ -350,22 +367,66 @@ class MachineState(nixops.resources.ResourceState):
         cmd += " " + method
         return self.run_command(cmd, check=False)
 
-    def copy_closure_to(self, path):
-        """Copy a closure to this machine."""
-
-        # !!! Implement copying between cloud machines, as in the Perl
-        # version.
+    def copy_closure_to(self, path, missing=None):
+        """Copy a closure to this machine.  If the store paths of the
+        closure that are missing on this machine are already known,
+        ‘missing’ is the set of them, and only their closures are
+        copied."""
 
         ssh = self.get_ssh_for_copy_closure()
 
+        # Passing many missing paths gains little over letting
+        # nix-copy-closure work them out from ‘path’, and may exceed
+        # the maximum length of a command line.
+        if missing is None or len(missing) > _max_missing_paths:
+            missing = [path]
+
         # Any remaining paths are copied from the local machine.
         env = dict(os.environ)
         env['NIX_SSHOPTS'] = ' '.join(ssh._get_flags() + ssh.get_master().opts)
         self._logged_exec(
-            ["nix-copy-closure", "--to", ssh._get_target(), path]
+            ["nix-copy-closure", "--to", ssh._get_target()] + sorted(missing)
             + ([] if self.has_fast_connection else ["--use-substitutes"]),
             env=env)
 
+    def copy_closure_from_cache(self, path, substituter):
+        """Let this machine fetch the closure of ‘path’ from the binary
+        cache ‘substituter’.  The paths must be signed by a key the
+        machine trusts."""
+        ssh = self.get_ssh_for_copy_closure()
+        ssh.run_command(["nix", "copy", "--from", substituter, path])
+
+    def get_missing_paths(self, paths):
+        """Return the set of those store paths in ‘paths’ that are
+        not valid on this machine."""
+        ssh = self.get_ssh_for_copy_closure()
+        out = ssh.run_command("xargs -r nix-store --check-validity --print-invalid",
+                              stdin_string="\n".join(paths) + "\n", capture_stdout=True)
+        return set(out.split())
+
+    def copy_closure_from_peer(self, peer, paths, agent):
+        """Copy the store paths ‘paths’, which machine ‘peer’ already
+        has, directly from ‘peer’ to this machine.  The SSH agent
+        ‘agent’, which should hold only the key of this machine, is
+        forwarded to ‘peer’ to log in to this machine, and ‘peer’
+        checks the recorded host key of this machine."""
+        if not self.public_host_key:
+            raise Exception("host key of machine ‘{0}’ is unknown".format(self.name))
+        address = peer.address_to(self)
+        host = address if self.ssh_port == 22 else "[{0}]:{1}".format(address, self.ssh_port)
+        known_host = "{0} {1}".format(host, self.public_host_key)
+        cmd = ("f=$(mktemp) && trap 'rm -f \"$f\"' EXIT && printf '%s\\n' {0} > \"$f\" && "
+               "env NIX_SSHOPTS=\"-p {1} -o StrictHostKeyChecking=yes -o UserKnownHostsFile=$f\" "
+               "xargs -r nix-copy-closure --to root@{2}").format(
+                   pipes.quote(known_host), self.ssh_port, pipes.quote(address))
+        ssh = peer.get_ssh_for_copy_closure()
+        # Agent forwarding doesn't work through a master connection,
+        # which uses the agent it was started with.
+        self._logged_exec(
+            ["ssh", "-x", "-A", "-o", "ControlPath=none", ssh._get_target()]
+            + ssh._get_flags() + [cmd],
+            env=agent.env, stdin_string="\n".join(paths) + "\n")
+
     def generate_vpn_key(self):
         key_missing = False
         try:
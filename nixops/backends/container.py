@@ -47,6 +47,9 @@ class ContainerState(MachineState):
             return m.private_ipv4
         return MachineState.address_to(self, m)
 
+    def address_scope(self):
+        return ("container", self.host)
+
     def get_ssh_name(self):
         assert self.private_ipv4
         if self.host == "localhost":
@@ -72,9 +75,12 @@ class ContainerState(MachineState):
         # should copy closures to the host.
         return self.host_ssh
 
-    def copy_closure_to(self, path):
+    def needs_closure_copy(self):
+        return self.host != "localhost"
+
+    def copy_closure_to(self, path, missing=None):
         if self.host == "localhost": return
-        MachineState.copy_closure_to(self, path)
+        MachineState.copy_closure_to(self, path, missing)
 
     def get_host_ssh(self):
         if self.host.startswith("__machine-"):
@@ -265,6 +265,15 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             return m.private_ipv4
         return MachineState.address_to(self, m)
 
+    def address_scope(self):
+        return "ec2"
+
+    def peer_scope(self):
+        # Private addresses are only reachable within a VPC.  The VPC
+        # of an instance isn't recorded, so only pair instances in the
+        # same subnet, or in the default VPC of the same region.
+        return ("ec2", self.region, self.subnet_id or None)
+
 
     def connect(self):
         if self._conn: return self._conn
@@ -365,11 +374,11 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             if instance.state not in {"pending", "running", "scheduling", "launching", "stopped"}:
                 raise Exception("EC2 instance ‘{0}’ failed to start (state is ‘{1}’)".format(self.vm_id, instance.state))
             if instance.state != "running":
-                time.sleep(3)
+                nixops.util.sleep(3)
                 continue
             if _instance_ip_ready(instance):
                 break
-            time.sleep(3)
+            nixops.util.sleep(3)
 
         self.log_end("{0} / {1}".format(instance.ip_address, instance.private_ip_address))
 
@@ -629,7 +638,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                         raise Exception(
                             "EC2 instance ‘{0}’ failed to reach running state (state is ‘{1}’)"
                             .format(self.vm_id, instance.state))
-                    time.sleep(3)
+                    nixops.util.sleep(3)
                     instance = self._get_instance(update=True)
                 self.log_end("")
 
@@ -650,7 +659,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                         self.log_continue("[{0}] ".format(instance.ip_address))
                         if instance.ip_address == elastic_ipv4:
                             break
-                        time.sleep(3)
+                        nixops.util.sleep(3)
                         instance = self._get_instance(update=True)
                     self.log_end("")
 
@@ -752,7 +761,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                     self.spot_instance_request_id = None
                     self.log_end("")
                     raise Exception("spot instance request failed with result ‘{0}’".format(request.status.code))
-                time.sleep(3)
+                nixops.util.sleep(3)
             self.log_end("")
 
             instance = self._retry(lambda: self._get_instance(instance_id=request.instance_id))
@@ -796,7 +805,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                     raise Exception("spot instance request got fulfilled unexpectedly as instance ‘{0}’".format(request.instance_id))
                 self.vm_id = request.instance_id
             if request.state != 'open': break
-            time.sleep(3)
+            nixops.util.sleep(3)
 
         self.log_end("")
 
@@ -1018,7 +1027,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             while True:
                 if self._get_instance(allow_missing=True): break
                 self.log("EC2 instance ‘{0}’ not known yet, waiting...".format(self.vm_id))
-                time.sleep(3)
+                nixops.util.sleep(3)
 
         if not self.virtualization_type:
             self.virtualization_type = self._get_instance().virtualization_type
@@ -1367,7 +1376,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             while True:
                 self.log_continue("[{0}] ".format(instance.state))
                 if instance.state == "terminated": break
-                time.sleep(3)
+                nixops.util.sleep(3)
                 instance = self._get_instance(update=True)
 
         self.log_end("")
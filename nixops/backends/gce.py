@@ -163,6 +163,9 @@ class GCEState(MachineState, ResourceState):
         else:
             return MachineState.address_to(self, resource)
 
+    def address_scope(self):
+        return ("gce", self.network)
+
     def full_metadata(self, metadata):
         result = metadata.copy()
         result.update({
@@ -103,6 +103,9 @@ class LibvirtdState(MachineState):
             return m.private_ipv4
         return MachineState.address_to(self, m)
 
+    def address_scope(self):
+        return "libvirtd"
+
     def _vm_id(self):
         return "nixops-{0}-{1}".format(self.depl.uuid, self.name)
 
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Working out which store paths have to be copied to which machines,
+# so that closures shared by many machines are queried only once.
+
+import subprocess
+
+import nixops.parallel
+
+
+def get_closure(path):
+    """Return the set of store paths in the closure of ‘path’."""
+    return set(subprocess.check_output(["nix-store", "-qR", path]).split())
+
+
+def get_path_sizes(paths, chunk_size=1000):
+    """Return a dictionary mapping each of the store paths ‘paths’ to
+    its size in bytes."""
+    paths = sorted(paths)
+    sizes = {}
+    for i in range(0, len(paths), chunk_size):
+        chunk = paths[i:i + chunk_size]
+        out = subprocess.check_output(["nix-store", "-q", "--size"] + chunk).split()
+        sizes.update(zip(chunk, [int(s) for s in out]))
+    return sizes
+
+
+def format_size(size):
+    return "{0:.1f} MiB".format(size / (1024.0 * 1024.0))
+
+
+class CopyPlan(object):
+    """The store paths missing on each of a set of machines, given the
+    configuration ‘m.new_toplevel’ each machine ‘m’ is to receive."""
+
+    def __init__(self, machines, max_concurrent_query=16):
+        machines = list(machines)
+        self.closures = {}
+        for m in machines:
+            if m.new_toplevel not in self.closures:
+                self.closures[m.new_toplevel] = get_closure(m.new_toplevel)
+        self.sizes = get_path_sizes(set().union(*self.closures.values()))
+
+        def worker(m):
+            closure = self.closures[m.new_toplevel]
+            try:
+                return (m.name, m.get_missing_paths(closure) & closure)
+            except Exception as e:
+                m.logger.warn("cannot determine which store paths are missing ({0}), assuming all are".format(e))
+                return (m.name, closure)
+
+        self.missing = dict(nixops.parallel.run_tasks(
+            nr_workers=min(max_concurrent_query, max(len(machines), 1)),
+            tasks=machines, worker_fun=worker))
+
+        # How many machines lack each path.
+        self._nr_missing = {}
+        for paths in self.missing.itervalues():
+            for p in paths:
+                self._nr_missing[p] = self._nr_missing.get(p, 0) + 1
+
+    def bytes_to_copy(self, m):
+        """Return the number of bytes missing on machine ‘m’."""
+        return sum(self.sizes[p] for p in self.missing[m.name])
+
+    def unique_bytes(self, m):
+        """Return the number of bytes missing on ‘m’ only."""
+        return sum(self.sizes[p] for p in self.missing[m.name] if self._nr_missing[p] == 1)
+
+    def log(self, machines):
+        for m in machines:
+            if self.missing[m.name]:
+                m.logger.log("{0} store paths ({1}) to copy, {2} of them needed by this machine only"
+                             .format(len(self.missing[m.name]), format_size(self.bytes_to_copy(m)),
+                                     format_size(self.unique_bytes(m))))
+            else:
+                m.logger.log("closure already present")
+
+    def order(self, machines):
+        """Return the machines that lack store paths, those with the
+        most bytes to copy first, so that the largest copies don't
+        start last."""
+        return sorted([m for m in machines if self.missing[m.name]],
+                      key=lambda m: (-self.bytes_to_copy(m), m.name))
@@ -10,13 +10,19 @@ import shutil
 import threading
 import exceptions
 import errno
+import hashlib
+import multiprocessing
 from collections import defaultdict
 from xml.etree import ElementTree
 import nixops.statefile
 import nixops.backends
 import nixops.logger
 import nixops.parallel
-from nixops.nix_expr import RawValue, Function, Call, nixmerge, py2nix
+import nixops.closures
+import nixops.peer_copy
+import nixops.ssh_util
+import nixops.eval_cache
+from nixops.nix_expr import RawValue, Function, Call, nixmerge_into, py2nix
 import re
 from datetime import datetime, timedelta
 import getpass
@@ -29,6 +35,8 @@ from nixops.util import ansi_success
 import inspect
 import time
 import importlib
+import urlparse
+from contextlib import contextmanager
 
 class NixEvalError(Exception):
     pass
@@ -53,6 +61,11 @@ class Deployment(object):
     datadog_notify = nixops.util.attr_property("datadogNotify", False, bool)
     datadog_event_info = nixops.util.attr_property("datadogEventInfo", "")
     datadog_tags = nixops.util.attr_property("datadogTags", [], 'json')
+    binary_cache = nixops.util.attr_property("binaryCache", None)
+    binary_cache_substituter = nixops.util.attr_property("binaryCacheSubstituter", None)
+    # Average time in seconds it took to create a resource of each
+    # type, used to start the longest chains of dependencies first.
+    create_durations = nixops.util.attr_property("createDurations", {}, 'json')
 
     # internal variable to mark if network attribute of network has been evaluated (separately)
     network_attr_eval = False
@@ -73,24 +86,77 @@ class Deployment(object):
 
         self._lock_file_path = None
 
+        # Cache of evaluation results, see evaluate_config_json().
+        self.eval_cache = None
+
+        # (phase, seconds) pairs recorded by _timed().
+        self.timings = []
+
         self.expr_path = os.path.realpath(os.path.dirname(__file__) + "/../../../../share/nix/nixops")
         if not os.path.exists(self.expr_path):
             self.expr_path = os.path.realpath(os.path.dirname(__file__) + "/../../../../../share/nix/nixops")
         if not os.path.exists(self.expr_path):
             self.expr_path = os.path.dirname(__file__) + "/../nix"
 
-        self.resources = {}
-        with self._db:
-            c = self._db.cursor()
-            c.execute("select id, name, type from Resources where deployment = ?", (self.uuid,))
-            for (id, name, type) in c.fetchall():
-                r = _create_state(self, type, name, id)
-                self.resources[name] = r
-        self.logger.update_log_prefixes()
+        # Attribute caches, see _get_deployment_attrs() and
+        # _get_resource_attrs().
+        self._attrs = None
+        self._resource_attrs = {}
+
+        # Resource state objects are created on first access to
+        # ‘resources’, so that operations that only need deployment
+        # attributes don't pay for them.
+        self._resources = None
 
         self.definitions = None
 
 
+    @property
+    def resources(self):
+        resources = self._resources
+        if resources is None:
+            with self._db:
+                if self._resources is None:
+                    self._resources = self._load_resources()
+                resources = self._resources
+            self.logger.update_log_prefixes()
+        return resources
+
+
+    def _load_resources(self):
+        """Create the state objects of all resources in the deployment."""
+        resources = {}
+        self._db.flush()
+        c = self._db.cursor()
+        c.execute("select id, name, type from Resources where deployment = ?", (self.uuid,))
+        rows = c.fetchall()
+
+        # Fetch the attributes of all resources at once, rather
+        # than letting each resource state object query its own.
+        for (id, name, type) in rows:
+            self._resource_attrs[id] = {}
+        c.execute("select a.machine, a.name, a.value from ResourceAttrs a "
+                  "join Resources r on r.id = a.machine where r.deployment = ?", (self.uuid,))
+        for (id, name, value) in c.fetchall():
+            self._resource_attrs[id][name] = value
+
+        for (id, name, type) in rows:
+            resources[name] = _create_state(self, type, name, id)
+        return resources
+
+
+    @contextmanager
+    def _timed(self, phase):
+        """Record how long a phase of an operation takes in ‘timings’."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.timings.append((phase, elapsed))
+            if debug: print >> sys.stderr, "{0} took {1:.2f}s".format(phase, elapsed)
+
+
     @property
     def tempdir(self):
         if not self._tempdir:
@@ -130,14 +196,19 @@ class Deployment(object):
 
     def _set_attrs(self, attrs):
         """Update deployment attributes in the state file."""
-        with self._db:
-            c = self._db.cursor()
+        with self._db.lock:
             for n, v in attrs.iteritems():
                 if v == None:
-                    c.execute("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, n))
+                    self._db.queue(("DeploymentAttrs", self.uuid, n),
+                                   "delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, n))
                 else:
-                    c.execute("insert or replace into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
-                              (self.uuid, n, v))
+                    self._db.queue(("DeploymentAttrs", self.uuid, n),
+                                   "insert or replace into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
+                                   (self.uuid, n, v))
+            if self._attrs is not None:
+                if not _update_attrs_cache(self._attrs, attrs):
+                    self._attrs = None
+            self._db.write_queued()
 
 
     def _set_attr(self, name, value):
@@ -147,39 +218,80 @@ class Deployment(object):
 
     def _del_attr(self, name):
         """Delete a deployment attribute from the state file."""
-        with self._db:
-            self._db.execute("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, name))
+        self._set_attrs({name: None})
+
+
+    def _get_deployment_attrs(self):
+        """Return all deployment attributes, reading them from the state file on first use."""
+        attrs = self._attrs
+        if attrs is None:
+            with self._db:
+                self._db.flush()
+                c = self._db.cursor()
+                c.execute("select name, value from DeploymentAttrs where deployment = ?", (self.uuid,))
+                attrs = self._attrs = dict(c.fetchall())
+        return attrs
 
 
     def _get_attr(self, name, default=nixops.util.undefined):
         """Get a deployment attribute from the state file."""
-        with self._db:
-            c = self._db.cursor()
-            c.execute("select value from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, name))
-            row = c.fetchone()
-            if row != None: return row[0]
-            return nixops.util.undefined
+        return self._get_deployment_attrs().get(name, nixops.util.undefined)
+
+
+    def _get_resource_attrs(self, id):
+        """Return all attributes of the resource with the given ID.
+
+        The attributes are read from the state file with a single query
+        the first time they are needed and then served from memory.
+        """
+        attrs = self._resource_attrs.get(id)
+        if attrs is None:
+            # Updates are applied to the cache under the same lock, but
+            # may still be queued, so write them out before loading.
+            with self._db:
+                self._db.flush()
+                c = self._db.cursor()
+                c.execute("select name, value from ResourceAttrs where machine = ?", (id,))
+                attrs = self._resource_attrs[id] = dict(c.fetchall())
+        return attrs
+
+
+    def _set_resource_attrs(self, id, attrs):
+        """Update attributes of the resource with the given ID in the state file."""
+        with self._db.lock:
+            for n, v in attrs.iteritems():
+                if v == None:
+                    self._db.queue(("ResourceAttrs", id, n),
+                                   "delete from ResourceAttrs where machine = ? and name = ?", (id, n))
+                else:
+                    self._db.queue(("ResourceAttrs", id, n),
+                                   "insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                                   (id, n, v))
+            cached = self._resource_attrs.get(id)
+            if cached is not None and not _update_attrs_cache(cached, attrs):
+                del self._resource_attrs[id]
+            self._db.write_queued()
 
 
     def _create_resource(self, name, type):
-        c = self._db.cursor()
-        c.execute("select 1 from Resources where deployment = ? and name = ?", (self.uuid, name))
-        if len(c.fetchall()) != 0:
-            raise Exception("resource already exists in database!")
-        c.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
-                  (self.uuid, name, type))
-        id = c.lastrowid
+        resources = self.resources
+        with self._db:
+            c = self._db.cursor()
+            c.execute("select 1 from Resources where deployment = ? and name = ?", (self.uuid, name))
+            if len(c.fetchall()) != 0:
+                raise Exception("resource already exists in database!")
+            c.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
+                      (self.uuid, name, type))
+            id = c.lastrowid
+        self._resource_attrs[id] = {}
         r = _create_state(self, type, name, id)
-        self.resources[name] = r
+        resources[name] = r
         return r
 
 
     def export(self):
         with self._db:
-            c = self._db.cursor()
-            c.execute("select name, value from DeploymentAttrs where deployment = ?", (self.uuid,))
-            rows = c.fetchall()
-            res = {row[0]: row[1] for row in rows}
+            res = dict(self._get_deployment_attrs())
             res['resources'] = {r.name: r.export() for r in self.resources.itervalues()}
             return res
 
@@ -198,9 +310,11 @@ class Deployment(object):
     def clone(self):
         with self._db:
             new = self._statefile.create_deployment()
+            self._db.flush()
             self._db.execute("insert into DeploymentAttrs (deployment, name, value) " +
                              "select ?, name, value from DeploymentAttrs where deployment = ?",
                              (new.uuid, self.uuid))
+            new._attrs = None
             new.configs_path = None
             return new
 
@@ -233,7 +347,11 @@ class Deployment(object):
     def delete_resource(self, m):
         del self.resources[m.name]
         with self._db:
+            # Write queued attribute updates first; they would violate
+            # the foreign key constraint once the resource is gone.
+            self._db.flush()
             self._db.execute("delete from Resources where deployment = ? and id = ?", (self.uuid, m.id))
+        self._resource_attrs.pop(m.id, None)
 
 
     def delete(self, force=False):
@@ -248,7 +366,10 @@ class Deployment(object):
             for p in glob.glob(profile + "*"):
                 if os.path.islink(p): os.remove(p)
 
+            if self.eval_cache: self.eval_cache.remove(self.uuid)
+
             # Delete the deployment from the database.
+            self._db.flush()
             self._db.execute("delete from Deployments where uuid = ?", (self.uuid,))
 
 
@@ -311,7 +432,6 @@ class Deployment(object):
 
     def evaluate_config(self, attr):
         try:
-            # FIXME: use --json
             xml = subprocess.check_output(
                 ["nix-instantiate"]
                 + self.extra_nix_eval_flags
@@ -333,46 +453,107 @@ class Deployment(object):
         config = nixops.util.xml_expr_to_python(tree.find("*"))
         return (tree, config)
 
+    def _eval_cache_key(self):
+        """Return a fingerprint of everything that the evaluation of the
+        deployment specification depends on, or None if there is no
+        affordable way to compute it."""
+        env_nix_path = os.environ.get("NIX_PATH", "")
+        nix_path = self.extra_nix_path + self.nix_path + env_nix_path.split(":")
+        paths = [self.expr_path]
+        for x in nix_path:
+            p = x.split("=", 1)[-1]
+            if p and "://" not in p: paths.append(os.path.expanduser(p))
+        if not env_nix_path: paths.append(os.path.expanduser("~/.nix-defexpr"))
+        for x in self.nix_exprs:
+            if x[0] != '<': paths.append(os.path.dirname(os.path.abspath(x)))
+        db_file = os.path.abspath(self._statefile.db_file)
+        return nixops.eval_cache.fingerprint(
+            [self.uuid, self.name, self.args, self.nix_exprs, nix_path,
+             self.extra_nix_flags, self.extra_nix_eval_flags],
+            paths, exclude=[db_file, self.eval_cache.cache_dir] + [db_file + s for s in ("-wal", "-shm", "-journal")])
+
+    def evaluate_config_json(self, attr):
+        """Evaluate an attribute of ‘jsonInfo’ (see eval-machine-info.nix)
+        and return it as a Python value.  This is much cheaper than
+        going through the XML output of evaluate_config().
+
+        If ‘eval_cache’ is set (‘--eval-cache’), the result is reused
+        as long as the directories of the network expressions and the
+        local entries of the Nix search path are unchanged.  This
+        doesn't notice changes in files imported from elsewhere, in
+        URLs on the search path or in environment variables read by
+        the network expressions, which is why it is off by default.
+        Results containing the text of ‘deployment.keys’ are never
+        cached.
+        """
+        key = self._eval_cache_key() if self.eval_cache else None
+        if key:
+            value = self.eval_cache.get(self.uuid, attr, key)
+            if value is not None: return value
+
+        try:
+            with self._timed("evaluation of ‘{0}’".format(attr)):
+                out = subprocess.check_output(
+                    ["nix-instantiate"]
+                    + self.extra_nix_eval_flags
+                    + self._eval_flags(self.nix_exprs) +
+                    ["--eval-only", "--json", "--strict",
+                     "--arg", "checkConfigurationOptions", "false",
+                     "-A", attr], stderr=self.logger.log_file)
+                value = json.loads(out)
+            if debug: print >> sys.stderr, "JSON output of nix-instantiate:\n" + out
+        except OSError as e:
+            raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
+        except subprocess.CalledProcessError:
+            raise NixEvalError
+
+        if key and not _has_keys(value): self.eval_cache.put(self.uuid, attr, key, value)
+        return value
+
+    def _set_network_attrs(self, config):
+        """Set the global deployment attributes from the evaluated ‘network’ attribute."""
+        self.description = config.get("description", self.default_description)
+        self.rollback_enabled = config.get("enableRollback", False)
+        self.datadog_notify = config.get("datadogNotify", False)
+        self.datadog_event_info = config.get("datadogEventInfo", "")
+        self.datadog_tags = config.get("datadogTags", [])
+        self.datadog_downtime = config.get("datadogDowntime", False)
+        self.datadog_downtime_seconds = config.get("datadogDowntimeSeconds", 3600)
+        self.binary_cache = config.get("binaryCache", None)
+        self.binary_cache_substituter = config.get("binaryCacheSubstituter", None)
+        self.network_attr_eval = True
+
     def evaluate_network(self, action=''):
         if not self.network_attr_eval:
             # Extract global deployment attributes.
             try:
-                (_, config) = self.evaluate_config("info.network")
+                config = self.evaluate_config_json("jsonInfo.network")
             except Exception as e:
                 if action not in ('destroy', 'delete'):
                     raise e
                 config = {}
-            self.description = config.get("description", self.default_description)
-            self.rollback_enabled = config.get("enableRollback", False)
-            self.datadog_notify = config.get("datadogNotify", False)
-            self.datadog_event_info = config.get("datadogEventInfo", "")
-            self.datadog_tags = config.get("datadogTags", [])
-            self.datadog_downtime = config.get("datadogDowntime", False)
-            self.datadog_downtime_seconds = config.get("datadogDowntimeSeconds", 3600)
-            self.network_attr_eval = True
+            self._set_network_attrs(config)
 
     def evaluate(self):
         """Evaluate the Nix expressions belonging to this deployment into a deployment specification."""
 
         self.definitions = {}
-        self.evaluate_network()
 
-        (tree, config) = self.evaluate_config("info")
+        # Get the global deployment attributes, machines and resources
+        # from a single evaluation, so that the network expressions
+        # and Nixpkgs are only evaluated once.
+        config = self.evaluate_config_json("jsonInfo")
+        self._set_network_attrs(config["network"])
 
-        # Extract machine information.
-        for x in tree.findall("attrs/attr[@name='machines']/attrs/attr"):
-            name = x.get("name")
-            cfg = config["machines"][name]
-            defn = _create_definition(x, cfg, cfg["targetEnv"])
-            self.definitions[name] = defn
+        with self._timed("creation of definitions"):
+            # Extract machine information.
+            for name, cfg in config["machines"].iteritems():
+                self.definitions[name] = _create_definition(name, cfg, cfg["targetEnv"])
 
-        # Extract info about other kinds of resources.
-        for x in tree.findall("attrs/attr[@name='resources']/attrs/attr"):
-            res_type = x.get("name")
-            for y in x.findall("attrs/attr"):
-                name = y.get("name")
-                defn = _create_definition(y, config["resources"][res_type][name], res_type)
-                self.definitions[name] = defn
+            # Extract info about other kinds of resources.
+            for res_type, defs in config["resources"].iteritems():
+                for name, cfg in defs.iteritems():
+                    self.definitions[name] = _create_definition(name, cfg, res_type)
 
 
     def evaluate_option_value(self, machine_name, option_name, json=False, xml=False, include_physical=False):
@@ -407,8 +588,11 @@ class Deployment(object):
             raise Exception("Could not determine arguments to NixOps deployment.")
 
 
-    def get_physical_spec(self):
-        """Compute the contents of the Nix expression specifying the computed physical deployment attributes"""
+    def _get_physical_spec_parts(self):
+        """Compute the physical deployment attributes.  Returns the
+        values shared by all machines, which the expressions must be
+        able to refer to as ‘shared’, and a list of (resource,
+        expression) pairs."""
 
         active_machines = self.active
         active_resources = self.active_resources
@@ -430,7 +614,28 @@ class Deployment(object):
         # This is critical for example when using host names for access
         # control, because the canonical_hostname is returned in reverse
         # lookups.
+        #
+        # The addresses of all resources as seen from a machine are the
+        # same for all machines in its address scope, so they are only
+        # computed once per scope and emitted once as a shared value.
+        # ‘hosts’ only holds the entries specific to a machine.
         hosts = defaultdict(lambda: defaultdict(list))
+        scope_hosts = {}
+
+        def hosts_to_string(h):
+            # Sort the hosts by its canonical host names.
+            sorted_hosts = sorted(h.iteritems(), key=lambda item: item[1][0])
+            # Just to remember the format:
+            #   ip_address canonical_hostname [aliases...]
+            return "".join(["{0} {1}\n".format(ip, ' '.join(names)) for ip, names in sorted_hosts])
+
+        def addresses_seen_by(m):
+            h = defaultdict(list)
+            for m2 in active_resources.itervalues():
+                ip = m.address_to(m2)
+                if ip:
+                    h[ip] += [m2.name, m2.name + "-unencrypted"]
+            return hosts_to_string(h)
 
         def index_to_private_ip(index):
             n = 105 + index / 256
@@ -441,16 +646,11 @@ class Deployment(object):
             defn = self.definitions[m.name]
             attrs_list = attrs_per_resource[m.name]
 
-            # Emit configuration to realise encrypted peer-to-peer links.
-            for m2 in active_resources.itervalues():
-                ip = m.address_to(m2)
-                if ip:
-                    hosts[m.name][ip] += [m2.name, m2.name + "-unencrypted"]
-
             # Always use the encrypted/unencrypted suffixes for aliases rather
             # than for the canonical name!
             hosts[m.name]["127.0.0.1"].append(m.name + "-encrypted")
 
+            # Emit configuration to realise encrypted peer-to-peer links.
             for m2_name in defn.encrypted_links_to:
 
                 if m2_name not in active_machines:
@@ -523,20 +723,45 @@ class Deployment(object):
         for m in active_machines.itervalues():
             do_machine(m)
 
+        # Values shared by all machines, bound in a ‘let’ so that they
+        # appear only once in the generated expression.
+        shared = {}
+
+        # SSH public host keys for all machines in network.
+        known_hosts = {}
+        for m2 in active_machines.itervalues():
+            if hasattr(m2, 'public_host_key') and m2.public_host_key:
+                # Using references to files in same tempdir for now, until NixOS has support
+                # for adding the keys directly as string. This way at least it is compatible
+                # with older versions of NixOS as well.
+                # TODO: after reasonable amount of time replace with string option
+                known_hosts[m2.name] = {
+                    'hostNames': [m2.name + "-unencrypted",
+                                  m2.name + "-encrypted",
+                                  m2.name],
+                    'publicKey': m2.public_host_key,
+                }
+        if known_hosts:
+            shared['knownHosts'] = known_hosts
+
+        def extra_hosts(m):
+            own = hosts_to_string(hosts[m.name])
+            scope = m.address_scope()
+            if scope is None:
+                return own + addresses_seen_by(m)
+            if scope not in scope_hosts:
+                name = "hosts{0}".format(len(scope_hosts))
+                shared[name] = addresses_seen_by(m)
+                scope_hosts[scope] = name
+            return RawValue("{0} + shared.{1}".format(py2nix(own, inline=True), scope_hosts[scope]))
+
         def emit_resource(r):
-            config = []
-            config.extend(attrs_per_resource[r.name])
+            config = {}
+            for attrs in attrs_per_resource[r.name]:
+                nixmerge_into(config, attrs)
             if is_machine(r):
-                # Sort the hosts by its canonical host names.
-                sorted_hosts = sorted(hosts[r.name].iteritems(),
-                                      key=lambda item: item[1][0])
-                # Just to remember the format:
-                #   ip_address canonical_hostname [aliases...]
-                extra_hosts = ["{0} {1}".format(ip, ' '.join(names))
-                               for ip, names in sorted_hosts]
-
                 if authorized_keys[r.name]:
-                    config.append({
+                    nixmerge_into(config, {
                         ('users', 'extraUsers', 'root'): {
                             ('openssh', 'authorizedKeys', 'keys'): authorized_keys[r.name]
                         },
@@ -545,47 +770,80 @@ class Deployment(object):
                         },
                     })
 
-                config.append({
+                nixmerge_into(config, {
                     ('boot', 'kernelModules'): list(kernel_modules[r.name]),
                     ('networking', 'firewall'): {
                         'trustedInterfaces': list(trusted_interfaces[r.name])
                     },
-                    ('networking', 'extraHosts'): '\n'.join(extra_hosts) + "\n"
+                    ('networking', 'extraHosts'): extra_hosts(r)
                 })
 
+                if known_hosts:
+                    config[('services', 'openssh', 'knownHosts')] = RawValue("shared.knownHosts")
 
-                # Add SSH public host keys for all machines in network.
-                for m2 in active_machines.itervalues():
-                    if hasattr(m2, 'public_host_key') and m2.public_host_key:
-                        # Using references to files in same tempdir for now, until NixOS has support
-                        # for adding the keys directly as string. This way at least it is compatible
-                        # with older versions of NixOS as well.
-                        # TODO: after reasonable amount of time replace with string option
-                        config.append({
-                            ('services', 'openssh', 'knownHosts', m2.name): {
-                                 'hostNames': [m2.name + "-unencrypted",
-                                               m2.name + "-encrypted",
-                                               m2.name],
-                                 'publicKey': m2.public_host_key,
-                            }
-                        })
-
-            merged = reduce(nixmerge, config) if len(config) > 0 else {}
             physical = r.get_physical_spec()
 
-            if len(merged) == 0 and len(physical) == 0:
-                return {}
+            if len(config) == 0 and len(physical) == 0:
+                return None
             else:
-                return r.prefix_definition({
-                    r.name: Function("{ config, lib, pkgs, ... }", {
-                        'config': merged,
-                        'imports': [physical],
-                    })
+                return Function("{ config, lib, pkgs, ... }", {
+                    'config': config,
+                    'imports': [physical],
                 })
 
-        return py2nix(reduce(nixmerge, [
-            emit_resource(r) for r in active_resources.itervalues()
-        ], {})) + "\n"
+        specs = [(r, emit_resource(r)) for r in active_resources.itervalues()]
+        return (shared, [(r, spec) for (r, spec) in specs if spec is not None])
+
+    def get_physical_spec(self):
+        """Compute the contents of the Nix expression specifying the computed physical deployment attributes"""
+        (shared, specs) = self._get_physical_spec_parts()
+        spec = {}
+        for (r, defn) in specs:
+            nixmerge_into(spec, r.prefix_definition({r.name: defn}))
+        spec = py2nix(spec)
+        if shared:
+            spec = u"let shared = {0}; in\n{1}".format(py2nix(shared), spec)
+        return spec + "\n"
+
+    def write_physical_spec(self, dir):
+        """Write the physical deployment attributes to ‘dir’, one file
+        per resource plus one with the values they share, and return
+        the path of the Nix expression combining them and a hash of
+        their contents.  Only files whose contents changed are
+        rewritten, and files of resources that no longer exist are
+        removed."""
+        (shared, specs) = self._get_physical_spec_parts()
+        files = {}
+
+        def file_name(name):
+            if not re.match(r"^[A-Za-z0-9_][A-Za-z0-9_.-]*$", name):
+                name = hashlib.sha256(name.encode("utf-8")).hexdigest()[:32]
+            return "resource-{0}.nix".format(name)
+
+        spec = {}
+        for (r, defn) in specs:
+            name = file_name(r.name)
+            files[name] = "shared: " + py2nix(defn) + "\n"
+            nixmerge_into(spec, r.prefix_definition({r.name: RawValue("import ./{0} shared".format(name))}))
+        files["shared.nix"] = py2nix(shared) + "\n"
+        files["physical.nix"] = u"let shared = import ./shared.nix; in\n{0}\n".format(py2nix(spec))
+
+        h = hashlib.sha256()
+        for name in sorted(files):
+            contents = files[name]
+            if isinstance(contents, unicode): contents = contents.encode("utf-8")
+            h.update("{0}\0{1}\0".format(name, hashlib.sha256(contents).hexdigest()))
+            path = os.path.join(dir, name)
+            if os.path.exists(path):
+                with open(path) as f:
+                    if f.read() == contents: continue
+            nixops.util.write_private_file(path, contents)
+
+        for name in os.listdir(dir):
+            if name.startswith("resource-") and name.endswith(".nix") and name not in files:
+                os.remove(os.path.join(dir, name))
+
+        return (os.path.join(dir, "physical.nix"), h.hexdigest())
 
     def get_profile(self):
         profile_dir = "/nix/var/nix/profiles/per-user/" + getpass.getuser()
@@ -601,8 +859,15 @@ class Deployment(object):
         return profile
 
 
-    def build_configs(self, include, exclude, dry_run=False, repair=False):
-        """Build the machine configurations in the Nix store."""
+    def build_configs(self, include, exclude, dry_run=False, repair=False,
+                      max_concurrent_build=None, on_built=None):
+        """Build the machine configurations in the Nix store.
+
+        By default, all selected machines are built by a single
+        nix-build.  If ‘max_concurrent_build’ is set, each machine is
+        instantiated and built separately, at most that many at a time
+        (-1 meaning all), and ‘on_built’ is called with each machine
+        as soon as its configuration has been built."""
 
         self.logger.log("building all machine configurations...")
 
@@ -615,10 +880,16 @@ class Deployment(object):
         if os.path.exists(nixos_path + "/.git") and os.path.exists(get_version_script):
             self.nixos_version_suffix = subprocess.check_output(["/bin/sh", get_version_script] + self._nix_path_flags()).rstrip()
 
-        phys_expr = self.tempdir + "/physical.nix"
-        p = self.get_physical_spec()
-        nixops.util.write_file(phys_expr, p)
-        if debug: print >> sys.stderr, "generated physical spec:\n" + p
+        # With the evaluation cache, the physical spec is kept in a
+        # private directory across runs, so that the files of
+        # resources that didn't change stay the same.
+        if self.eval_cache:
+            phys_dir = self.eval_cache.get_private_dir(self.uuid, "physical")
+        else:
+            phys_dir = self.tempdir + "/physical"
+            if not os.path.exists(phys_dir): os.mkdir(phys_dir, 0700)
+        (phys_expr, phys_hash) = self.write_physical_spec(phys_dir)
+        if debug: print >> sys.stderr, "generated physical spec in ‘{0}’".format(phys_dir)
 
         selected = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
 
@@ -652,6 +923,55 @@ class Deployment(object):
             if not os.path.exists(load_dir): os.makedirs(load_dir, 0700)
             os.environ['NIX_CURRENT_LOAD'] = load_dir
 
+        # While neither the inputs of the evaluation nor the physical
+        # spec change, the configurations built last time are still
+        # valid.  This has to cover the whole physical spec, since a
+        # machine's configuration can refer to the physical attributes
+        # of other machines through ‘nodes’.
+        build_key = None
+        if self.eval_cache and not repair:
+            inputs = self._eval_cache_key()
+            if inputs: build_key = hashlib.sha256("{0}\0{1}".format(inputs, phys_hash)).hexdigest()
+
+        if max_concurrent_build is not None:
+            with self._timed("build"):
+                configs_path = self._build_machines(
+                    selected, phys_expr, max_concurrent_build, on_built,
+                    dry_run=dry_run, repair=repair, build_key=build_key)
+            if dry_run: return configs_path
+        else:
+            with self._timed("build"):
+                configs_path = self._build_network(
+                    names, phys_expr, dry_run=dry_run, repair=repair, build_key=build_key)
+
+        if self.rollback_enabled and not dry_run:
+            profile = self.create_profile()
+            if subprocess.call(["nix-env", "-p", profile, "--set", configs_path]) != 0:
+                raise Exception("cannot update profile ‘{0}’".format(profile))
+
+        return configs_path
+
+
+    def _build_network(self, names, phys_expr, dry_run=False, repair=False, build_key=None):
+        """Build the configurations of the machines ‘names’ with a
+        single nix-build and return the resulting store path.  If
+        ‘build_key’ is set, the path is recorded in the evaluation
+        cache under that key, and is reused while the key and the
+        selected machines stay the same."""
+        configs_key = None
+        if build_key and not dry_run:
+            configs_key = hashlib.sha256("{0}\0{1}".format(build_key, " ".join(sorted(names)))).hexdigest()
+        previous = self.eval_cache.get(self.uuid, "configs", configs_key) if configs_key else None
+        if previous and os.path.exists(previous):
+            self.logger.log("machine configurations are unchanged, not building them again")
+            try:
+                subprocess.check_output(
+                    ["nix-store", "-r", previous, "--add-root", self.tempdir + "/configs", "--indirect"],
+                    stderr=self.logger.log_file)
+                return previous
+            except subprocess.CalledProcessError:
+                pass
+
         try:
             configs_path = subprocess.check_output(
                 ["nix-build"]
@@ -663,106 +983,296 @@ class Deployment(object):
                 stderr=self.logger.log_file).rstrip()
         except subprocess.CalledProcessError:
             raise Exception("unable to build all machine configurations")
+        if configs_key: self.eval_cache.put(self.uuid, "configs", configs_key, configs_path)
+        return configs_path
 
-        if self.rollback_enabled and not dry_run:
-            profile = self.create_profile()
-            if subprocess.call(["nix-env", "-p", profile, "--set", configs_path]) != 0:
-                raise Exception("cannot update profile ‘{0}’".format(profile))
 
-        return configs_path
+    def _build_machines(self, machines, phys_expr, max_concurrent_build, on_built,
+                        dry_run=False, repair=False, build_key=None):
+        """Instantiate and build the configuration of each machine
+        separately, so that one slow or broken machine doesn't hold up
+        the others.  Return a store path containing a symlink to the
+        configuration of each machine, like the ‘machines’ attribute
+        of the network, or None if ‘dry_run’ is set.
 
+        If ‘build_key’ is set, the configuration built for each machine
+        is recorded in the evaluation cache under that key, and
+        machines whose recorded configuration still exists are not
+        instantiated again."""
+        configs_dir = self.tempdir + "/machine-configs"
+        if not os.path.exists(configs_dir): os.mkdir(configs_dir)
 
-    def copy_closures(self, configs_path, include, exclude, max_concurrent_copy):
-        """Copy the closure of each machine configuration to the corresponding machine."""
+        previous = (self.eval_cache.get(self.uuid, "toplevels", build_key) if build_key else None) or {}
+        built = dict(previous)
 
         def worker(m):
-            if not should_do(m, include, exclude): return
-            m.logger.log("copying closure...")
+            toplevel = previous.get(m.name)
+            try:
+                if toplevel and os.path.exists(toplevel):
+                    m.logger.log("configuration is unchanged, not instantiating it again")
+                    path = toplevel
+                else:
+                    m.logger.log("building configuration...")
+                    path = subprocess.check_output(
+                        ["nix-instantiate"]
+                        + self._eval_flags(self.nix_exprs + [phys_expr]) +
+                        ["--argstr", "name", m.name, "-A", "toplevel"],
+                        stderr=self.logger.log_file).rstrip()
+                subprocess.check_call(
+                    ["nix-store", "-r", path] + self.extra_nix_flags
+                    + (["--dry-run"] if dry_run else
+                       ["--add-root", configs_dir + "/" + m.name, "--indirect"])
+                    + (["--repair"] if repair else []),
+                    stdout=self.logger.log_file, stderr=self.logger.log_file)
+            except subprocess.CalledProcessError:
+                raise Exception("unable to build the configuration of machine ‘{0}’".format(m.name))
+            if dry_run: return
+            m.new_toplevel = os.path.realpath(configs_dir + "/" + m.name)
+            built[m.name] = m.new_toplevel
+            if on_built: on_built(m)
+
+        try:
+            nixops.parallel.run_tasks(nr_workers=max_concurrent_build, tasks=machines, worker_fun=worker)
+        finally:
+            if build_key and built != previous: self.eval_cache.put(self.uuid, "toplevels", build_key, built)
+        if dry_run: return None
+
+        # Combine the configurations into a single store path, since
+        # the result is recorded in the state and may become a profile
+        # generation, so it must outlive the temporary directory.
+        attrs = {m.name: Call(RawValue("builtins.storePath"), m.new_toplevel) for m in machines}
+        try:
+            return subprocess.check_output(
+                ["nix-build"] + self._nix_path_flags() +
+                ["<nixops/update-profile.nix>",
+                 "--arg", "machines", py2nix(attrs, inline=True),
+                 "-o", self.tempdir + "/configs"],
+                stderr=self.logger.log_file).rstrip()
+        except subprocess.CalledProcessError:
+            raise Exception("unable to build all machine configurations")
+
+
+    def _check_binary_cache(self):
+        """Refuse to use ‘network.binaryCache’ unless the paths uploaded
+        to it are signed.  The machines fetch them as root, so anyone
+        who can write to the cache, or tamper with the connection to
+        it, could otherwise make them run arbitrary code."""
+        params = urlparse.parse_qs(self.binary_cache.partition("?")[2])
+        if not params.get("secret-key"):
+            raise Exception("‘network.binaryCache’ must have a ‘secret-key’ parameter, so that the machines can check the signatures of the paths they fetch from it")
+
+
+    def _push_to_binary_cache(self, paths):
+        """Copy the closures of ‘paths’ to ‘network.binaryCache’."""
+        self.logger.log("copying {0} closures to binary cache ‘{1}’..."
+                        .format(len(paths), self.binary_cache.split("?")[0]))
+        try:
+            with self._timed("push to binary cache"):
+                subprocess.check_call(["nix", "copy", "--to", self.binary_cache] + sorted(paths),
+                                      stdout=self.logger.log_file, stderr=self.logger.log_file)
+        except subprocess.CalledProcessError:
+            raise Exception("unable to copy closures to binary cache ‘{0}’".format(self.binary_cache.split("?")[0]))
+
+
+    def _copy_closure(self, m, pushed=False, missing=None):
+        if not os.path.exists(m.new_toplevel):
+            raise Exception("can't find closure of machine ‘{0}’".format(m.name))
+        if self.binary_cache:
+            if not pushed:
+                self._check_binary_cache()
+                self._push_to_binary_cache([m.new_toplevel])
+            substituter = self.binary_cache_substituter or self.binary_cache.split("?")[0]
+            m.logger.log("fetching closure from ‘{0}’...".format(substituter))
+            try:
+                m.copy_closure_from_cache(m.new_toplevel, substituter)
+                return
+            except Exception as e:
+                m.logger.warn("cannot fetch closure from binary cache ({0}), copying it directly".format(e))
+        m.logger.log("copying closure...")
+        m.copy_closure_to(m.new_toplevel, missing)
+
+
+    def _is_unchanged(self, m, check):
+        """Whether the state file records that machine ‘m’ already runs
+        ‘m.new_toplevel’, in which case it need not be contacted.
+        Unless ‘check’ is set, the recorded state is trusted."""
+        return not check and m.state != m.RESCUE and m.cur_toplevel == m.new_toplevel
+
+
+    def copy_closures(self, configs_path, include, exclude, max_concurrent_copy, peer_copy=False,
+                      adaptive_copy=False, check=False):
+        """Copy the closure of each machine configuration to the
+        corresponding machine, skipping machines that already run it
+        unless ‘check’ is set.  If ‘peer_copy’ is set, machines that
+        already have their closure copy the paths they share with
+        other machines that they can reach directly to them.  If
+        ‘adaptive_copy’ is set, the number of concurrent copies varies
+        between 1 and ‘max_concurrent_copy’ depending on the
+        throughput they achieve."""
+
+        selected = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        for m in selected:
             m.new_toplevel = os.path.realpath(configs_path + "/" + m.name)
             if not os.path.exists(m.new_toplevel):
                 raise Exception("can't find closure of machine ‘{0}’".format(m.name))
-            m.copy_closure_to(m.new_toplevel)
 
-        nixops.parallel.run_tasks(
-            nr_workers=max_concurrent_copy,
-            tasks=self.active.itervalues(), worker_fun=worker)
+        unchanged = [m for m in selected if self._is_unchanged(m, check)]
+        if unchanged:
+            self.logger.log("{0} of {1} machines already run their configuration, not copying their closures"
+                            .format(len(unchanged), len(selected)))
+            selected = [m for m in selected if m not in unchanged]
+
+        # Don't contact machines that use the local Nix store.
+        selected = [m for m in selected if m.needs_closure_copy()]
+
+        with self._timed("copy"):
+            nixops.ssh_util.start_masters(set(m.get_ssh_for_copy_closure() for m in selected))
+
+            # Query the closures and the paths that each machine lacks
+            # once, and copy only the closures of the missing paths.
+            # nix-copy-closure does that by itself for a single machine.
+            plan = None
+            if len(selected) > 1 or peer_copy or adaptive_copy:
+                plan = nixops.closures.CopyPlan(selected)
+                plan.log(selected)
+                selected = plan.order(selected)
+            missing = lambda m: plan.missing[m.name] if plan else None
+            if self.binary_cache:
+                if peer_copy or adaptive_copy:
+                    raise Exception("‘network.binaryCache’ cannot be combined with copying closures between machines or adapting the number of concurrent copies")
+                self._check_binary_cache()
+                # The targets fetch their closures from the cache, so
+                # the local machine only uploads each path once.
+                if selected: self._push_to_binary_cache(set(m.new_toplevel for m in selected))
+                nixops.parallel.run_tasks(
+                    nr_workers=-1, tasks=selected,
+                    worker_fun=lambda m: self._copy_closure(m, pushed=True, missing=missing(m)))
+            elif peer_copy:
+                nixops.peer_copy.copy_closures(selected, max_concurrent_copy, self.logger, plan=plan)
+            elif adaptive_copy and selected:
+                limit = nixops.parallel.AdaptiveLimit(
+                    1, max_concurrent_copy if max_concurrent_copy != -1 else len(selected))
+                def worker(m):
+                    limit.acquire()
+                    nr_bytes = 0
+                    try:
+                        self._copy_closure(m, missing=plan.missing[m.name])
+                        nr_bytes = plan.bytes_to_copy(m)
+                    finally:
+                        limit.release(nr_bytes)
+                start = time.time()
+                try:
+                    nixops.parallel.run_tasks(nr_workers=limit.maximum, tasks=selected, worker_fun=worker)
+                finally:
+                    elapsed = max(time.time() - start, 0.001)
+                    self.logger.log("copied {0} in {1:.1f}s ({2}/s); number of concurrent copies: {3}"
+                                    .format(nixops.closures.format_size(limit.total_bytes), elapsed,
+                                            nixops.closures.format_size(limit.total_bytes / elapsed),
+                                            " → ".join(str(n) for n in limit.history)))
+            else:
+                nixops.parallel.run_tasks(
+                    nr_workers=max_concurrent_copy,
+                    tasks=selected, worker_fun=lambda m: self._copy_closure(m, missing=missing(m)))
         self.logger.log(ansi_success("{0}> closures copied successfully".format(self.name or "unnamed"), outfile=self.logger._log_file))
 
 
-    def activate_configs(self, configs_path, include, exclude, allow_reboot,
-                         force_reboot, check, sync, always_activate, dry_activate, max_concurrent_activate):
-        """Activate the new configuration on a machine."""
+    def _activate_config(self, m, configs_path, allow_reboot, force_reboot,
+                         sync, always_activate, dry_activate, check=False):
+        """Activate the new configuration on a machine.  Return the
+        name of the machine if this failed, and None otherwise."""
 
-        def worker(m):
-            if not should_do(m, include, exclude): return
+        try:
+            if not (always_activate or self.definitions[m.name].always_activate or force_reboot) \
+               and self._is_unchanged(m, check):
+                m.log("configuration unchanged, not activating")
+                if not dry_activate:
+                    # Keys aren't part of the configuration, so they
+                    # may have changed anyway.
+                    m.send_keys()
+                    if configs_path:
+                        with self._db: m.cur_configs_path = configs_path
+                return
 
-            try:
-                # Set the system profile to the new configuration.
-                daemon_var = '' if m.state == m.RESCUE else 'env NIX_REMOTE=daemon '
-                setprof = daemon_var + 'nix-env -p /nix/var/nix/profiles/system --set "{0}"'
-                if always_activate or self.definitions[m.name].always_activate:
-                    m.run_command(setprof.format(m.new_toplevel))
-                else:
-                    # Only activate if the profile has changed.
-                    new_profile_cmd = '; '.join([
-                        'old_gen="$(readlink -f /nix/var/nix/profiles/system)"',
-                        'new_gen="$(readlink -f "{0}")"',
-                        '[ "x$old_gen" != "x$new_gen" ] || exit 111',
-                        setprof
-                    ]).format(m.new_toplevel)
-
-                    ret = m.run_command(new_profile_cmd, check=False)
-                    if ret == 111:
-                        m.log("configuration already up to date")
-                        return
-                    elif ret != 0:
-                        raise Exception("unable to set new system profile")
-
-                m.send_keys()
-
-                if force_reboot or m.state == m.RESCUE:
-                    switch_method = "boot"
-                elif dry_activate:
-                    switch_method = "dry-activate"
-                else:
-                    switch_method = "switch"
+            # Set the system profile to the new configuration.
+            daemon_var = '' if m.state == m.RESCUE else 'env NIX_REMOTE=daemon '
+            setprof = daemon_var + 'nix-env -p /nix/var/nix/profiles/system --set "{0}"'
+            if always_activate or self.definitions[m.name].always_activate:
+                m.run_command(setprof.format(m.new_toplevel))
+            else:
+                # Only activate if the profile has changed.
+                new_profile_cmd = '; '.join([
+                    'old_gen="$(readlink -f /nix/var/nix/profiles/system)"',
+                    'new_gen="$(readlink -f "{0}")"',
+                    '[ "x$old_gen" != "x$new_gen" ] || exit 111',
+                    setprof
+                ]).format(m.new_toplevel)
+
+                ret = m.run_command(new_profile_cmd, check=False)
+                if ret == 111:
+                    m.log("configuration already up to date")
+                    return
+                elif ret != 0:
+                    raise Exception("unable to set new system profile")
 
-                # Run the switch script.  This will also update the
-                # GRUB boot loader.
-                res = m.switch_to_configuration(switch_method, sync)
+            m.send_keys()
 
-                if dry_activate: return
+            if force_reboot or m.state == m.RESCUE:
+                switch_method = "boot"
+            elif dry_activate:
+                switch_method = "dry-activate"
+            else:
+                switch_method = "switch"
+
+            # Run the switch script.  This will also update the
+            # GRUB boot loader.
+            res = m.switch_to_configuration(switch_method, sync)
+
+            if dry_activate: return
+
+            if res != 0 and res != 100:
+                raise Exception("unable to activate new configuration (exit code {})".format(res))
+
+            if res == 100 or force_reboot or m.state == m.RESCUE:
+                if not allow_reboot and not force_reboot:
+                    raise Exception("the new configuration requires a "
+                                    "reboot to take effect (hint: use "
+                                    "‘--allow-reboot’)".format(m.name))
+                m.reboot_sync()
+                res = 0
+                # FIXME: should check which systemd services
+                # failed to start after the reboot.
+
+            if res == 0:
+                m.success("activation finished successfully")
+
+            # Record that we switched this machine to the new
+            # configuration.
+            with self._db:
+                if configs_path: m.cur_configs_path = configs_path
+                m.cur_toplevel = m.new_toplevel
 
-                if res != 0 and res != 100:
-                    raise Exception("unable to activate new configuration (exit code {})".format(res))
+        except Exception as e:
+            # This thread shouldn't throw an exception because
+            # that will cause NixOps to exit and interrupt
+            # activation on the other machines.
+            m.logger.error(traceback.format_exc())
+            return m.name
+        return None
 
-                if res == 100 or force_reboot or m.state == m.RESCUE:
-                    if not allow_reboot and not force_reboot:
-                        raise Exception("the new configuration requires a "
-                                        "reboot to take effect (hint: use "
-                                        "‘--allow-reboot’)".format(m.name))
-                    m.reboot_sync()
-                    res = 0
-                    # FIXME: should check which systemd services
-                    # failed to start after the reboot.
 
-                if res == 0:
-                    m.success("activation finished successfully")
+    def activate_configs(self, configs_path, include, exclude, allow_reboot,
+                         force_reboot, check, sync, always_activate, dry_activate, max_concurrent_activate):
+        """Activate the new configuration on a machine.  Machines that
+        already run it according to the state file are skipped unless
+        ‘check’ is set."""
 
-                # Record that we switched this machine to the new
-                # configuration.
-                m.cur_configs_path = configs_path
-                m.cur_toplevel = m.new_toplevel
+        def worker(m):
+            if not should_do(m, include, exclude): return
+            return self._activate_config(m, configs_path, allow_reboot, force_reboot,
+                                         sync, always_activate, dry_activate, check)
 
-            except Exception as e:
-                # This thread shouldn't throw an exception because
-                # that will cause NixOps to exit and interrupt
-                # activation on the other machines.
-                m.logger.error(traceback.format_exc())
-                return m.name
-            return None
-
-        res = nixops.parallel.run_tasks(nr_workers=max_concurrent_activate, tasks=self.active.itervalues(), worker_fun=worker)
+        with self._timed("activation"):
+            res = nixops.parallel.run_tasks(nr_workers=max_concurrent_activate, tasks=self.active.itervalues(), worker_fun=worker)
         failed = [x for x in res if x != None]
         if failed != []:
             raise Exception("activation of {0} of {1} machines failed (namely on {2})"
@@ -880,17 +1390,18 @@ class Deployment(object):
         # Determine the set of active resources.  (We can't just
         # delete obsolete resources from ‘self.resources’ because they
         # contain important state that we don't want to forget about.)
-        for m in self.resources.values():
-            if m.name in self.definitions:
-                if m.obsolete:
-                    self.logger.log("resource ‘{0}’ is no longer obsolete".format(m.name))
-                    m.obsolete = False
-            else:
-                self.logger.log("resource ‘{0}’ is obsolete".format(m.name))
-                if not m.obsolete: m.obsolete = True
-                if not should_do(m, include, exclude): continue
-                if kill_obsolete:
-                    to_destroy.append(m.name)
+        with self._db:
+            for m in self.resources.values():
+                if m.name in self.definitions:
+                    if m.obsolete:
+                        self.logger.log("resource ‘{0}’ is no longer obsolete".format(m.name))
+                        m.obsolete = False
+                else:
+                    self.logger.log("resource ‘{0}’ is obsolete".format(m.name))
+                    if not m.obsolete: m.obsolete = True
+                    if not should_do(m, include, exclude): continue
+                    if kill_obsolete:
+                        to_destroy.append(m.name)
 
         if to_destroy:
             self._destroy_resources(include=to_destroy)
@@ -900,18 +1411,26 @@ class Deployment(object):
                 include=[], exclude=[], check=False, kill_obsolete=False,
                 allow_reboot=False, allow_recreate=False, force_reboot=False,
                 max_concurrent_copy=5, max_concurrent_activate=-1, sync=True,
-                always_activate=False, repair=False, dry_activate=False):
+                always_activate=False, repair=False, dry_activate=False,
+                max_concurrent_build=None, pipeline=False, peer_copy=False,
+                adaptive_copy=False, max_concurrent_create=64, fail_fast=False):
         """Perform the deployment defined by the deployment specification."""
 
+        if peer_copy and (pipeline or max_concurrent_build is not None):
+            raise Exception("copying closures between machines requires all machines to be built first")
+        if adaptive_copy and (peer_copy or pipeline or max_concurrent_build is not None):
+            raise Exception("adapting the number of concurrent copies requires copying all closures from this machine after building them")
+
         self.evaluate_active(include, exclude, kill_obsolete)
 
         # Assign each resource an index if it doesn't have one.
-        for r in self.active_resources.itervalues():
-            if r.index == None:
-                r.index = self._get_free_resource_index()
-                # FIXME: Logger should be able to do coloring without the need
-                #        for an index maybe?
-                r.logger.register_index(r.index)
+        with self._db:
+            for r in self.active_resources.itervalues():
+                if r.index == None:
+                    r.index = self._get_free_resource_index()
+                    # FIXME: Logger should be able to do coloring without the need
+                    #        for an index maybe?
+                    r.logger.register_index(r.index)
 
         self.logger.update_log_prefixes()
 
@@ -927,8 +1446,6 @@ class Deployment(object):
                 if r.get_type() != defn.get_type():
                     raise Exception("the type of resource ‘{0}’ changed from ‘{1}’ to ‘{2}’, which is currently unsupported"
                                     .format(r.name, r.get_type(), defn.get_type()))
-                r._created_event = threading.Event()
-                r._errored = False
 
 
             def plan_worker(r):
@@ -943,74 +1460,140 @@ class Deployment(object):
                     plan_worker(r)
                 return
 
+            durations = {}
+            durations_lock = threading.Lock()
+
             def worker(r):
-                try:
-                    if not should_do(r, include, exclude): return
-
-                    # Sleep until all dependencies of this resource have
-                    # been created.
-                    deps = r.create_after(self.active_resources.itervalues(), self.definitions[r.name])
-                    for dep in deps:
-                        dep._created_event.wait()
-                        # !!! Should we print a message here?
-                        if dep._errored:
-                            r._errored = True
-                            return
-
-                    # Now create the resource itself.
-                    if not r.creation_time:
-                        r.creation_time = int(time.time())
-                    r.create(self.definitions[r.name], check=check, allow_reboot=allow_reboot, allow_recreate=allow_recreate)
-
-                    if is_machine(r):
-                        # The first time the machine is created,
-                        # record the state version. We get it from
-                        # /etc/os-release, rather than from the
-                        # configuration's state.systemVersion
-                        # attribute, because the machine may have been
-                        # booted from an older NixOS image.
-                        if not r.state_version:
-                            os_release = r.run_command("cat /etc/os-release", capture_stdout=True)
-                            match = re.search('VERSION_ID="([0-9]+\.[0-9]+).*"', os_release)
-                            if match:
-                                r.state_version = match.group(1)
-                                r.log("setting state version to {0}".format(r.state_version))
-                            else:
-                                r.warn("cannot determine NixOS version")
-
-                        r.wait_for_ssh(check=check)
-                        r.generate_vpn_key()
-
-                except:
-                    r._errored = True
-                    raise
-                finally:
-                    r._created_event.set()
+                if not should_do(r, include, exclude): return
 
-            nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=worker)
+                new = not r.creation_time
+                start = time.time()
+
+                # Now create the resource itself.
+                if not r.creation_time:
+                    r.creation_time = int(time.time())
+                r.create(self.definitions[r.name], check=check, allow_reboot=allow_reboot, allow_recreate=allow_recreate)
+
+                if is_machine(r):
+                    # The first time the machine is created,
+                    # record the state version. We get it from
+                    # /etc/os-release, rather than from the
+                    # configuration's state.systemVersion
+                    # attribute, because the machine may have been
+                    # booted from an older NixOS image.
+                    if not r.state_version:
+                        os_release = r.run_command("cat /etc/os-release", capture_stdout=True)
+                        match = re.search('VERSION_ID="([0-9]+\.[0-9]+).*"', os_release)
+                        if match:
+                            r.state_version = match.group(1)
+                            r.log("setting state version to {0}".format(r.state_version))
+                        else:
+                            r.warn("cannot determine NixOS version")
+
+                    r.wait_for_ssh(check=check)
+                    r.generate_vpn_key()
+
+                if new:
+                    with durations_lock:
+                        durations.setdefault(r.get_type(), []).append(time.time() - start)
+
+            # Only resources whose dependencies have been created are
+            # handed to the workers; if creating a resource fails, the
+            # resources depending on it are skipped.
+            deps = {r.name: [dep.name for dep in r.create_after(self.active_resources.itervalues(), self.definitions[r.name])]
+                    for r in self.active_resources.itervalues() if should_do(r, include, exclude)}
+            # With ‘fail_fast’, the first failure stops the creation
+            # of the other resources as soon as they wait for something.
+            try:
+                self._run_resource_tasks(max_concurrent_create, self.active_resources.values(), deps, worker,
+                                         cost_fun=self._get_create_cost_fun(),
+                                         cancel=nixops.util.CancelToken() if fail_fast else None)
+            finally:
+                self._update_create_durations(durations)
 
         if create_only: return
 
         # Build the machine configurations.
         # Record configs_path in the state so that the ‘info’ command
         # can show whether machines have an outdated configuration.
-        self.configs_path = self.build_configs(dry_run=dry_run, repair=repair, include=include, exclude=exclude)
+        # If machines are built separately, the closure of each
+        # machine is copied as soon as it has been built and, when
+        # pipelining, activated as soon as it has been copied.  The
+        # copies and activations run in threads of their own, so they
+        # don't take up build slots.  Otherwise all closures are
+        # copied before any machine is activated.
+        # Each build instantiates the whole network, which takes a lot
+        # of memory for large networks, so don't run one per machine.
+        if pipeline and max_concurrent_build is None: max_concurrent_build = multiprocessing.cpu_count()
+        pipeline = pipeline and not copy_only
+        stages = []
+        activated = []
+        failed = []
+        if max_concurrent_build is not None and not (build_only or dry_run):
+            def nr_workers(n):
+                return n if n != -1 else max(len(self.active), 1)
+
+            def activate(m):
+                # The path of all configurations is only known once
+                # every machine has been built.
+                res = self._activate_config(m, None, allow_reboot, force_reboot,
+                                            sync, always_activate, dry_activate, check)
+                (failed if res else activated).append(m)
+            activations = nixops.parallel.Stage(nr_workers(max_concurrent_activate), activate) if pipeline else None
+
+            def copy(m):
+                if m.needs_closure_copy() and not self._is_unchanged(m, check):
+                    self._copy_closure(m)
+                if activations: activations.put(m)
+            copies = nixops.parallel.Stage(nr_workers(max_concurrent_copy), copy)
+
+            # Copies feed activations, so wait for them first.
+            stages = [copies] + ([activations] if activations else [])
+
+            # Each closure is pushed to the binary cache on its own,
+            # so refuse an unsigned cache before building anything.
+            if self.binary_cache: self._check_binary_cache()
+
+        try:
+            self.configs_path = self.build_configs(dry_run=dry_run, repair=repair, include=include, exclude=exclude,
+                                                   max_concurrent_build=max_concurrent_build,
+                                                   on_built=stages[0].put if stages else None)
+        finally:
+            # Finish copying to and activating the machines that have
+            # been built, even if others failed to build.
+            for stage in stages: stage.join()
+        for stage in stages: stage.check()
 
         if build_only or dry_run: return
 
         # Copy the closures of the machine configurations to the
         # target machines.
-        self.copy_closures(self.configs_path, include=include, exclude=exclude,
-                           max_concurrent_copy=max_concurrent_copy)
+        if stages:
+            self.logger.log(ansi_success("{0}> closures copied successfully".format(self.name or "unnamed"), outfile=self.logger._log_file))
+        else:
+            self.copy_closures(self.configs_path, include=include, exclude=exclude,
+                               max_concurrent_copy=max_concurrent_copy, peer_copy=peer_copy,
+                               adaptive_copy=adaptive_copy, check=check)
 
         if copy_only: return
 
         # Active the configurations.
-        self.activate_configs(self.configs_path, include=include,
-                              exclude=exclude, allow_reboot=allow_reboot,
-                              force_reboot=force_reboot, check=check,
-                              sync=sync, always_activate=always_activate,
-                              dry_activate=dry_activate, max_concurrent_activate=max_concurrent_activate)
+        if pipeline:
+            if not dry_activate:
+                with self._db:
+                    for m in activated:
+                        if m.cur_toplevel == m.new_toplevel:
+                            m.cur_configs_path = self.configs_path
+            if failed:
+                raise Exception("activation of {0} of {1} machines failed (namely on {2})"
+                                .format(len(failed), len(failed) + len(activated),
+                                        ", ".join(["‘{0}’".format(m.name) for m in failed])))
+        else:
+            self.activate_configs(self.configs_path, include=include,
+                                  exclude=exclude, allow_reboot=allow_reboot,
+                                  force_reboot=force_reboot, check=check,
+                                  sync=sync, always_activate=always_activate,
+                                  dry_activate=dry_activate, max_concurrent_activate=max_concurrent_activate)
 
         if dry_activate: return
 
@@ -1022,7 +1605,7 @@ class Deployment(object):
             # Now create the resource itself.
             r.after_activation(self.definitions[r.name])
 
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=cleanup_worker)
+        self._run_resource_tasks(max_concurrent_create, self.active_resources.values(), {}, cleanup_worker)
         self.logger.log(ansi_success("{0}> deployment finished successfully".format(self.name or "unnamed"), outfile=self.logger._log_file))
 
 
@@ -1088,7 +1671,7 @@ class Deployment(object):
                 if not m.obsolete: m.obsolete = True
 
         self.copy_closures(self.configs_path, include=include, exclude=exclude,
-                           max_concurrent_copy=max_concurrent_copy)
+                           max_concurrent_copy=max_concurrent_copy, check=check)
 
         self.activate_configs(self.configs_path, include=include,
                               exclude=exclude, allow_reboot=allow_reboot,
@@ -1102,43 +1685,69 @@ class Deployment(object):
             self._rollback(**kwargs)
 
 
-    def _destroy_resources(self, include=[], exclude=[], wipe=False):
+    def _run_resource_tasks(self, nr_workers, resources, deps, worker, cost_fun=None, cancel=None):
+        """Run ‘worker’ on ‘resources’ in the order given by ‘deps’,
+        using at most ‘nr_workers’ threads and respecting the
+        ‘max_concurrent_create’ limit of each resource type."""
+        limits = {r.get_type(): r.max_concurrent_create for r in resources
+                  if r.max_concurrent_create is not None}
+        nixops.parallel.run_dag(nr_workers=nr_workers, tasks=resources, deps=deps, worker_fun=worker,
+                                group_fun=lambda r: r.get_type(), group_limits=limits, cost_fun=cost_fun,
+                                cancel=cancel)
+
+
+    def _get_create_cost_fun(self):
+        """Return a function estimating how long it takes to create a
+        resource, based on the recorded durations of its type.  Types
+        without a recorded duration get the average of the others."""
+        known = self.create_durations
+        default = sum(known.values()) / len(known) if known else 1.0
+        return lambda r: known.get(r.get_type(), default)
+
+
+    def _update_create_durations(self, durations):
+        """Fold the creation times in ‘durations’, a dictionary mapping
+        resource types to lists of durations, into the averages recorded
+        in the state file."""
+        if not durations: return
+        known = self.create_durations
+        for (type, samples) in durations.iteritems():
+            average = sum(samples) / len(samples)
+            known[type] = (known[type] + average) / 2 if type in known else average
+        with self._db:
+            self.create_durations = known
+
 
+    def _destroy_resources(self, include=[], exclude=[], wipe=False, max_concurrent_destroy=64):
+
+        deps = {}
         for r in self.resources.itervalues():
-            r._destroyed_event = threading.Event()
-            r._errored = False
             for rev_dep in r.destroy_before(self.resources.itervalues()):
-                try:
-                    rev_dep._wait_for.append(r)
-                except AttributeError:
-                    rev_dep._wait_for = [ r ]
+                deps.setdefault(rev_dep.name, []).append(r.name)
 
         def worker(m):
-            try:
-                if not should_do(m, include, exclude): return
+            if not should_do(m, include, exclude): return
+            # Look up the SSH master while the machine still knows its
+            # address, so that it can be shut down once it's gone.
+            master = None
+            if is_machine(m):
                 try:
-                    for dep in m._wait_for:
-                        dep._destroyed_event.wait()
-                        # !!! Should we print a message here?
-                        if dep._errored:
-                            m._errored = True
-                            return
-                except AttributeError:
+                    master = m.ssh.find_master()
+                except Exception:
                     pass
-                if m.destroy(wipe=wipe): self.delete_resource(m)
-            except:
-                m._errored = True
-                raise
-            finally:
-                m._destroyed_event.set()
+            if m.destroy(wipe=wipe):
+                if master: master.shutdown()
+                if is_machine(m): m.ssh.reset()
+                self.delete_resource(m)
 
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.resources.values(), worker_fun=worker)
+        self._run_resource_tasks(max_concurrent_destroy, self.resources.values(), deps, worker)
 
-    def destroy_resources(self, include=[], exclude=[], wipe=False):
+    def destroy_resources(self, include=[], exclude=[], wipe=False, max_concurrent_destroy=64):
         """Destroy all active and obsolete resources."""
 
         with self._get_deployment_lock():
-            self.run_with_notify('destroy', lambda: self._destroy_resources(include, exclude, wipe))
+            self.run_with_notify('destroy', lambda: self._destroy_resources(include, exclude, wipe,
+                                                                           max_concurrent_destroy))
 
         # Remove the destroyed machines from the rollback profile.
         # This way, a subsequent "nix-env --delete-generations old" or
@@ -1224,6 +1833,13 @@ class Deployment(object):
         nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
 
 
+def _has_keys(info):
+    """Whether the evaluation result ‘info’ contains the text of a
+    machine's ‘deployment.keys’."""
+    machines = info.get("machines") if isinstance(info, dict) else None
+    return any(cfg.get("keys") for cfg in (machines or {}).itervalues())
+
+
 def should_do(m, include, exclude):
     return should_do_n(m.name, include, exclude)
 
@@ -1243,8 +1859,12 @@ def _subclasses(cls):
     sub = cls.__subclasses__()
     return [cls] if not sub else [g for s in sub for g in _subclasses(s)]
 
-def _create_definition(xml, config, type_name):
-    """Create a resource definition object from the given XML representation of the machine's attributes."""
+def _create_definition(name, config, type_name):
+    """Create a resource definition object from the evaluated attributes of a resource."""
+
+    # Definitions that still parse the XML output of nix-instantiate
+    # get it built on demand from the configuration.
+    xml = nixops.util.LazyXMLExpr(name, config)
 
     for cls in _subclasses(nixops.resources.ResourceDefinition):
         if type_name == cls.get_resource_type():
@@ -1256,6 +1876,35 @@ def _create_definition(xml, config, type_name):
 
     raise nixops.deployment.UnknownBackend("unknown resource type ‘{0}’".format(type_name))
 
+def _update_attrs_cache(cache, attrs):
+    """Apply attribute updates to a cached attribute map.
+
+    The cache holds values as SQLite returns them from the text-typed
+    value columns.  Returns False if a value cannot be represented
+    that way, in which case the cache must be dropped.
+    """
+    for n, v in attrs.iteritems():
+        if v == None:
+            cache.pop(n, None)
+        elif isinstance(v, unicode):
+            cache[n] = v
+        elif isinstance(v, str):
+            try:
+                cache[n] = v.decode('utf-8')
+            except UnicodeDecodeError:
+                return False
+        elif isinstance(v, bool):
+            cache[n] = u"1" if v else u"0"
+        elif isinstance(v, (int, long)):
+            cache[n] = unicode(v)
+        else:
+            return False
+    return True
+
+def _state_types(cls=nixops.resources.ResourceState):
+    """Return the type names of the resource state classes derived from ‘cls’."""
+    return set(c.get_type() for c in _subclasses(cls))
+
 def _create_state(depl, type, name, id):
     """Create a resource state object of the desired type."""
 
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of the results of evaluating deployment specifications.
+
+import os
+import json
+import errno
+import hashlib
+import shutil
+import tempfile
+
+
+# Bump this when the meaning of cached values changes.
+cache_version = 1
+
+# Don't bother fingerprinting trees larger than this; evaluating them
+# is cheap compared to their size anyway.
+max_files = 100000
+
+
+def get_default_cache_dir():
+    return os.environ.get("NIXOPS_EVAL_CACHE", os.environ.get("HOME", "") + "/.nixops/eval-cache")
+
+
+class TooManyFiles(Exception):
+    pass
+
+
+def _hash_path(h, path, exclude, counter):
+    """Add the location, size and modification time of ‘path’ and, if
+    it is a directory, of all files below it except those in ‘exclude’
+    to the hash ‘h’."""
+    if isinstance(path, unicode): path = path.encode("utf-8")
+    real = os.path.realpath(path)
+    h.update("{0}\0{1}\0".format(path, real))
+    # Store paths are immutable, so their name says it all.
+    if real.startswith("/nix/store/"): return
+    try:
+        st = os.stat(real)
+    except OSError:
+        h.update("-\0")
+        return
+    if not os.path.isdir(real):
+        h.update("{0} {1}\0".format(st.st_size, st.st_mtime))
+        return
+    for root, dirs, files in os.walk(real):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and os.path.join(root, d) not in exclude)
+        for f in sorted(files):
+            counter[0] += 1
+            if counter[0] > max_files:
+                raise TooManyFiles()
+            p = os.path.join(root, f)
+            if p in exclude: continue
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            target = os.path.realpath(p) if os.path.islink(p) else ""
+            h.update("{0}\0{1}\0{2} {3}\0".format(p, target, st.st_size, st.st_mtime))
+
+
+def fingerprint(values, paths, exclude=[]):
+    """Return a hash of the JSON-serialisable ‘values’ and of the
+    current state of the files and directories in ‘paths’, or None if
+    the latter are too large to fingerprint.  Files and directories in
+    ‘exclude’, such as the state file, are ignored."""
+    h = hashlib.sha256()
+    h.update(json.dumps([cache_version, values], sort_keys=True))
+    exclude = set(os.path.realpath(p) for p in exclude)
+    counter = [0]
+    try:
+        for path in sorted(set(paths)):
+            _hash_path(h, path, exclude, counter)
+    except TooManyFiles:
+        return None
+    return h.hexdigest()
+
+
+class EvalCache(object):
+    """Directory holding one evaluation result per deployment and
+    attribute, together with the fingerprint of the inputs it was
+    computed from.  Since evaluation results may contain secrets, the
+    directory and its files are only accessible to the user."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _path(self, uuid, attr):
+        return os.path.join(self.cache_dir, "{0}-{1}.json".format(uuid, attr))
+
+    def get(self, uuid, attr, key):
+        """Return the cached value of ‘attr’ if it was stored with
+        fingerprint ‘key’, and None otherwise."""
+        try:
+            with open(self._path(uuid, attr)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if entry.get("key") != key: return None
+        return entry.get("value")
+
+    def _make_cache_dir(self):
+        try:
+            os.makedirs(self.cache_dir, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+
+    def put(self, uuid, attr, key, value):
+        self._make_cache_dir()
+        (fd, tmp) = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"key": key, "value": value}, f)
+            os.rename(tmp, self._path(uuid, attr))
+        except:
+            os.remove(tmp)
+            raise
+
+    def get_private_dir(self, uuid, name):
+        """Return a directory for files that a deployment keeps across
+        runs, creating it if necessary.  Like the cache, it is only
+        accessible to the user."""
+        self._make_cache_dir()
+        path = os.path.join(self.cache_dir, "{0}-{1}".format(uuid, name))
+        try:
+            os.mkdir(path, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+        os.chmod(path, 0700)
+        return path
+
+    def remove(self, uuid):
+        """Remove all cached values and files of a deployment."""
+        if not os.path.isdir(self.cache_dir): return
+        for f in os.listdir(self.cache_dir):
+            if f.startswith(uuid + "-"):
+                path = os.path.join(self.cache_dir, f)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
@@ -1,9 +1,9 @@
 import re
-import string
 
+from StringIO import StringIO
 from textwrap import dedent
 
-__all__ = ['py2nix', 'nix2py', 'nixmerge', 'expand_dict',
+__all__ = ['py2nix', 'nix2py', 'nixmerge', 'nixmerge_into', 'expand_dict',
            'RawValue', 'Function']
 
 
@@ -20,6 +20,9 @@ class RawValue(object):
     def indent(self, level=0, inline=False, maxwidth=80):
         return "  " * level + self.value
 
+    def write(self, out, level=0, inline=False, maxwidth=80):
+        out.write("  " * level + self.value)
+
     def __repr__(self):
         return self.value
 
@@ -40,6 +43,9 @@ class MultiLineRawValue(RawValue):
     def indent(self, level=0, inline=False, maxwidth=80):
         return '\n'.join(["  " * level + value for value in self.values])
 
+    def write(self, out, level=0, inline=False, maxwidth=80):
+        out.write(self.indent(level, inline, maxwidth))
+
 
 class Function(object):
     def __init__(self, head, body):
@@ -75,38 +81,55 @@ class Container(object):
         self.children = children
         self.suffix = suffix
         self.inline_variant = inline_variant
+        # Containers aren't modified after construction, so these are
+        # computed once instead of at every level of nesting.
+        self._min_length = None
+        self._inlineable = None
 
     def get_min_length(self):
         """
         Return the minimum length of this container and all sub-containers.
         """
-        return (len(self.prefix) + len(self.suffix) + 1 + len(self.children) +
+        if self._min_length is None:
+            self._min_length = (
+                len(self.prefix) + len(self.suffix) + 1 + len(self.children) +
                 sum([child.get_min_length() for child in self.children]))
+        return self._min_length
 
     def is_inlineable(self):
-        return all([child.is_inlineable() for child in self.children])
+        if self._inlineable is None:
+            self._inlineable = all([child.is_inlineable()
+                                    for child in self.children])
+        return self._inlineable
 
     def indent(self, level=0, inline=False, maxwidth=80):
+        out = StringIO()
+        self.write(out, level, inline, maxwidth)
+        return out.getvalue()
+
+    def write(self, out, level=0, inline=False, maxwidth=80):
         if not self.is_inlineable():
             inline = False
         elif level * 2 + self.get_min_length() < maxwidth:
             inline = True
         ind = "  " * level
         if inline and self.inline_variant is not None:
-            return self.inline_variant.indent(level=level, inline=True,
-                                              maxwidth=maxwidth)
+            self.inline_variant.write(out, level=level, inline=True,
+                                      maxwidth=maxwidth)
         elif inline:
-            sep = ' '
-            lines = ' '.join([child.indent(level=0, inline=True)
-                              for child in self.children])
-            suffix_ind = ""
+            out.write(ind + self.prefix + ' ')
+            for n, child in enumerate(self.children):
+                if n > 0:
+                    out.write(' ')
+                child.write(out, level=0, inline=True)
+            out.write(' ' + self.suffix)
         else:
-            sep = '\n'
-            lines = '\n'.join([child.indent(level + 1, inline=inline,
-                                            maxwidth=maxwidth)
-                               for child in self.children])
-            suffix_ind = ind
-        return ind + self.prefix + sep + lines + sep + suffix_ind + self.suffix
+            out.write(ind + self.prefix + '\n')
+            for n, child in enumerate(self.children):
+                if n > 0:
+                    out.write('\n')
+                child.write(out, level + 1, inline=inline, maxwidth=maxwidth)
+            out.write('\n' + ind + self.suffix)
 
 
 def enclose_node(node, prefix="", suffix=""):
@@ -126,12 +149,34 @@ def enclose_node(node, prefix="", suffix=""):
                          node.suffix + suffix, new_inline)
 
 
-def _fold_string(value, rules):
-    folder = lambda val, rule: val.replace(rule[0], rule[1])
-    return reduce(folder, rules, value)
+def _make_escaper(rules):
+    """
+    Return a function applying the given (search, replacement) rules to a
+    string in a single pass, rather than one pass per rule.
+    """
+    replacements = dict(rules)
+    regex = re.compile('|'.join([re.escape(search) for search, _ in rules]))
+    return lambda value: regex.sub(lambda m: replacements[m.group(0)], value)
+
+
+_escape_str = _make_escaper([
+    ("\\", "\\\\"),
+    ("${", "\\${"),
+    ('"', '\\"'),
+    ("\n", "\\n"),
+    ("\t", "\\t"),
+])
+
+_escape_multiline_str = _make_escaper([
+    ("''", "'''"),
+    ("${", "''${"),
+    ("\t", "'\\t"),
+])
+
+_identifier = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
 
 
-def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
+def py2nix(value, initial_indentation=0, maxwidth=80, inline=False, out=None):
     """
     Return the given value as a Nix expression string.
 
@@ -139,7 +184,8 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
     inline fewer than that. Also, 'maxwidth' specifies the maximum line width
     which is enforced whenever it is possible to break an expression. Set to 0
     if you want to break on every occasion possible. If 'inline' is set to
-    True, squash everything into a single line.
+    True, squash everything into a single line. If 'out' is a file object, the
+    expression is written to it instead of being returned.
     """
     def _enc_int(node):
         if node < 0:
@@ -148,13 +194,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
             return RawValue(str(node))
 
     def _enc_str(node, for_attribute=False):
-        encoded = _fold_string(node, [
-            ("\\", "\\\\"),
-            ("${", "\\${"),
-            ('"', '\\"'),
-            ("\n", "\\n"),
-            ("\t", "\\t"),
-        ])
+        encoded = _escape_str(node)
 
         inline_variant = RawValue(u'"{0}"'.format(encoded))
 
@@ -162,11 +202,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
             return inline_variant.value
 
         if node.endswith("\n"):
-            encoded = _fold_string(node[:-1], [
-                ("''", "'''"),
-                ("${", "''${"),
-                ("\t", "'\\t"),
-            ])
+            encoded = _escape_multiline_str(node[:-1])
 
             atoms = [RawValue(line) for line in encoded.splitlines()]
             return Container("''", atoms, "''", inline_variant=inline_variant)
@@ -188,8 +224,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
         elif len(key) == 0:
             raise KeyError("key name has zero length")
 
-        if all(char in string.letters + string.digits + '_'
-               for char in key) and not key[0].isdigit():
+        if _identifier.match(key):
             return key
         else:
             return _enc_str(key, for_attribute=True)
@@ -208,7 +243,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
                 child_key, child_value = child_value.items()[0]
                 encoded_key += "." + _enc_key(child_key)
 
-            contents = _enc(child_value)
+            contents = _enc(child_value, expanded=True)
             prefix = "{0} = ".format(encoded_key)
             suffix = ";"
 
@@ -222,7 +257,7 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
     def _enc_call(node):
         return Container("(", [_enc(node.fun), _enc(node.arg)], ")")
 
-    def _enc(node, inlist=False):
+    def _enc(node, inlist=False, expanded=False):
         if isinstance(node, RawValue):
             if inlist and (isinstance(node, MultiLineRawValue) or
                            any(char.isspace() for char in node.value)):
@@ -242,7 +277,8 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
         elif isinstance(node, list):
             return _enc_list(node)
         elif isinstance(node, dict):
-            return _enc_attrset(expand_dict(node))
+            # expand_dict() already expanded the values of its result.
+            return _enc_attrset(node if expanded else expand_dict(node))
         elif isinstance(node, Function):
             if inlist:
                 return enclose_node(_enc_function(node), "(", ")")
@@ -256,8 +292,11 @@ def py2nix(value, initial_indentation=0, maxwidth=80, inline=False):
         else:
             raise ValueError("unable to encode {0}".format(repr(node)))
 
-    return _enc(value).indent(initial_indentation, maxwidth=maxwidth,
-                              inline=inline)
+    if out is None:
+        return _enc(value).indent(initial_indentation, maxwidth=maxwidth,
+                                  inline=inline)
+    _enc(value).write(out, initial_indentation, maxwidth=maxwidth,
+                      inline=inline)
 
 
 def expand_dict(unexpanded):
@@ -287,8 +326,15 @@ def expand_dict(unexpanded):
         else:
             strings[key] = val
 
+    if paths:
+        merged = {}
+        for expr in paths + [strings]:
+            nixmerge_into(merged, expr)
+    else:
+        merged = strings
+
     return {key: (expand_dict(val) if isinstance(val, dict) else val)
-            for key, val in reduce(nixmerge, paths + [strings]).iteritems()}
+            for key, val in merged.iteritems()}
 
 
 def nixmerge(expr1, expr2):
@@ -319,6 +365,38 @@ def nixmerge(expr1, expr2):
     return _merge(expr1, expr2)
 
 
+def nixmerge_into(dest, expr):
+    """
+    Merge the dictionary expr into the dictionary dest in place, like
+    nixmerge(), and return dest.  Unlike repeated nixmerge() calls, merging
+    n expressions this way takes time linear in their total size.  Values
+    taken from expr are copied, so merging into dest later on doesn't
+    modify them.
+    """
+    def _copy(e):
+        if isinstance(e, dict):
+            return nixmerge_into({}, e)
+        elif isinstance(e, list):
+            return list(e)
+        return e
+
+    for key, value in expr.iteritems():
+        if key not in dest:
+            dest[key] = _copy(value)
+        elif isinstance(dest[key], dict) and isinstance(value, dict):
+            nixmerge_into(dest[key], value)
+        elif isinstance(dest[key], list) and isinstance(value, list):
+            present = set(dest[key])
+            for e in value:
+                if e not in present:
+                    dest[key].append(e)
+                    present.add(e)
+        else:
+            err = "unable to merge {0} with {1}".format(type(dest[key]), type(value))
+            raise ValueError(err)
+    return dest
+
+
 def nix2py(source):
     """
     Dedent the given Nix source code and encode it into multiple raw values
@@ -1,9 +1,13 @@
 import threading
 import sys
+import time
+import heapq
 import Queue
 import random
 import traceback
 
+import nixops.util
+
 class MultipleExceptions(Exception):
     def __init__(self, exceptions={}):
         self.exceptions = exceptions
@@ -20,7 +24,13 @@ class MultipleExceptions(Exception):
             traceback.print_exception(e[0], e[1], e[2])
 
 
-def run_tasks(nr_workers, tasks, worker_fun):
+def run_tasks(nr_workers, tasks, worker_fun, cancel=None):
+    """Call 'worker_fun' on each of 'tasks' using at most 'nr_workers'
+    threads, and return the results.  If a nixops.util.CancelToken
+    'cancel' is given, it is cancelled as soon as a task fails, so that
+    tasks that haven't started are skipped and running tasks give up
+    when they next wait.  Otherwise the worker threads inherit the
+    token of the calling thread, if any."""
     task_queue = Queue.Queue()
     result_queue = Queue.Queue()
 
@@ -32,7 +42,10 @@ def run_tasks(nr_workers, tasks, worker_fun):
     if nr_workers == -1: nr_workers = nr_tasks
     if nr_workers < 1: raise Exception("number of worker threads must be at least 1")
 
+    token = cancel or nixops.util.get_cancel_token()
+
     def thread_fun():
+        nixops.util.set_cancel_token(token)
         n = 0
         while True:
             try:
@@ -41,6 +54,7 @@ def run_tasks(nr_workers, tasks, worker_fun):
                 break
             n = n + 1
             try:
+                if token: token.check()
                 result_queue.put((worker_fun(t), None, t.name))
             except Exception as e:
                 result_queue.put((None, sys.exc_info(), t.name))
@@ -55,20 +69,112 @@ def run_tasks(nr_workers, tasks, worker_fun):
 
     results = []
     exceptions = {}
-    while len(results) < nr_tasks:
-        try:
-            # Use a timeout to allow keyboard interrupts to be
-            # processed.  The actual timeout value doesn't matter.
-            (res, excinfo, name) = result_queue.get(True, 1000)
-        except Queue.Empty:
-            continue
-        if excinfo:
-            exceptions[name]=excinfo
-        results.append(res)
+    cancelled = {}
+    with _cancel_on_interrupt(token):
+        while len(results) < nr_tasks:
+            try:
+                # Use a timeout to allow keyboard interrupts to be
+                # processed.  The actual timeout value doesn't matter.
+                (res, excinfo, name) = result_queue.get(True, 1000)
+            except Queue.Empty:
+                continue
+            if excinfo:
+                _record_failure(name, excinfo, token, cancel, exceptions, cancelled)
+            results.append(res)
 
     for thr in threads:
         thr.join()
 
+    _raise_exceptions(exceptions or cancelled)
+
+    return results
+
+
+class Stage(object):
+    """A step that tasks go through as soon as an earlier step has
+    finished with them, e.g. copying the closure of each machine once
+    it has been built.  'worker_fun' is called on each task passed to
+    put() using at most 'nr_workers' threads, which are started as
+    tasks arrive.  Call join() after the last put() to wait for the
+    remaining tasks, and check() to raise their failures as in
+    run_tasks.  'cancel' is handled as in run_tasks."""
+
+    def __init__(self, nr_workers, worker_fun, cancel=None):
+        if nr_workers < 1: raise Exception("number of worker threads must be at least 1")
+        self.nr_workers = nr_workers
+        self.worker_fun = worker_fun
+        self.cancel = cancel
+        self.token = cancel or nixops.util.get_cancel_token()
+        self._task_queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._exceptions = {}
+        self._cancelled = {}
+
+    def put(self, task):
+        with self._lock:
+            if len(self._threads) < self.nr_workers:
+                thr = threading.Thread(target=self._thread_fun)
+                thr.daemon = True
+                thr.start()
+                self._threads.append(thr)
+        self._task_queue.put(task)
+
+    def _thread_fun(self):
+        nixops.util.set_cancel_token(self.token)
+        while True:
+            t = self._task_queue.get()
+            if t is None: break
+            try:
+                if self.token: self.token.check()
+                self.worker_fun(t)
+            except Exception as e:
+                with self._lock:
+                    _record_failure(t.name, sys.exc_info(), self.token, self.cancel,
+                                    self._exceptions, self._cancelled)
+
+    def join(self):
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        for thr in threads: self._task_queue.put(None)
+        with _cancel_on_interrupt(self.token):
+            for thr in threads:
+                # Use a timeout to allow keyboard interrupts to be
+                # processed.  The actual timeout value doesn't matter.
+                while thr.is_alive(): thr.join(1000)
+
+    def check(self):
+        _raise_exceptions(self._exceptions or self._cancelled)
+
+
+class _cancel_on_interrupt(object):
+    """Cancel 'token' if the calling thread is interrupted, so that
+    the worker threads stop as well."""
+
+    def __init__(self, token):
+        self.token = token
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        if self.token and exception_type is KeyboardInterrupt:
+            self.token.cancel("interrupted")
+
+
+def _record_failure(name, excinfo, token, cancel, exceptions, cancelled):
+    """Record that task 'name' raised 'excinfo'.  Tasks that gave up
+    because the operation was cancelled are recorded separately, and
+    only reported if no task failed by itself."""
+    if token and token.cancelled and issubclass(excinfo[0], nixops.util.Cancelled):
+        cancelled[name] = excinfo
+    else:
+        exceptions[name] = excinfo
+        if cancel: cancel.cancel("cancelled because {0} failed".format(name))
+
+
+def _raise_exceptions(exceptions):
     if len(exceptions.keys()) == 1:
         excinfo = exceptions[exceptions.keys()[0]]
         raise excinfo[0], excinfo[1], excinfo[2]
@@ -76,4 +182,197 @@ def run_tasks(nr_workers, tasks, worker_fun):
     if len(exceptions.keys()) > 1:
         raise MultipleExceptions(exceptions)
 
+
+def run_dag(nr_workers, tasks, deps, worker_fun, group_fun=None, group_limits={}, cost_fun=None,
+            cancel=None):
+    """Like run_tasks, but 'deps' maps the name of a task to the names
+    of the tasks that must have finished before it can start.  Only
+    tasks whose dependencies have finished are handed to the at most
+    'nr_workers' threads, and at most 'group_limits[g]' tasks 't' with
+    'group_fun(t) == g' run at once.  Ready tasks that start the
+    longest chain of dependent tasks go first, where the length of a
+    chain is the sum of 'cost_fun(t)' (by default 1) over its tasks.
+    Tasks that depend on a failed task are skipped.  'cancel' is
+    handled as in run_tasks."""
+    tasks = list(tasks)
+    if not tasks: return []
+
+    if nr_workers == -1: nr_workers = len(tasks)
+    if nr_workers < 1: raise Exception("number of worker threads must be at least 1")
+    for (group, limit) in group_limits.iteritems():
+        if limit < 1: raise Exception("concurrency limit of '{0}' must be at least 1".format(group))
+
+    by_name = {t.name: t for t in tasks}
+    nr_deps = {}
+    dependents = {name: [] for name in by_name}
+    for name in by_name:
+        ds = set(d for d in deps.get(name, []) if d in by_name and d != name)
+        nr_deps[name] = len(ds)
+        for d in ds: dependents[d].append(name)
+
+    # Topologically sort the tasks to detect cycles and to compute the
+    # length of the longest chain starting at each task.
+    order = [name for name in by_name if nr_deps[name] == 0]
+    left = dict(nr_deps)
+    for name in order:
+        for d in dependents[name]:
+            left[d] -= 1
+            if left[d] == 0: order.append(d)
+    if len(order) < len(tasks):
+        raise Exception("dependency cycle between {0}"
+                        .format(", ".join(sorted("'{0}'".format(n) for n in by_name if left[n] > 0))))
+    priority = {}
+    for name in reversed(order):
+        cost = cost_fun(by_name[name]) if cost_fun else 1
+        priority[name] = cost + max([priority[d] for d in dependents[name]] or [0])
+
+    task_queue = Queue.Queue()
+    result_queue = Queue.Queue()
+
+    token = cancel or nixops.util.get_cancel_token()
+
+    def thread_fun():
+        nixops.util.set_cancel_token(token)
+        while True:
+            t = task_queue.get()
+            if t is None: break
+            try:
+                if token: token.check()
+                result_queue.put((worker_fun(t), None, t.name))
+            except Exception as e:
+                result_queue.put((None, sys.exc_info(), t.name))
+
+    threads = []
+    for n in range(min(nr_workers, len(tasks))):
+        thr = threading.Thread(target=thread_fun)
+        thr.daemon = True
+        thr.start()
+        threads.append(thr)
+
+    ready = []
+    position = {name: i for (i, name) in enumerate(order)}
+    def make_ready(name):
+        heapq.heappush(ready, (-priority[name], position[name], name))
+    for name in order:
+        if nr_deps[name] == 0: make_ready(name)
+
+    running = {}
+    skipped = set()
+    results = []
+    exceptions = {}
+    cancelled = {}
+    nr_done = 0
+
+    def skip_dependents(name):
+        n = 0
+        for d in dependents[name]:
+            if d in skipped: continue
+            skipped.add(d)
+            n += 1 + skip_dependents(d)
+        return n
+
+    try:
+        with _cancel_on_interrupt(token):
+            while nr_done < len(tasks):
+                # Start as many ready tasks as the limits allow.
+                deferred = []
+                while ready and len(running) < nr_workers:
+                    item = heapq.heappop(ready)
+                    t = by_name[item[2]]
+                    group = group_fun(t) if group_fun else None
+                    limit = group_limits.get(group)
+                    if limit is not None and running.values().count(group) >= limit:
+                        deferred.append(item)
+                        continue
+                    running[t.name] = group
+                    task_queue.put(t)
+                for item in deferred: heapq.heappush(ready, item)
+
+                try:
+                    # Use a timeout to allow keyboard interrupts to be
+                    # processed.  The actual timeout value doesn't matter.
+                    (res, excinfo, name) = result_queue.get(True, 1000)
+                except Queue.Empty:
+                    continue
+                del running[name]
+                nr_done += 1
+                if excinfo:
+                    _record_failure(name, excinfo, token, cancel, exceptions, cancelled)
+                    nr_done += skip_dependents(name)
+                else:
+                    results.append(res)
+                    for d in dependents[name]:
+                        nr_deps[d] -= 1
+                        if nr_deps[d] == 0 and d not in skipped: make_ready(d)
+    finally:
+        for thr in threads: task_queue.put(None)
+
+    for thr in threads:
+        thr.join()
+
+    _raise_exceptions(exceptions or cancelled)
+
     return results
+
+
+class AdaptiveLimit(object):
+    """A limit on the number of tasks that run at once, which adapts to
+    the throughput they achieve together, somewhat like TCP congestion
+    control.  After every round of as many tasks as the limit allows,
+    the limit doubles (at first) or grows by one while throughput keeps
+    rising by more than 10%, shrinks by a quarter when it falls by more
+    than 10%, and stays the same otherwise.  It never leaves the range
+    from 'minimum' to 'maximum'."""
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = minimum
+        self.history = [minimum]
+        self.total_bytes = 0
+        self._slow_start = True
+        self._active = 0
+        self._cond = threading.Condition()
+        self._last_throughput = None
+        self._start_round(time.time())
+
+    def _start_round(self, now):
+        self._round_start = now
+        self._round_bytes = 0
+        self._round_tasks = 0
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait(1000)
+            self._active += 1
+
+    def release(self, nr_bytes):
+        """Record that a task has finished after processing 'nr_bytes'
+        bytes, and let another one start."""
+        with self._cond:
+            self._active -= 1
+            self.total_bytes += nr_bytes
+            self._round_bytes += nr_bytes
+            self._round_tasks += 1
+            if self._round_tasks >= self.limit:
+                self._adjust(time.time())
+            self._cond.notify_all()
+
+    def _adjust(self, now):
+        throughput = self._round_bytes / max(now - self._round_start, 0.001)
+        last = self._last_throughput
+        if last is None or throughput > last * 1.1:
+            limit = self.limit * 2 if self._slow_start else self.limit + 1
+        elif throughput < last * 0.9:
+            self._slow_start = False
+            limit = self.limit - max(self.limit // 4, 1)
+        else:
+            self._slow_start = False
+            limit = self.limit
+        limit = max(self.minimum, min(self.maximum, limit))
+        if limit != self.limit:
+            self.limit = limit
+            self.history.append(limit)
+        self._last_throughput = throughput
+        self._start_round(now)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Copying closures to many machines at once.  Besides the copies from
+# the local machine, machines that already have their closure copy the
+# store paths they share with their peers to them, so the number of
+# machines that can serve copies roughly doubles with every round.
+
+import sys
+import threading
+import traceback
+
+import nixops.ssh_util
+from nixops.closures import get_closure
+from nixops.parallel import MultipleExceptions
+
+
+def _can_serve(peer, m):
+    """Whether machine ‘peer’ can copy store paths directly to ‘m’."""
+    scope = m.peer_scope()
+    return scope is not None and peer.peer_scope() == scope and bool(peer.address_to(m))
+
+
+def copy_closures(machines, max_concurrent_copy, logger, plan=None):
+    """Copy the closure of ‘m.new_toplevel’ to every machine ‘m’ in
+    ‘machines’, running at most ‘max_concurrent_copy’ copies from the
+    local machine at once.  Machines that have received their closure
+    copy the paths they share with machines in the same peer scope
+    to them; the remaining paths are copied from the local machine.
+    If a nixops.closures.CopyPlan is given, only the paths it lists as
+    missing are copied from peers."""
+    machines = list(machines)
+    if not machines: return
+    if max_concurrent_copy == -1: max_concurrent_copy = len(machines)
+
+    if plan:
+        closures = plan.closures
+    else:
+        closures = {}
+        for m in machines:
+            if m.new_toplevel not in closures:
+                closures[m.new_toplevel] = get_closure(m.new_toplevel)
+
+    # Machines using a password or the user's own SSH agent can't log
+    # in to their peers, and peers can't authenticate machines whose
+    # host key is unknown.
+    eligible = set(m.name for m in machines
+                   if m.get_ssh_private_key_file() and m.get_ssh_password() is None
+                   and m.public_host_key)
+
+    cond = threading.Condition()
+    pending = list(machines)  # need their closure
+    partial = []              # got the shared paths from a peer, need the rest
+    sources = []              # have their closure and aren't copying to a peer
+    exceptions = {}
+    counts = {'local': 0, 'running': 0, 'peer_copies': 0}
+
+    def start(fun, *args):
+        def thread_fun():
+            try:
+                fun(*args)
+            finally:
+                with cond:
+                    counts['running'] -= 1
+                    cond.notify()
+        counts['running'] += 1
+        thr = threading.Thread(target=thread_fun)
+        thr.daemon = True
+        thr.start()
+
+    def copy_local(m):
+        try:
+            m.logger.log("copying closure...")
+            m.copy_closure_to(m.new_toplevel, plan.missing[m.name] if plan else None)
+        except Exception:
+            with cond:
+                exceptions[m.name] = sys.exc_info()
+                counts['local'] -= 1
+            return
+        with cond:
+            counts['local'] -= 1
+            if m.name in eligible: sources.append(m)
+
+    def copy_from_peer(peer, m, paths):
+        # The agent forwarded to the peer holds only the key of ‘m’.
+        agent = None
+        try:
+            agent = nixops.ssh_util.SSHAgent()
+            agent.add_key(m.get_ssh_private_key_file())
+            m.logger.log("copying {0} store paths from ‘{1}’...".format(len(paths), peer.name))
+            m.copy_closure_from_peer(peer, sorted(paths), agent)
+            ok = True
+        except Exception:
+            m.logger.warn("copying from ‘{0}’ failed; copying from the local machine instead".format(peer.name))
+            m.logger.log(traceback.format_exc())
+            ok = False
+        finally:
+            if agent: agent.shutdown()
+        with cond:
+            sources.append(peer)
+            partial.append(m)
+            if ok: counts['peer_copies'] += 1
+
+    def find_peer(m):
+        if m.name not in eligible: return (None, None)
+        closure = plan.missing[m.name] if plan else closures[m.new_toplevel]
+        for peer in sources:
+            if not _can_serve(peer, m): continue
+            shared = closures[peer.new_toplevel] & closure
+            if shared: return (peer, shared)
+        return (None, None)
+
+    with cond:
+        while pending or partial or counts['running']:
+            # Let idle machines serve their peers.
+            for m in list(pending):
+                if not sources: break
+                (peer, shared) = find_peer(m)
+                if peer is None: continue
+                sources.remove(peer)
+                pending.remove(m)
+                start(copy_from_peer, peer, m, shared)
+
+            # Copy the missing paths to machines that got most of
+            # their closure from a peer before starting new copies.
+            while counts['local'] < max_concurrent_copy and (partial or pending):
+                m = partial.pop(0) if partial else pending.pop(0)
+                counts['local'] += 1
+                start(copy_local, m)
+
+            # Use a timeout to allow keyboard interrupts to be
+            # processed.
+            cond.wait(1000)
+
+    logger.log("copied closures to {0} machines, {1} of them partly from peers"
+               .format(len(machines) - len(exceptions), counts['peer_copies']))
+
+    if len(exceptions) == 1:
+        excinfo = exceptions.values()[0]
+        raise excinfo[0], excinfo[1], excinfo[2]
+    if len(exceptions) > 1:
+        raise MultipleExceptions(exceptions)
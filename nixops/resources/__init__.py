@@ -5,6 +5,7 @@ import nixops.util
 
 from nixops.state import StateDict
 from nixops.diff import Diff, Handler
+from typing import Optional
 
 class ResourceDefinition(object):
     """Base class for NixOps resource definitions."""
@@ -57,6 +58,10 @@ class ResourceState(object):
     # Time (in Unix epoch) the resource was created.
     creation_time = nixops.util.attr_property("creationTime", None, int)
 
+    # The maximum number of resources of this type that are created or
+    # destroyed at the same time, e.g. to stay below API rate limits.
+    max_concurrent_create = None  # type: Optional[int]
+
     def __init__(self, depl, name, id):
         self.depl = depl
         self.name = name
@@ -66,14 +71,7 @@ class ResourceState(object):
 
     def _set_attrs(self, attrs):
         """Update machine attributes in the state file."""
-        with self.depl._db:
-            c = self.depl._db.cursor()
-            for n, v in attrs.iteritems():
-                if v == None:
-                    c.execute("delete from ResourceAttrs where machine = ? and name = ?", (self.id, n))
-                else:
-                    c.execute("insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
-                              (self.id, n, v))
+        self.depl._set_resource_attrs(self.id, attrs)
 
     def _set_attr(self, name, value):
         """Update one machine attribute in the state file."""
@@ -81,27 +79,17 @@ class ResourceState(object):
 
     def _del_attr(self, name):
         """Delete a machine attribute from the state file."""
-        with self.depl._db:
-            self.depl._db.execute("delete from ResourceAttrs where machine = ? and name = ?", (self.id, name))
+        self._set_attrs({name: None})
 
     def _get_attr(self, name, default=nixops.util.undefined):
         """Get a machine attribute from the state file."""
-        with self.depl._db:
-            c = self.depl._db.cursor()
-            c.execute("select value from ResourceAttrs where machine = ? and name = ?", (self.id, name))
-            row = c.fetchone()
-            if row != None: return row[0]
-            return nixops.util.undefined
+        return self.depl._get_resource_attrs(self.id).get(name, nixops.util.undefined)
 
     def export(self):
         """Export the resource to move between databases"""
-        with self.depl._db:
-            c = self.depl._db.cursor()
-            c.execute("select name, value from ResourceAttrs where machine = ?", (self.id,))
-            rows = c.fetchall()
-            res = {row[0]: row[1] for row in rows}
-            res['type'] = self.get_type()
-            return res
+        res = dict(self.depl._get_resource_attrs(self.id))
+        res['type'] = self.get_type()
+        return res
 
     def import_(self, attrs):
         """Import the resource from another database"""
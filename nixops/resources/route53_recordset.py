@@ -46,6 +46,10 @@ class Route53RecordSetDefinition(nixops.resources.ResourceDefinition):
 class Route53RecordSetState(nixops.resources.ResourceState):
     """State of a Route53 Recordset."""
 
+    # Route53 allows five requests per second per account, and
+    # rejects changes to a hosted zone while another is pending.
+    max_concurrent_create = 5
+
     state = nixops.util.attr_property("state", nixops.resources.ResourceState.MISSING, int)
     access_key_id = nixops.util.attr_property("route53.accessKeyId", None)
 
@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
-import atexit
+import collections
+import errno
+import hashlib
 import os
+import select
 import shlex
+import stat
 import subprocess
 import sys
+import threading
 import time
 import weakref
-from tempfile import mkdtemp
+from tempfile import gettempdir, mkdtemp
+from typing import Dict
+import nixops.parallel
 import nixops.util
 
-__all__ = ['SSHConnectionFailed', 'SSHCommandFailed', 'SSH']
+__all__ = ['SSHConnectionFailed', 'SSHCommandFailed', 'SSH', 'SSHAgent',
+           'run_commands', 'start_masters']
 
 
 class SSHConnectionFailed(Exception):
@@ -20,17 +28,137 @@ class SSHCommandFailed(nixops.util.CommandFailed):
     pass
 
 
+def get_control_dir():
+    """
+    Return the directory holding the control sockets of SSH master
+    connections.  The masters outlive NixOps, so that subsequent
+    invocations can reuse their connections.
+    """
+    path = os.environ.get("NIXOPS_SSH_CONTROL_DIR")
+    if not path:
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+        if runtime_dir:
+            path = os.path.join(runtime_dir, "nixops-ssh")
+        else:
+            path = os.path.join(gettempdir(), "nixops-ssh-{0}".format(os.getuid()))
+    try:
+        os.makedirs(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST: raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0077:
+        raise Exception("SSH control directory ‘{0}’ must be a directory that "
+                        "only the current user can access".format(path))
+    return path
+
+
+def _get_port(ssh_flags):
+    """
+    Return the port that SSH connects to given 'ssh_flags'.
+    """
+    port = "22"
+    flags = list(ssh_flags)
+    while flags:
+        flag = flags.pop(0)
+        if flag == "-p" and flags:
+            port = flags.pop(0)
+        elif flag.startswith("-p"):
+            port = flag[2:]
+        elif flag == "-o" and flags and flags[0].lower().startswith("port="):
+            port = flags.pop(0)[5:]
+        elif flag.lower().startswith("-oport="):
+            port = flag[7:]
+    return port
+
+
+def _get_key_id(key_file):
+    """
+    Return a hash of the contents of the SSH key file 'key_file', or
+    its name if it cannot be read.
+    """
+    try:
+        with open(key_file) as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except IOError:
+        return key_file
+
+
+def _get_control_socket(target, ssh_flags, host_key):
+    """
+    Return the control socket of the master connection to 'target'.
+    Besides the user, host and port, the socket is named after the
+    other SSH flags, such as the key and known hosts files, and the
+    recorded host key, so that a master is only reused by connections
+    that would authenticate the same way.  Key files are identified by
+    their contents, since most backends write them to a temporary
+    directory that differs between invocations.
+    """
+    flags = set()
+    rest = list(ssh_flags)
+    while rest:
+        flag = rest.pop(0)
+        if flag == "-o" and rest and rest[0].lower().startswith("connecttimeout="):
+            rest.pop(0)
+        elif flag.lower().startswith("-oconnecttimeout="):
+            pass
+        elif flag == "-i" and rest:
+            flags.add("-i" + _get_key_id(rest.pop(0)))
+        elif flag.startswith("-i"):
+            flags.add("-i" + _get_key_id(flag[2:]))
+        else:
+            flags.add(flag)
+    key = "{0}:{1}:{2}:{3}".format(target, _get_port(ssh_flags), "\0".join(sorted(flags)), host_key or "")
+    return os.path.join(get_control_dir(), hashlib.sha1(key).hexdigest()[:20])
+
+
+# Serialises the startup of masters sharing a control socket, e.g. for
+# containers running on the same host.
+_master_locks = collections.defaultdict(threading.Lock)  # type: Dict[str, threading.Lock]
+_master_locks_lock = threading.Lock()
+
+
 class SSHMaster(object):
-    def __init__(self, target, logger, ssh_flags, passwd, user, compress=False):
+    def __init__(self, target, logger, ssh_flags, passwd, user, compress=False,
+                 host_key=None, start=True):
         self._running = False
-        self._tempdir = nixops.util.SelfDeletingDir(mkdtemp(prefix="nixops-ssh-tmp"))
+        self._tempdir = None
         self._askpass_helper = None
-        self._control_socket = self._tempdir + "/master-socket"
         self._ssh_target = target
+        # The socket has a fixed name, so that the next NixOps
+        # invocation finds it.
+        self._control_socket = _get_control_socket(target, ssh_flags, host_key)
+        self.opts = ["-oControlPath={0}".format(self._control_socket)]
+
+        with _master_locks_lock:
+            lock = _master_locks[self._control_socket]
+        with lock:
+            if not self._reuse():
+                # Only look for a running master.
+                if not start: return
+                self._start(target, ssh_flags, passwd, user, compress)
+        self._running = True
+
+    def _reuse(self):
+        """
+        Check whether a live master is listening on the control socket,
+        e.g. one left by a previous NixOps invocation.
+        """
+        if not os.path.exists(self._control_socket): return False
+        res = subprocess.call(["ssh", self._ssh_target, "-S",
+                               self._control_socket, "-O", "check"],
+                              stdout=nixops.util.devnull,
+                              stderr=nixops.util.devnull)
+        if res == 0: return True
+        # The master has died without removing its socket.
+        os.remove(self._control_socket)
+        return False
+
+    def _start(self, target, ssh_flags, passwd, user, compress):
         pass_prompts = 0 if "-i" in ssh_flags and user is None else 3
         kwargs = {}
 
         if passwd is not None:
+            self._tempdir = nixops.util.SelfDeletingDir(mkdtemp(prefix="nixops-ssh-tmp"))
             self._askpass_helper = self._make_askpass_helper()
             newenv = dict(os.environ)
             newenv.update({
@@ -56,26 +184,15 @@ class SSHMaster(object):
                 "unable to start SSH master connection to "
                 "‘{0}’".format(target)
             )
-        self.opts = ["-oControlPath={0}".format(self._control_socket)]
 
-        timeout = 60.0
-        while not self.is_alive():
-            if timeout < 0:
-                raise SSHConnectionFailed(
-                    "could not establish an SSH master socket to "
-                    "‘{0}’ within 60 seconds".format(target)
-                )
-            time.sleep(0.1)
-            timeout -= 0.1
-
-        self._running = True
-
-        weakself = weakref.ref(self)
-        def maybe_shutdown():
-            realself = weakself()
-            if realself is not None:
-                realself.shutdown()
-        atexit.register(maybe_shutdown)
+        # With ‘-f’, ssh only goes to the background once the master
+        # is listening on the control socket, so there is no need to
+        # wait for it to appear.
+        if not self.is_alive():
+            raise SSHConnectionFailed(
+                "SSH master connection to ‘{0}’ did not create its "
+                "control socket".format(target)
+            )
 
     def is_alive(self):
         """
@@ -99,7 +216,9 @@ sys.stdout.write(os.environ['NIXOPS_SSH_PASSWORD'])""".format(sys.executable))
 
     def shutdown(self):
         """
-        Shutdown master process and clean up temporary files.
+        Shutdown master process and clean up temporary files.  Masters
+        that are not shut down exit by themselves after being idle for
+        10 minutes.
         """
         if not self._running: return
         self._running = False
@@ -108,8 +227,61 @@ sys.stdout.write(os.environ['NIXOPS_SSH_PASSWORD'])""".format(sys.executable))
                         stderr=nixops.util.devnull)
         self._tempdir = None
 
-    def __del__(self):
-        self.shutdown()
+
+class SSHAgent(object):
+    def __init__(self):
+        """
+        Start a private SSH agent, which holds only the keys added to it, so
+        that it can be forwarded to a machine that has to log in to others.
+        """
+        self._tempdir = nixops.util.SelfDeletingDir(mkdtemp(prefix="nixops-ssh-agent"))
+        self.socket = self._tempdir + "/agent-socket"
+        self._keys = set()
+        self._process = subprocess.Popen(["ssh-agent", "-D", "-a", self.socket],
+                                         stdout=nixops.util.devnull)
+        timeout = 10.0
+        while not os.path.exists(self.socket):
+            if timeout < 0 or self._process.poll() is not None:
+                self.shutdown()
+                raise Exception("unable to start SSH agent")
+            time.sleep(0.1)
+            timeout -= 0.1
+
+    @property
+    def env(self):
+        """
+        Return the environment for SSH processes using this agent.
+        """
+        env = dict(os.environ)
+        env['SSH_AUTH_SOCK'] = self.socket
+        return env
+
+    def add_key(self, key_file):
+        """
+        Add the private key in the given file to the agent.  Raises
+        CommandFailed if the key cannot be added, e.g. because it has a
+        passphrase.
+        """
+        if key_file in self._keys: return
+        res = subprocess.call(["ssh-add", key_file], env=self.env,
+                              stdin=nixops.util.devnull,
+                              stdout=nixops.util.devnull,
+                              stderr=nixops.util.devnull)
+        if res != 0:
+            raise nixops.util.CommandFailed(
+                "unable to add key ‘{0}’ to the SSH agent".format(key_file), res)
+        self._keys.add(key_file)
+
+    def shutdown(self):
+        """
+        Stop the agent, forgetting all keys.
+        """
+        if self._process is None: return
+        if self._process.poll() is None:
+            self._process.terminate()
+        self._process.wait()
+        self._process = None
+        self._tempdir = None
 
 
 class SSH(object):
@@ -121,6 +293,7 @@ class SSH(object):
         self._flag_fun = lambda: []
         self._host_fun = None
         self._passwd_fun = lambda: None
+        self._host_key_fun = lambda: None
         self._logger = logger
         self._ssh_master = None
         self._compress = False
@@ -161,6 +334,15 @@ class SSH(object):
     def _get_passwd(self):
         return self._passwd_fun()
 
+    def register_host_key_fun(self, host_key_fun):
+        """
+        Register a function that returns the recorded public host key of
+        the machine or None, and requires no arguments.  Master
+        connections are only shared between SSH objects for which it
+        returns the same key.
+        """
+        self._host_key_fun = host_key_fun
+
     def reset(self):
         """
         Reset SSH master connection.
@@ -169,6 +351,19 @@ class SSH(object):
             self._ssh_master.shutdown()
             self._ssh_master = None
 
+    def find_master(self, user=None):
+        """
+        Return the running master connection to the machine, including
+        one left by a previous NixOps invocation, or None.  Unlike
+        get_master, this never connects to the machine.
+        """
+        if self._ssh_master is not None and self._ssh_master.is_alive():
+            return weakref.proxy(self._ssh_master)
+        master = SSHMaster(self._get_target(user), self._logger,
+                           self._get_flags(), None, user,
+                           host_key=self._host_key_fun(), start=False)
+        return master if master._running else None
+
     def get_master(self, flags=[], timeout=None, user=None):
         """
         Start (if necessary) an SSH master connection to speed up subsequent
@@ -197,7 +392,8 @@ class SSH(object):
                 self._ssh_master = SSHMaster(self._get_target(user),
                                              self._logger, flags,
                                              self._get_passwd(), user,
-                                             compress=self._compress)
+                                             compress=self._compress,
+                                             host_key=self._host_key_fun())
                 break
             except Exception:
                 tries = tries - 1
@@ -256,6 +452,20 @@ class SSH(object):
             return ['--', ' '.join(["'{0}'".format(arg.replace("'", r"'\''"))
                                     for arg in command])]
 
+    def _get_command(self, command, flags, timeout, logged, allow_ssh_args,
+                     user):
+        """
+        Start a master connection if necessary and return the SSH command
+        line for running 'command' through it.
+        """
+        master = self.get_master(flags, timeout, user)
+        flags = flags + self._get_flags()
+        if logged:
+            flags.append("-x")
+        cmd = ["ssh"] + master.opts + flags
+        cmd.append(self._get_target(user))
+        return cmd + self._sanitize_command(command, allow_ssh_args)
+
     def run_command(self, command, flags=[], timeout=None, logged=True,
                     allow_ssh_args=False, user=None, **kwargs):
         """
@@ -277,13 +487,8 @@ class SSH(object):
 
         'timeout' specifies the SSH connection timeout.
         """
-        master = self.get_master(flags, timeout, user)
-        flags = flags + self._get_flags()
-        if logged:
-            flags.append("-x")
-        cmd = ["ssh"] + master.opts + flags
-        cmd.append(self._get_target(user))
-        cmd += self._sanitize_command(command, allow_ssh_args)
+        cmd = self._get_command(command, flags, timeout, logged,
+                                allow_ssh_args, user)
         if logged:
             try:
                 return nixops.util.logged_exec(cmd, self._logger, **kwargs)
@@ -301,3 +506,119 @@ class SSH(object):
 
     def enable_compression(self):
         self._compress = True
+
+
+class _RemoteCommand(object):
+    def __init__(self, ssh, command, allow_ssh_args, user):
+        self.name = ssh._logger.machine_name
+        self.ssh = ssh
+        self.command = command
+        self.allow_ssh_args = allow_ssh_args
+        self.user = user
+        self.cmd = None
+        self.process = None
+        self.output = None
+
+    def prepare(self):
+        try:
+            self.cmd = self.ssh._get_command(self.command, [], None, True,
+                                             self.allow_ssh_args, self.user)
+        except SSHConnectionFailed as exc:
+            self.ssh._logger.warn(str(exc))
+
+
+def run_commands(commands, max_concurrent=-1, max_concurrent_connect=16,
+                 allow_ssh_args=False, user=None):
+    """
+    Execute many commands over SSH at once, such as the same command on
+    every machine of a network.  'commands' is a list of (ssh, command)
+    pairs, where 'ssh' is an SSH instance and 'command' is interpreted as
+    in SSH.run_command().  The output of each command is written to the
+    logger of its SSH instance, like run_command() does.
+
+    Master connections are started (or reused) first, at most
+    'max_concurrent_connect' at a time.  Then at most 'max_concurrent'
+    commands (all if -1) run at the same time, and a single event loop
+    in the calling thread collects their output, so that running a
+    command on a thousand machines doesn't take a thousand threads.
+
+    Returns the list of exit codes, in the order of 'commands'; it is
+    255 (like for ssh itself) for machines that could not be reached.
+    """
+    jobs = [_RemoteCommand(ssh, command, allow_ssh_args, user)
+            for (ssh, command) in commands]
+    if not jobs: return []
+    if max_concurrent == -1: max_concurrent = len(jobs)
+
+    nixops.parallel.run_tasks(
+        nr_workers=min(max_concurrent_connect, len(jobs)), tasks=jobs,
+        worker_fun=lambda job: job.prepare())
+
+    pending = collections.deque(job for job in jobs if job.cmd is not None)
+    running = {}
+    poller = select.poll()
+
+    def start(job):
+        job.process = subprocess.Popen(job.cmd, stdin=nixops.util.devnull,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        job.output = nixops.util.OutputLogger(job.ssh._logger)
+        fd = job.process.stdout.fileno()
+        nixops.util.make_non_blocking(fd)
+        poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+        running[fd] = job
+
+    try:
+        while pending or running:
+            while pending and len(running) < max_concurrent:
+                start(pending.popleft())
+            # Use a timeout to allow keyboard interrupts to be processed.
+            for (fd, event) in poller.poll(1000):
+                job = running[fd]
+                try:
+                    data = os.read(fd, 65536)
+                except OSError:
+                    continue
+                if data:
+                    job.output.feed(data)
+                    continue
+                job.output.close()
+                poller.unregister(fd)
+                del running[fd]
+                job.process.stdout.close()
+                job.process.wait()
+    finally:
+        for job in running.itervalues():
+            if job.process.poll() is None: job.process.terminate()
+
+    return [job.process.returncode if job.process else 255 for job in jobs]
+
+
+class _MasterTask(object):
+    def __init__(self, ssh):
+        self.name = ssh._logger.machine_name
+        self.ssh = ssh
+
+
+def start_masters(sshs, max_concurrent=16, timeout=10):
+    """
+    Start master connections for the SSH instances 'sshs', or check that
+    their masters from earlier invocations are alive, at most
+    'max_concurrent' at a time.  Connections that cannot be established
+    within 'timeout' seconds are not retried; later commands will try
+    again and report the error.  Returns the number of masters that
+    could not be started.
+    """
+    tasks = [_MasterTask(ssh) for ssh in sshs]
+    if not tasks: return 0
+
+    def worker(task):
+        try:
+            task.ssh.get_master(timeout=timeout)
+            return True
+        except Exception:
+            return False
+
+    res = nixops.parallel.run_tasks(nr_workers=min(max_concurrent, len(tasks)),
+                                    tasks=tasks, worker_fun=worker)
+    return res.count(False)
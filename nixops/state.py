@@ -1,8 +1,36 @@
+import copy
 import json
+import re
 import collections
 
 import nixops.util
 
+# Type tags of decoded state values: plain text that isn't valid JSON,
+# immutable JSON values (numbers, booleans, strings) and JSON lists and
+# objects.
+_TEXT = 0
+_SCALAR = 1
+_CONTAINER = 2
+
+_json_scalar = re.compile(r'(-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?|true|false|null)\Z')
+
+def _decode(value):
+    """Decode a stored value, returning a (type tag, value) pair.  The
+    tag follows from the stored type and the first character of stored
+    text, so plain text such as resource IDs is never handed to the
+    JSON parser."""
+    if not isinstance(value, basestring):
+        return (_SCALAR, value)
+    if _json_scalar.match(value):
+        return (_SCALAR, json.loads(value))
+    if value[:1] in ('[', '{', '"'):
+        try:
+            v = json.loads(value)
+        except ValueError:
+            return (_TEXT, value)
+        return (_CONTAINER if isinstance(v, (list, dict)) else _SCALAR, v)
+    return (_TEXT, value)
+
 class StateDict(collections.MutableMapping):
     """
        An implementation of a MutableMapping container providing
@@ -11,50 +39,51 @@ class StateDict(collections.MutableMapping):
     # TODO implement __repr__ for convenience e.g debuging the structure
     def __init__(self, depl, id):
         super(StateDict, self).__init__()
+        self._depl = depl
         self._db = depl._db
         self.id = id
+        # Maps keys to (stored value, type tag, decoded value), so that
+        # each stored value is decoded only once.
+        self._decoded = {}
 
     def __setitem__(self, key, value):
-        with self._db:
-            c = self._db.cursor()
-            if value == None:
-                c.execute("delete from ResourceAttrs where machine = ? and name = ?",
-                          (self.id, key))
-            else:
-                v = value
-                if isinstance(value, list):
-                    v = json.dumps(value)
-                c.execute("insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
-                          (self.id, key, v))
+        # Record the tag of the value as it is written, so that reading
+        # it back needn't decode it.
+        if isinstance(value, list):
+            v = json.dumps(value)
+            decoded = (_CONTAINER, copy.deepcopy(value))
+        else:
+            v = value
+            decoded = _decode(v)
+        self._depl._set_resource_attrs(self.id, {key: v})
+        # Remember the value as the attribute cache holds it (numbers
+        # are stored as text), so that it is recognised as current.
+        stored = self._depl._get_resource_attrs(self.id).get(key)
+        self._decoded[key] = (stored,) + decoded
 
     def __getitem__(self, key):
-        with self._db:
-            c = self._db.cursor()
-            c.execute("select value from ResourceAttrs where machine = ? and name = ?",
-                      (self.id, key))
-            row = c.fetchone()
-            if row != None:
-                try:
-                    return json.loads(row[0])
-                except ValueError:
-                    return row[0]
+        value = self._depl._get_resource_attrs(self.id).get(key)
+        if value == None:
             raise KeyError("couldn't find key {} in the state file".format(key))
+        # The attribute may also have been changed through the resource
+        # state object, so check that the decoded value is still current.
+        decoded = self._decoded.get(key)
+        if decoded is None or decoded[0] != value:
+            decoded = self._decoded[key] = (value,) + _decode(value)
+        (value, tag, v) = decoded
+        if tag == _CONTAINER:
+            # Callers may modify lists and objects, so give them their own.
+            return copy.deepcopy(v)
+        return v
 
     def __delitem__(self, key):
-        with self._db:
-            c.execute("delete from ResourceAttrs where machine = ? and name = ?", (self.id, key))
+        self._depl._set_resource_attrs(self.id, {key: None})
+        self._decoded.pop(key, None)
 
     def keys(self):
-        # Generally the list of keys per ResourceAttrs is relatively small
-        # so this should be also relatively fast.
-        _keys = []
-        with self._db:
-            c = self._db.cursor()
-            c.execute("select name from ResourceAttrs where machine = ?", (self.id,))
-            rows = c.fetchall()
-            for row in rows:
-                _keys.append(row[0])
-            return _keys
+        # The attributes of a resource are cached by the deployment,
+        # so this doesn't hit the state file.
+        return self._depl._get_resource_attrs(self.id).keys()
 
     def __iter__(self):
         return iter(self.keys())
@@ -6,18 +6,80 @@ import os.path
 from pysqlite2 import dbapi2 as sqlite3
 import sys
 import threading
+import atexit
+import weakref
+from collections import OrderedDict
 
 
-class Connection(sqlite3.Connection):
+class _SQLiteConnection(sqlite3.Connection):
+    # Subclassed only so that connections can be weakly referenced.
+    pass
 
-    def __init__(self, db_file, **kwargs):
+
+# Statements on a reader connection may not take these actions.
+_write_actions = frozenset([
+    sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE,
+    sqlite3.SQLITE_CREATE_TABLE, sqlite3.SQLITE_CREATE_INDEX,
+    sqlite3.SQLITE_DROP_TABLE, sqlite3.SQLITE_DROP_INDEX,
+    sqlite3.SQLITE_ALTER_TABLE, sqlite3.SQLITE_TRANSACTION])
+
+
+def _deny_writes(action, arg1, arg2, db_name, trigger):
+    return sqlite3.SQLITE_DENY if action in _write_actions else sqlite3.SQLITE_OK
+
+
+class Connection(object):
+    """
+    A connection to a state file that can be shared between threads.
+
+    Statements inside a "with" block run on a single writer connection,
+    and such blocks are serialised between threads.  Statements outside
+    of one run on a connection private to the calling thread, so that
+    reads by parallel workers don't wait for each other or for a writer
+    (the state file is in WAL mode, which allows this).  Those
+    connections refuse to write, since nothing serialises their writes.
+    """
+
+    def __init__(self, db_file):
         db_exists = os.path.exists(db_file)
         if not db_exists:
             os.fdopen(os.open(db_file, os.O_WRONLY | os.O_CREAT, 0o600), 'w').close()
-        sqlite3.Connection.__init__(self, db_file, **kwargs)
         self.db_file = db_file
         self.nesting = 0
         self.lock = threading.RLock()
+        self._owner = None
+        self._writer = self._connect()
+        self._writer.execute("pragma journal_mode = wal")
+        self._local = threading.local()
+        self._readers = weakref.WeakSet()
+        self._queued = OrderedDict()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=60, check_same_thread=False,
+                               factory=_SQLiteConnection, isolation_level=None) # FIXME
+        conn.execute("pragma foreign_keys = 1")
+        return conn
+
+    def _get_connection(self):
+        if self._owner is threading.current_thread():
+            return self._writer
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            conn.set_authorizer(_deny_writes)
+            self._readers.add(conn)
+        return conn
+
+    def cursor(self):
+        return self._get_connection().cursor()
+
+    def execute(self, *args):
+        return self._get_connection().execute(*args)
+
+    def close(self):
+        for conn in list(self._readers):
+            conn.close()
+        self._writer.close()
 
     # Implement Python's context management protocol so that "with db"
     # automatically commits or rolls back.  The difference with the
@@ -27,23 +89,116 @@ class Connection(sqlite3.Connection):
         self.lock.acquire()
         if self.nesting == 0:
             self.must_rollback = False
+            self._owner = threading.current_thread()
         self.nesting = self.nesting + 1
-        sqlite3.Connection.__enter__(self)
+        self._writer.__enter__()
 
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
         if exception_type != None: self.must_rollback = True
         self.nesting = self.nesting - 1
         assert self.nesting >= 0
-        if self.nesting == 0:
-            if self.must_rollback:
+        try:
+            if self.nesting == 0:
+                if self.must_rollback:
+                    try:
+                        self._writer.rollback()
+                    except sqlite3.ProgrammingError:
+                        pass
+                else:
+                    self._writer.__exit__(exception_type, exception_value, exception_traceback)
+                # The writer is in autocommit mode (isolation_level is
+                # None), so the rollback above has nothing to undo:
+                # statements run in a failed block stay in the state
+                # file.  Queued updates are likewise written even if
+                # the block failed, since they record changes that have
+                # already been made to the real world (e.g. a newly
+                # created instance).  An explicit "with" block writes
+                # them even inside a unit of work, so that callers can
+                # make sure that an update is on disk before they go on.
+                self.flush()
+        finally:
+            if self.nesting == 0:
+                self._owner = None
+            self.lock.release()
+
+    def queue(self, key, sql, params):
+        """
+        Queue an update of the row identified by ‘key’.  A later update
+        with the same key replaces a queued one.  The caller must hold
+        ‘lock’ and call write_queued() once it has queued its updates.
+        The queue is shared by all threads, so a flush by another thread
+        may write the update earlier.
+        """
+        with self.lock:
+            self._queued[key] = (sql, params)
+
+    def write_queued(self):
+        """
+        Write the queued updates, unless the calling thread is in a
+        "with" block or a unit of work, which write them when the outer
+        one ends.
+        """
+        with self.lock:
+            if self.nesting > 0 and self._owner is threading.current_thread(): return
+            if self.in_unit_of_work(): return
+            self.flush()
+
+    def flush(self):
+        """
+        Write all queued updates to the state file in one transaction.
+        If one of them fails, it is dropped and the others stay queued.
+        """
+        with self.lock:
+            if not self._queued: return
+            queued = self._queued
+            self._queued = OrderedDict()
+            c = self._writer.cursor()
+            c.execute("begin")
+            for (key, (sql, params)) in queued.iteritems():
                 try:
-                    self.rollback()
-                except sqlite3.ProgrammingError:
-                    pass
-            else:
-                sqlite3.Connection.__exit__(self, exception_type, exception_value, exception_traceback)
-        self.lock.release()
+                    c.execute(sql, params)
+                except:
+                    c.execute("rollback")
+                    del queued[key]
+                    queued.update(self._queued)
+                    self._queued = queued
+                    raise
+            c.execute("commit")
+
+    def in_unit_of_work(self):
+        return getattr(self._local, 'depth', 0) > 0
+
+    def unit_of_work(self):
+        """
+        Return a context manager that keeps the attribute updates of
+        the calling thread queued until it is left, so that a step that
+        sets many attributes usually costs one transaction.  Units of
+        work nest; updates are written when the outer one is left, even
+        on an exception.  An explicit "with" block inside a unit of work
+        still writes the queue when it ends.
+
+        Only use this for steps that don't create or change anything
+        outside the state file, such as ‘nixops check’: if nixops dies
+        in the middle of the step, its queued updates are lost, and a
+        resource they recorded would be leaked.
+
+        The queue is shared between threads: a flush by another thread
+        (at the end of its own "with" block or unit of work, or before
+        it loads attributes from the state file) also writes the updates
+        queued in this unit of work.  That only splits the transaction,
+        because queued updates are never rolled back anyway, not even
+        when the "with" block that queued them fails.
+        """
+        db = self
+        class UnitOfWork(object):
+            def __enter__(self):
+                db._local.depth = getattr(db._local, 'depth', 0) + 1
+            def __exit__(self, exception_type, exception_value, exception_traceback):
+                db._local.depth = db._local.depth - 1
+                if db._local.depth == 0:
+                    db.flush()
+        return UnitOfWork()
 
 
 def get_default_state_file():
@@ -60,21 +215,28 @@ def get_default_state_file():
     return os.environ.get("NIXOPS_STATE", os.environ.get("CHARON_STATE", home + "/deployments.nixops"))
 
 
+class DeploymentSummary(object):
+    """The information about a deployment shown by ‘nixops list’."""
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.name = None
+        self.description = nixops.deployment.Deployment.default_description
+        self.nr_machines = 0
+        self.machine_types = set()
+
+
 class StateFile(object):
     """NixOps state file."""
 
-    current_schema = 3
+    current_schema = 4
 
     def __init__(self, db_file):
         self.db_file = db_file
 
         if os.path.splitext(db_file)[1] not in ['.nixops', '.charon']:
             raise Exception("state file ‘{0}’ should have extension ‘.nixops’".format(db_file))
-        db = sqlite3.connect(db_file, timeout=60, check_same_thread=False, factory=Connection, isolation_level=None) # FIXME
-        db.db_file = db_file
-
-        db.execute("pragma journal_mode = wal")
-        db.execute("pragma foreign_keys = 1")
+        db = Connection(db_file)
 
         # FIXME: this is not actually transactional, because pysqlite (not
         # sqlite) does an implicit commit before "create table".
@@ -96,13 +258,24 @@ class StateFile(object):
             elif version < self.current_schema:
                 if version <= 1: self._upgrade_1_to_2(c)
                 if version <= 2: self._upgrade_2_to_3(c)
+                if version <= 3: self._upgrade_3_to_4(c)
                 c.execute("update SchemaVersion set version = ?", (self.current_schema,))
             else:
                 raise Exception("this NixOps version is too old to deal with schema version {0}".format(version))
 
         self._db = db
 
+        # Don't lose queued updates if we're interrupted in the middle
+        # of a unit of work.
+        weakself = weakref.ref(self)
+        def maybe_flush():
+            realself = weakself()
+            if realself is not None:
+                realself._db.flush()
+        atexit.register(maybe_flush)
+
     def close(self):
+        self._db.flush()
         self._db.close()
 
     def query_deployments(self):
@@ -113,22 +286,56 @@ class StateFile(object):
         return [x[0] for x in res]
 
     def get_all_deployments(self):
-        """Return Deployment objects for every deployment in the database."""
-        uuids = self.query_deployments()
+        """Return Deployment objects for every deployment in the database.
+
+        The resources of each deployment are only loaded when first
+        accessed, so deployments with resources of an unknown type
+        are detected here from their type names.
+        """
+        known = nixops.deployment._state_types()
+        unknown = {}
+        c = self._db.cursor()
+        c.execute("select distinct deployment, type from Resources")
+        for (uuid, type) in c.fetchall():
+            if type not in known: unknown.setdefault(uuid, type)
         res = []
-        for uuid in uuids:
-            try:
-                res.append(self.open_deployment(uuid=uuid))
-            except nixops.deployment.UnknownBackend as e:
-                sys.stderr.write("skipping deployment ‘{0}’: {1}\n".format(uuid, str(e)))
+        for uuid in self.query_deployments():
+            if uuid in unknown:
+                sys.stderr.write("skipping deployment ‘{0}’: unknown resource type ‘{1}’\n".format(uuid, unknown[uuid]))
+            else:
+                res.append(nixops.deployment.Deployment(self, uuid, sys.stderr))
         return res
 
+    def get_deployment_summaries(self):
+        """Return a DeploymentSummary for every deployment in the database.
+
+        This only needs a few aggregate queries, no matter how many
+        deployments and resources there are.
+        """
+        self._db.flush()
+        c = self._db.cursor()
+        summaries = {}
+        for uuid in self.query_deployments():
+            summaries[uuid] = DeploymentSummary(uuid)
+        c.execute("select deployment, name, value from DeploymentAttrs where name in ('name', 'description')")
+        for (uuid, name, value) in c.fetchall():
+            setattr(summaries[uuid], name, value)
+        machine_types = nixops.deployment._state_types(nixops.backends.MachineState)
+        c.execute("select deployment, type, count(*) from Resources group by deployment, type")
+        for (uuid, type, count) in c.fetchall():
+            if type in machine_types:
+                summaries[uuid].nr_machines += count
+                summaries[uuid].machine_types.add(type)
+        return summaries.values()
+
     def _find_deployment(self, uuid=None):
+        self._db.flush()
         c = self._db.cursor()
         if not uuid:
             c.execute("select uuid from Deployments")
         else:
-            c.execute("select uuid from Deployments d where uuid = ? or exists (select 1 from DeploymentAttrs where deployment = d.uuid and name = 'name' and value = ?)", (uuid, uuid))
+            c.execute("select uuid from Deployments where uuid = ? "
+                      "union select deployment from DeploymentAttrs where name = 'name' and value = ?", (uuid, uuid))
         res = c.fetchall()
         if len(res) == 0:
             if uuid:
@@ -208,6 +415,16 @@ class StateFile(object):
                  foreign key(machine) references Resources(id) on delete cascade
                );''')
 
+        self._create_indexes(c)
+
+    def _create_indexes(self, c):
+        # For looking up deployments by name.
+        c.execute("create index if not exists DeploymentsByName on DeploymentAttrs(value) where name = 'name'")
+
+        # For listing the resources of a deployment.  Resource names
+        # are unique within a deployment.
+        c.execute("create unique index if not exists ResourcesByDeployment on Resources(deployment, name)")
+
     def _upgrade_1_to_2(self, c):
         sys.stderr.write("updating database schema from version 1 to 2...\n")
         self._create_schemaversion(c)
@@ -217,4 +434,11 @@ class StateFile(object):
         c.execute("alter table Machines rename to Resources")
         c.execute("alter table MachineAttrs rename to ResourceAttrs")
 
-
+    def _upgrade_3_to_4(self, c):
+        sys.stderr.write("updating database schema from version 3 to 4...\n")
+        c.execute("select deployment, name from Resources group by deployment, name having count(*) > 1")
+        dups = c.fetchall()
+        if dups:
+            raise Exception("cannot upgrade the state file because deployment ‘{0}’ contains multiple resources named ‘{1}’"
+                            .format(dups[0][0], dups[0][1]))
+        self._create_indexes(c)
@@ -16,22 +16,84 @@ import subprocess
 import logging
 import atexit
 import re
+import threading
 from StringIO import StringIO
+from xml.etree import ElementTree
 
 devnull = open(os.devnull, 'rw')
 
 
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken(object):
+    """A flag telling the threads of a parallel operation to give up,
+    e.g. because another part of the operation has failed.  Threads
+    notice it when they wait using ‘sleep’ or ‘check’."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="operation cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        """Raise Cancelled if the operation has been cancelled."""
+        if self._event.is_set(): raise Cancelled(self.reason)
+
+    def sleep(self, seconds):
+        """Sleep for ‘seconds’, or until the operation is cancelled."""
+        self._event.wait(seconds)
+        self.check()
+
+
+_cancel_state = threading.local()
+
+
+def get_cancel_token():
+    """Return the CancelToken of the current thread, if any."""
+    return getattr(_cancel_state, "token", None)
+
+
+def set_cancel_token(token):
+    _cancel_state.token = token
+
+
+def check_cancelled():
+    token = get_cancel_token()
+    if token: token.check()
+
+
+def sleep(seconds):
+    """Like time.sleep, but raise Cancelled as soon as the current
+    thread's operation is cancelled."""
+    token = get_cancel_token()
+    if token:
+        token.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
 def check_wait(test, initial=10, factor=1, max_tries=60, exception=True):
     """Call function ‘test’ periodically until it returns True or a timeout occurs."""
     wait = initial
     tries = 0
+    check_cancelled()
     while tries < max_tries and not test():
         wait = wait * factor
         tries = tries + 1
         if tries == max_tries:
             if exception: raise Exception("operation timed out")
             return False
-        time.sleep(wait)
+        sleep(wait)
     return True
 
 
@@ -44,6 +106,37 @@ class CommandFailed(Exception):
         return "{0} (exit code {1})".format(self.message, self.exitcode)
 
 
+class OutputLogger(object):
+    """Write the output of a command to ‘logger’ line by line, as it
+    arrives in arbitrary chunks."""
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._at_new_line = True
+
+    def feed(self, data):
+        start = 0
+        while start < len(data):
+            end = data.find('\n', start)
+            if end == -1:
+                self._logger.log_start(data[start:])
+                self._at_new_line = False
+            else:
+                s = data[start:end]
+                if self._at_new_line:
+                    self._logger.log(s)
+                else:
+                    self._logger.log_end(s)
+                self._at_new_line = True
+            if end == -1:
+                break
+            start = end + 1
+
+    def close(self):
+        if not self._at_new_line:
+            self._logger.log_end("")
+
+
 def logged_exec(command, logger, check=True, capture_stdout=False, stdin=None,
                 stdin_string=None, env=None):
     """
@@ -102,7 +195,7 @@ def logged_exec(command, logger, check=True, capture_stdout=False, stdin=None,
     for fd in fds:
         make_non_blocking(fd)
 
-    at_new_line = True
+    output = OutputLogger(logger)
     stdout = ""
 
     while len(fds) > 0:
@@ -123,26 +216,10 @@ def logged_exec(command, logger, check=True, capture_stdout=False, stdin=None,
         if log_fd in r:
             data = log_fd.read()
             if data == "":
-                if not at_new_line:
-                    logger.log_end("")
+                output.close()
                 fds.remove(log_fd)
             else:
-                start = 0
-                while start < len(data):
-                    end = data.find('\n', start)
-                    if end == -1:
-                        logger.log_start(data[start:])
-                        at_new_line = False
-                    else:
-                        s = data[start:end]
-                        if at_new_line:
-                            logger.log(s)
-                        else:
-                            logger.log_end(s)
-                        at_new_line = True
-                    if end == -1:
-                        break
-                    start = end + 1
+                output.feed(data)
 
     res = process.wait()
 
@@ -197,8 +274,9 @@ def wait_for_tcp_port(ip, port, timeout=-1, open=True, callback=None):
     """Wait until the specified TCP port is open or closed."""
     n = 0
     while True:
+        check_cancelled()
         if ping_tcp_port(ip, port, ensure_timeout=True) == open: return True
-        if not open: time.sleep(1)
+        if not open: sleep(1)
         n = n + 1
         if timeout != -1 and n >= timeout: break
         if callback: callback()
@@ -346,6 +424,19 @@ def write_file(path, contents):
     f.close()
 
 
+def write_private_file(path, contents):
+    """Replace the file ‘path’ by one that only the user can read,
+    such that readers see either the old or the new contents."""
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(contents)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
 def xml_expr_to_python(node):
     if node.tag == "attrs":
         res = {}
@@ -372,6 +463,9 @@ def xml_expr_to_python(node):
     elif node.tag == "int":
         return int(node.get("value"))
 
+    elif node.tag == "float":
+        return float(node.get("value"))
+
     elif node.tag == "null":
         return None
 
@@ -381,6 +475,64 @@ def xml_expr_to_python(node):
     raise Exception("cannot convert XML output of nix-instantiate to Python: Unknown tag "+node.tag)
 
 
+def python_to_xml_expr(value):
+    """Inverse of xml_expr_to_python(): return the XML element that
+    nix-instantiate --xml would print for a value."""
+    if isinstance(value, dict):
+        node = ElementTree.Element("attrs")
+        for name in sorted(value.iterkeys()):
+            attr = ElementTree.SubElement(node, "attr", name=name)
+            attr.append(python_to_xml_expr(value[name]))
+        return node
+
+    elif isinstance(value, list):
+        node = ElementTree.Element("list")
+        node.extend(python_to_xml_expr(elem) for elem in value)
+        return node
+
+    elif isinstance(value, basestring):
+        return ElementTree.Element("string", value=value)
+
+    elif isinstance(value, bool):
+        return ElementTree.Element("bool", value="true" if value else "false")
+
+    elif isinstance(value, (int, long)):
+        return ElementTree.Element("int", value=str(value))
+
+    elif isinstance(value, float):
+        return ElementTree.Element("float", value=repr(value))
+
+    elif value is None:
+        return ElementTree.Element("null")
+
+    raise Exception("cannot convert {0} to the XML output of nix-instantiate".format(type(value).__name__))
+
+
+class LazyXMLExpr(object):
+    """Stand-in for the <attr> element that nix-instantiate --xml
+    prints for a named value.  The element is only built when
+    something other than its name is asked for, so definitions that
+    are constructed from their configuration don't pay for it."""
+
+    def __init__(self, name, value):
+        self._name = name
+        self._value = value
+        self._element = None
+
+    def _get_element(self):
+        if self._element is None:
+            self._element = ElementTree.Element("attr", name=self._name)
+            self._element.append(python_to_xml_expr(self._value))
+        return self._element
+
+    def get(self, key, default=None):
+        if key == "name": return self._name
+        return self._get_element().get(key, default)
+
+    def __getattr__(self, name):
+        return getattr(self._get_element(), name)
+
+
 def parse_nixos_version(s):
     """Split a NixOS version string into a list of components."""
     return s.split(".")
@@ -75,7 +75,7 @@ rec {
 
       src = "${tarball}/tarballs/*.tar.bz2";
 
-      buildInputs = [ python2Packages.nose python2Packages.coverage ];
+      buildInputs = [ python2Packages.nose python2Packages.coverage python2Packages.mock ];
 
       nativeBuildInputs = [ pkgs.mypy ];
 
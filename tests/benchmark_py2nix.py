@@ -0,0 +1,19 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Measure how long py2nix takes to encode the physical network
+# specification of a large deployment.  Run it from the top of the
+# source tree with ‘python2 -m tests.benchmark_py2nix [N...]’.
+
+import sys
+import time
+
+from nixops.nix_expr import py2nix
+from tests.unit.test_nix_expr import make_spec
+
+if __name__ == "__main__":
+    for n in [int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000]:
+        spec = make_spec(n)
+        start = time.time()
+        py2nix(spec)
+        print("{0} machines: {1:.2f}s".format(n, time.time() - start))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# A test fixture creating a network of machines in a fresh state file.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import nixops.deployment
+import nixops.statefile
+from tests.unit.test_definitions import machine_config
+
+def patch(test, target, attribute, *args, **kwargs):
+    """Replace ‘attribute’ of ‘target’ by a mock until the end of
+    ‘test’, and return the mock."""
+    patcher = mock.patch.object(target, attribute, *args, **kwargs)
+    test.addCleanup(patcher.stop)
+    return patcher.start()
+
+class NetworkTestBase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="nixops-test")
+        self.sf = nixops.statefile.StateFile(os.path.join(self.tempdir, "test.nixops"))
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tempdir)
+
+    def make_network(self, n):
+        depl = self.sf.create_deployment()
+        depl.definitions = {}
+        with self.sf._db:
+            for i in range(n):
+                name = "machine-{0}".format(i)
+                m = depl._create_resource(name, "none")
+                m.index = i
+                m.public_ipv4 = "10.0.{0}.{1}".format(i / 256, i % 256)
+                config = dict(machine_config, nixosRelease="18.03",
+                              encryptedLinksTo=["machine-1"] if i == 0 else [])
+                depl.definitions[name] = nixops.deployment._create_definition(name, config, "none")
+        return depl
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from tests.unit.network import NetworkTestBase, patch
+
+class ActivateTest(NetworkTestBase):
+    def test_skip_unchanged_machines(self):
+        depl = self.make_network(2)
+        contacted = []
+        with self.sf._db:
+            for m in depl.machines.values():
+                m.cur_toplevel = "/nix/store/old"
+                m.new_toplevel = "/nix/store/new" if m.name == "machine-1" else "/nix/store/old"
+                patch(self, m, "run_command", side_effect=lambda command, m=m, **kw: contacted.append(m.name) or 111)
+                patch(self, m, "send_keys", side_effect=lambda m=m: contacted.append("keys " + m.name))
+                patch(self, m, "switch_to_configuration", return_value=0)
+                depl.definitions[m.name].always_activate = False
+        def activate(check):
+            depl.activate_configs(self.tempdir, include=[], exclude=[], allow_reboot=False,
+                                  force_reboot=False, check=check, sync=False, always_activate=False,
+                                  dry_activate=False, max_concurrent_activate=-1)
+        activate(False)
+        self.assertEqual(sorted(contacted), ["keys machine-0", "machine-1"])
+        self.assertEqual(depl.machines["machine-0"].cur_configs_path, self.tempdir)
+        del contacted[:]
+        activate(True)
+        self.assertEqual(sorted(contacted), ["machine-0", "machine-1"])
+        del contacted[:]
+        depl.definitions["machine-0"].always_activate = True
+        activate(False)
+        self.assertEqual(sorted(contacted), ["keys machine-0", "machine-0", "machine-1"])
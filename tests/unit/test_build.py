@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+
+import mock
+
+import nixops.eval_cache
+from tests.unit.network import NetworkTestBase
+
+def get_arg(args, flag, name=None):
+    """Return the value following ‘flag’ (and ‘name’, for flags such
+    as ‘--argstr’ that take a name and a value) in ‘args’."""
+    for (i, a) in enumerate(args):
+        if a != flag: continue
+        if name is None: return args[i + 1]
+        if args[i + 1] == name: return args[i + 2]
+    raise KeyError(flag)
+
+class BuildTest(NetworkTestBase):
+    def build(self, depl, failing=["machine-1"], **kwargs):
+        store = os.path.join(self.tempdir, "store")
+        if not os.path.exists(store): os.mkdir(store)
+        self.builds = []
+        self.instantiated = []
+        def check_output(args, **kw):
+            if "--find-file" in args: return store + "/nixpkgs/nixos\n"
+            if args[0] == "nix-build":
+                self.builds.append(args)
+                out = os.path.join(store, "nixops-machines")
+                if not os.path.exists(out): os.mkdir(out)
+                return out + "\n"
+            if args[0] == "nix-store": return ""
+            name = get_arg(args, "--argstr", "name")
+            if name in failing: raise subprocess.CalledProcessError(1, args)
+            self.instantiated.append(name)
+            return "{0}/{1}.drv\n".format(store, name)
+        def check_call(args, **kw):
+            out = get_arg(args, "-r")
+            if out.endswith(".drv"): out = out[:-len(".drv")]
+            if not os.path.exists(out): os.mkdir(out)
+            root = get_arg(args, "--add-root")
+            if os.path.lexists(root): os.remove(root)
+            os.symlink(out, root)
+        with mock.patch("nixops.deployment.subprocess.check_output", side_effect=check_output), \
+             mock.patch("nixops.deployment.subprocess.check_call", side_effect=check_call):
+            return depl.build_configs(include=[], exclude=[], **kwargs)
+
+    def use_eval_cache(self, depl):
+        network = os.path.join(self.tempdir, "network", "network.nix")
+        os.mkdir(os.path.dirname(network))
+        with open(network, "w") as f: f.write("{ }")
+        depl.nix_exprs = [network]
+        depl.eval_cache = nixops.eval_cache.EvalCache(os.path.join(self.tempdir, "cache"))
+
+    def test_reuse_unchanged_network(self):
+        depl = self.make_network(2)
+        self.use_eval_cache(depl)
+        configs_path = self.build(depl)
+        self.assertEqual(len(self.builds), 1)
+        self.assertEqual(self.build(depl), configs_path)
+        self.assertEqual(self.builds, [])
+
+        # Machines can refer to each other's physical attributes, so
+        # the network is built again if any of them changes.
+        depl.resources["machine-1"].public_ipv4 = "10.1.0.1"
+        self.build(depl)
+        self.assertEqual(len(self.builds), 1)
+        self.build(depl, repair=True)
+        self.assertEqual(len(self.builds), 1)
+
+    def test_build_machines_separately(self):
+        depl = self.make_network(4)
+        built = []
+        try:
+            self.build(depl, max_concurrent_build=2, on_built=lambda m: built.append(m.name))
+            self.fail("expected the build of machine-1 to fail")
+        except Exception as e:
+            self.assertIn("machine ‘machine-1’", str(e))
+        self.assertEqual(sorted(built), ["machine-0", "machine-2", "machine-3"])
+        m = depl.machines["machine-2"]
+        self.assertEqual(m.new_toplevel, os.path.join(self.tempdir, "store", "machine-2"))
+        self.assertEqual(self.builds, [])
+
+    def test_reuse_unchanged_machines(self):
+        depl = self.make_network(2)
+        self.use_eval_cache(depl)
+        self.build(depl, failing=[], max_concurrent_build=2)
+        self.assertEqual(sorted(self.instantiated), ["machine-0", "machine-1"])
+        self.build(depl, failing=[], max_concurrent_build=2)
+        self.assertEqual(self.instantiated, [])
+        self.assertEqual(depl.machines["machine-1"].new_toplevel, os.path.join(self.tempdir, "store", "machine-1"))
+
+        depl.resources["machine-1"].public_ipv4 = "10.1.0.1"
+        self.build(depl, failing=[], max_concurrent_build=2)
+        self.assertEqual(sorted(self.instantiated), ["machine-0", "machine-1"])
+        self.build(depl, failing=[], max_concurrent_build=2, repair=True)
+        self.assertEqual(sorted(self.instantiated), ["machine-0", "machine-1"])
+
+    def test_build_machines_into_store_path(self):
+        depl = self.make_network(2)
+        configs_path = self.build(depl, failing=[], max_concurrent_build=2, on_built=None)
+        self.assertEqual(configs_path, os.path.join(self.tempdir, "store", "nixops-machines"))
+        [args] = self.builds
+        machines = get_arg(args, "--arg", "machines")
+        for name in ["machine-0", "machine-1"]:
+            self.assertIn('"{0}" = ( builtins.storePath "{1}/store/{0}" );'.format(name, self.tempdir), machines)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import nixops.closures
+import nixops.deployment
+import nixops.ssh_util
+from tests.unit.network import NetworkTestBase, patch
+
+class CopyClosuresTest(NetworkTestBase):
+    def test_skip_machines_using_local_store(self):
+        depl = self.make_network(3)
+        configs = os.path.join(self.tempdir, "configs")
+        os.mkdir(configs)
+        for m in depl.machines.values():
+            os.mkdir(os.path.join(configs, m.name))
+            patch(self, m, "copy_closure_to")
+        patch(self, depl.machines["machine-0"], "needs_closure_copy", return_value=False)
+        CopyPlan = patch(self, nixops.closures, "CopyPlan")
+        CopyPlan.return_value.order.side_effect = lambda machines: machines
+        start_masters = patch(self, nixops.ssh_util, "start_masters")
+        depl.copy_closures(configs, include=[], exclude=[], max_concurrent_copy=-1)
+        self.assertEqual(len(start_masters.call_args[0][0]), 2)
+        self.assertEqual(sorted(m.name for m in CopyPlan.call_args[0][0]), ["machine-1", "machine-2"])
+        self.assertEqual(sorted(m.name for m in depl.machines.values() if m.copy_closure_to.called),
+                         ["machine-1", "machine-2"])
+
+    def test_single_machine_without_plan(self):
+        depl = self.make_network(1)
+        configs = os.path.join(self.tempdir, "configs")
+        os.makedirs(os.path.join(configs, "machine-0"))
+        m = depl.machines["machine-0"]
+        patch(self, m, "copy_closure_to")
+        CopyPlan = patch(self, nixops.closures, "CopyPlan")
+        patch(self, nixops.ssh_util, "start_masters")
+        depl.copy_closures(configs, include=[], exclude=[], max_concurrent_copy=5)
+        self.assertFalse(CopyPlan.called)
+        m.copy_closure_to.assert_called_once_with(os.path.join(configs, "machine-0"), None)
+
+    def test_pass_toplevel_for_many_missing_paths(self):
+        depl = self.make_network(1)
+        m = depl.machines["machine-0"]
+        patch(self, m, "get_ssh_for_copy_closure")
+        logged_exec = patch(self, m, "_logged_exec")
+        def copy(missing):
+            m.copy_closure_to("/nix/store/toplevel", missing)
+            return logged_exec.call_args[0][0][3:-1]
+        self.assertEqual(copy(None), ["/nix/store/toplevel"])
+        self.assertEqual(copy(set(["/nix/store/b", "/nix/store/a"])), ["/nix/store/a", "/nix/store/b"])
+        many = set("/nix/store/{0}".format(i) for i in range(1000))
+        self.assertEqual(copy(many), ["/nix/store/toplevel"])
+
+    def test_copy_via_binary_cache(self):
+        depl = self.make_network(2)
+        depl.binary_cache = "file:///cache?secret-key=/key"
+        calls = []
+        def fetch(m, fail):
+            def copy_closure_from_cache(path, substituter):
+                calls.append(("fetch", m.name, substituter))
+                if fail: raise Exception("no such path")
+            return copy_closure_from_cache
+        for (i, m) in enumerate(sorted(depl.machines.values(), key=lambda m: m.name)):
+            m.new_toplevel = self.tempdir
+            patch(self, m, "copy_closure_from_cache", side_effect=fetch(m, i == 1))
+            patch(self, m, "copy_closure_to", side_effect=lambda path, missing=None, m=m: calls.append(("copy", m.name)))
+        patch(self, nixops.deployment.subprocess, "check_call", side_effect=lambda args, **kw: calls.append(tuple(args[:4])))
+        for m in depl.machines.values(): depl._copy_closure(m)
+        self.assertEqual(sorted(calls), [
+            ("copy", "machine-1"),
+            ("fetch", "machine-0", "file:///cache"),
+            ("fetch", "machine-1", "file:///cache"),
+            ("nix", "copy", "--to", "file:///cache?secret-key=/key"),
+            ("nix", "copy", "--to", "file:///cache?secret-key=/key")])
+
+    def test_refuse_unsigned_binary_cache(self):
+        depl = self.make_network(1)
+        m = depl.machines["machine-0"]
+        m.new_toplevel = self.tempdir
+        for cache in ["file:///cache", "s3://bucket?region=eu-west-1", "file:///cache?xsecret-key=/key"]:
+            depl.binary_cache = cache
+            try:
+                depl._copy_closure(m)
+                self.fail("expected an unsigned binary cache to be refused")
+            except Exception as e:
+                self.assertIn("secret-key", str(e))
+
+    def test_refuse_copy_flags_when_building_separately(self):
+        depl = self.make_network(1)
+        evaluate_active = patch(self, depl, "evaluate_active")
+        for kwargs in [dict(peer_copy=True, pipeline=True), dict(peer_copy=True, max_concurrent_build=2),
+                       dict(adaptive_copy=True, pipeline=True), dict(adaptive_copy=True, peer_copy=True)]:
+            self.assertRaises(Exception, depl._deploy, **kwargs)
+        self.assertFalse(evaluate_active.called)
+
+    def test_refuse_unsigned_binary_cache_before_building(self):
+        depl = self.make_network(1)
+        depl.binary_cache = "file:///cache"
+        patch(self, depl, "evaluate_active")
+        patch(self, depl, "_run_resource_tasks")
+        build_configs = patch(self, depl, "build_configs")
+        try:
+            depl._deploy(pipeline=True)
+            self.fail("expected an unsigned binary cache to be refused")
+        except Exception as e:
+            self.assertIn("secret-key", str(e))
+        self.assertFalse(build_configs.called)
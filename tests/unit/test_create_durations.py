@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+from tests.unit.network import NetworkTestBase, patch
+
+class CreateDurationsTest(NetworkTestBase):
+    def test_update_create_durations(self):
+        depl = self.make_network(1)
+        m = depl.machines["machine-0"]
+        self.assertEqual(depl._get_create_cost_fun()(m), 1.0)
+        depl._update_create_durations({"none": [10.0, 30.0], "ec2-keypair": [2.0]})
+        depl._update_create_durations({"none": [40.0]})
+        self.assertEqual(depl.create_durations, {"none": 30.0, "ec2-keypair": 2.0})
+        cost = depl._get_create_cost_fun()
+        self.assertEqual(cost(m), 30.0)
+        patch(self, m, "get_type", return_value="vpc")
+        self.assertEqual(cost(m), 16.0)
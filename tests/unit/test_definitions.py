@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import nixops.deployment
+import nixops.statefile
+from nixops.util import LazyXMLExpr, python_to_xml_expr, xml_expr_to_python
+
+machine_config = {
+    "targetEnv": "none",
+    "targetHost": "10.0.0.1",
+    "targetPort": 22,
+    "publicIPv4": None,
+    "encryptedLinksTo": ["bar"],
+    "storeKeysOnMachine": False,
+    "alwaysActivate": True,
+    "owners": ["alice@example.org"],
+    "hasFastConnection": False,
+    "keys": {
+        "secret": {"text": "s3cr3t", "keyFile": None, "destDir": "/run/keys",
+                   "user": "root", "group": "root", "permissions": "0600"},
+    },
+}
+
+class XMLExprTest(unittest.TestCase):
+    def test_round_trip(self):
+        value = {"a": [1, True, None, "x"], "b": {"c": u"‘d’"}, "e": 1.5}
+        self.assertEqual(xml_expr_to_python(python_to_xml_expr(value)), value)
+
+    def test_lazy_element(self):
+        xml = LazyXMLExpr("foo", machine_config)
+        self.assertEqual(xml.get("name"), "foo")
+        self.assertIsNone(xml._element)
+        self.assertEqual(xml.find("attrs/attr[@name='targetHost']/string").get("value"), "10.0.0.1")
+        self.assertEqual(len(xml.findall("attrs/attr[@name='owners']/list/string")), 1)
+
+class CreateDefinitionTest(unittest.TestCase):
+    def test_machine_from_config(self):
+        defn = nixops.deployment._create_definition("foo", machine_config, "none")
+        self.assertEqual(defn.name, "foo")
+        self.assertEqual(defn.encrypted_links_to, set(["bar"]))
+        self.assertEqual((defn.store_keys_on_machine, defn.ssh_port, defn.always_activate),
+                         (False, 22, True))
+        self.assertEqual(defn.keys["secret"], {"text": "s3cr3t", "destDir": "/run/keys", "user": "root",
+                                               "group": "root", "permissions": "0600"})
+        self.assertEqual((defn._target_host, defn._public_ipv4), ("10.0.0.1", None))
+
+    def test_xml_definition(self):
+        config = {"name": "queue", "region": "eu-west-1", "accessKeyId": "key",
+                  "visibilityTimeout": 30}
+        defn = nixops.deployment._create_definition("q", config, "sqsQueues")
+        self.assertEqual((defn.name, defn.queue_name, defn.region, defn.visibility_timeout),
+                         ("q", "queue", "eu-west-1", "30"))
+
+class EvaluateTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="nixops-test")
+        self.sf = nixops.statefile.StateFile(os.path.join(self.tempdir, "test.nixops"))
+        self.depl = self.sf.create_deployment()
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_single_evaluation(self):
+        info = {"network": {"description": "test network"},
+                "machines": {"foo": machine_config},
+                "resources": {"sshKeyPairs": {"key": {}}}}
+        calls = []
+        def check_output(args, **kwargs):
+            calls.append(args)
+            return json.dumps(info)
+        real_check_output = nixops.deployment.subprocess.check_output
+        nixops.deployment.subprocess.check_output = check_output
+        try:
+            self.depl.evaluate()
+        finally:
+            nixops.deployment.subprocess.check_output = real_check_output
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.depl.description, "test network")
+        self.assertEqual(sorted(self.depl.definitions.keys()), ["foo", "key"])
+        self.assertIn("evaluation of ‘jsonInfo’", [phase for (phase, t) in self.depl.timings])
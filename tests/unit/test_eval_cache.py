@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import nixops.deployment
+import nixops.eval_cache
+import nixops.statefile
+from nixops.eval_cache import EvalCache, fingerprint
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="nixops-test")
+        self.network = os.path.join(self.tempdir, "network.nix")
+        self.write(self.network, "{ }")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, path, contents, mtime=None):
+        with open(path, "w") as f: f.write(contents)
+        if mtime is not None: os.utime(path, (mtime, mtime))
+
+    def test_changes(self):
+        key = fingerprint(["a"], [self.tempdir])
+        self.assertEqual(fingerprint(["a"], [self.tempdir]), key)
+        self.assertNotEqual(fingerprint(["b"], [self.tempdir]), key)
+        self.write(self.network, "{ x = 1; }", time.time() + 10)
+        key2 = fingerprint(["a"], [self.tempdir])
+        self.assertNotEqual(key2, key)
+        self.write(os.path.join(self.tempdir, "machine.nix"), "{ }")
+        self.assertNotEqual(fingerprint(["a"], [self.tempdir]), key2)
+
+    def test_exclude(self):
+        state = os.path.join(self.tempdir, "state.nixops")
+        key = fingerprint([], [self.tempdir], exclude=[state])
+        self.write(state, "x")
+        self.assertEqual(fingerprint([], [self.tempdir], exclude=[state]), key)
+
+    def test_too_many_files(self):
+        old = nixops.eval_cache.max_files
+        nixops.eval_cache.max_files = 0
+        try:
+            self.assertIsNone(fingerprint([], [self.tempdir]))
+        finally:
+            nixops.eval_cache.max_files = old
+
+class EvalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="nixops-test")
+        self.cache = EvalCache(os.path.join(self.tempdir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("uuid", "jsonInfo", "key"))
+        self.cache.put("uuid", "jsonInfo", "key", {"machines": {}})
+        self.assertEqual(self.cache.get("uuid", "jsonInfo", "key"), {"machines": {}})
+        self.assertIsNone(self.cache.get("uuid", "jsonInfo", "other"))
+        self.assertEqual(os.stat(self.cache.cache_dir).st_mode & 0777, 0700)
+        self.cache.remove("uuid")
+        self.assertIsNone(self.cache.get("uuid", "jsonInfo", "key"))
+
+    def test_private_dir(self):
+        path = self.cache.get_private_dir("uuid", "physical")
+        self.assertEqual(os.stat(path).st_mode & 0777, 0700)
+        os.chmod(path, 0755)
+        self.assertEqual(self.cache.get_private_dir("uuid", "physical"), path)
+        self.assertEqual(os.stat(path).st_mode & 0777, 0700)
+        open(os.path.join(path, "physical.nix"), "w").close()
+        self.cache.remove("uuid")
+        self.assertFalse(os.path.exists(path))
+
+    def test_evaluation_is_cached(self):
+        sf = nixops.statefile.StateFile(os.path.join(self.tempdir, "test.nixops"))
+        try:
+            network = os.path.join(self.tempdir, "network.nix")
+            with open(network, "w") as f: f.write("{ }")
+            depl = sf.create_deployment()
+            depl.nix_exprs = [network]
+            depl.eval_cache = self.cache
+            calls = []
+            result = ['{"machines": {}, "resources": {}}']
+            def check_output(args, **kwargs):
+                calls.append(args)
+                return result[0]
+            real_check_output = nixops.deployment.subprocess.check_output
+            nixops.deployment.subprocess.check_output = check_output
+            try:
+                depl.evaluate_config_json("jsonInfo")
+                depl.evaluate_config_json("jsonInfo")
+                self.assertEqual(len(calls), 1)
+                depl.set_argstr("foo", "bar")
+                depl.evaluate_config_json("jsonInfo")
+                self.assertEqual(len(calls), 2)
+                # Key text is never cached.
+                depl.set_argstr("foo", "baz")
+                result[0] = '{"machines": {"m": {"keys": {"k": {"text": "secret"}}}}, "resources": {}}'
+                depl.evaluate_config_json("jsonInfo")
+                depl.evaluate_config_json("jsonInfo")
+                self.assertEqual(len(calls), 4)
+            finally:
+                nixops.deployment.subprocess.check_output = real_check_output
+        finally:
+            sf.close()
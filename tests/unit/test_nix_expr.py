@@ -2,10 +2,11 @@ import unittest
 
 from textwrap import dedent
 
-from nixops.nix_expr import py2nix, nix2py, nixmerge
+from nixops.nix_expr import py2nix, nix2py, nixmerge, nixmerge_into
 from nixops.nix_expr import RawValue, Function, Call
 
-__all__ = ['Py2NixTest', 'Nix2PyTest', 'NixMergeTest']
+__all__ = ['Py2NixTest', 'Nix2PyTest', 'NixMergeTest', 'NixMergeIntoTest',
+           'Py2NixLargeSpecTest']
 
 
 class Py2NixTestBase(unittest.TestCase):
@@ -330,3 +331,65 @@ class NixMergeTest(unittest.TestCase):
                           Function("aaa", {'a': 1}), Function("ccc", {'b': 2}))
         self.assertRaises(ValueError, nixmerge,
                           Function("aaa", {'a': 1}), {'b': 2})
+
+
+class NixMergeIntoTest(unittest.TestCase):
+    def test_merge(self):
+        sources = [
+            {'a': {'b': {'c': 'd'}}},
+            {'a': {'c': 'e'}},
+            {'b': {'a': ['a']}},
+            {'b': {'a': ['b', 'a']}},
+            {'e': 'f'},
+        ]
+        dest = {}
+        for source in sources:
+            nixmerge_into(dest, source)
+        self.assertEqual(dest, {
+            'a': {'c': 'e', 'b': {'c': 'd'}},
+            'b': {'a': ['a', 'b']},
+            'e': 'f',
+        })
+        self.assertEqual(sources[2], {'b': {'a': ['a']}})
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, nixmerge_into, {'a': [1]}, {'a': {'b': 2}})
+        self.assertRaises(ValueError, nixmerge_into, {'a': 1}, {'a': 2})
+
+
+def make_spec(n):
+    """
+    Return a physical network specification of n machines, like the
+    one NixOps generates for a deployment.
+    """
+    spec = {}
+    for i in range(n):
+        name = "machine-{0}".format(i)
+        spec[name] = Function("{ config, lib, pkgs, ... }", {
+            'config': {
+                ('deployment', 'targetHost'): "10.0.{0}.{1}".format(i / 256, i % 256),
+                ('networking', 'extraHosts'): RawValue('"own" + shared.hosts0'),
+                ('networking', 'privateIPv4'): "192.168.1.{0}".format(i % 256),
+                ('services', 'openssh', 'knownHosts'): RawValue("shared.knownHosts"),
+                ('boot', 'kernelModules'): ["virtio_pci", "virtio_net"],
+                ('system', 'activationScripts', 'nixops'): "echo ${foo}\n\tdone\n",
+            },
+            'imports': [RawValue("./hardware.nix"), nix2py("{ pkgs, ... }: {\n}")],
+        })
+    return spec
+
+
+class Py2NixLargeSpecTest(unittest.TestCase):
+    """
+    Encode a physical network specification of 1000 machines.  The time
+    this takes is measured by tests/benchmark_py2nix.py.
+    """
+    def test_encode_1000_machines(self):
+        from StringIO import StringIO
+        spec = make_spec(1000)
+        result = py2nix(spec)
+        out = StringIO()
+        py2nix(spec, out=out)
+        self.assertEqual(out.getvalue(), result)
+        self.assertEqual(result.count("deployment.targetHost = "), 1000)
+        self.assertIn('deployment.targetHost = "10.0.3.231";', result)
@@ -0,0 +1,149 @@
+import threading
+import time
+import unittest
+
+import nixops.parallel
+import nixops.util
+from nixops.parallel import AdaptiveLimit, MultipleExceptions, Stage, run_dag, run_tasks
+
+class Task(object):
+    def __init__(self, name, group=None):
+        self.name = name
+        self.group = group
+
+class AdaptiveLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.real_time = nixops.parallel.time.time
+        nixops.parallel.time.time = lambda: self.now
+
+    def tearDown(self):
+        nixops.parallel.time.time = self.real_time
+
+    def run_round(self, limit, capacity):
+        """Run a round of tasks over a link whose throughput stops
+        growing at 'capacity' concurrent tasks, and degrades beyond
+        twice that."""
+        n = limit.limit
+        throughput = min(n, capacity) if n <= 2 * capacity else capacity / 2.0
+        for i in range(n): limit.acquire()
+        self.now += 1.0
+        for i in range(n): limit.release(int(throughput * 1000000 / n))
+
+    def test_grows_until_throughput_stops_rising(self):
+        limit = AdaptiveLimit(1, 32)
+        for i in range(10): self.run_round(limit, 4)
+        self.assertEqual(limit.history[:3], [1, 2, 4])
+        self.assertTrue(4 <= limit.limit <= 8)
+        self.assertEqual(limit.history[-1], limit.limit)
+
+    def test_stays_within_bounds(self):
+        limit = AdaptiveLimit(2, 3)
+        for i in range(5): self.run_round(limit, 100)
+        self.assertEqual(limit.history, [2, 3])
+
+class RunDagTest(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = {}
+        self.max_running = {}
+
+    def worker(self, t, duration=0):
+        with self.lock:
+            self.started.append(t.name)
+            self.running[t.group] = self.running.get(t.group, 0) + 1
+            self.max_running[t.group] = max(self.max_running.get(t.group, 0), self.running[t.group])
+        # Keep the task running so that it overlaps with others.
+        time.sleep(duration)
+        with self.lock:
+            self.running[t.group] -= 1
+        if t.name.startswith("fail"): raise Exception(t.name + " failed")
+        return t.name
+
+    def test_critical_path_first(self):
+        tasks = [Task("leaf{0}".format(i)) for i in range(3)] + [Task("vpc"), Task("subnet"), Task("instance")]
+        deps = {"subnet": ["vpc"], "instance": ["subnet"]}
+        res = run_dag(1, tasks, deps, self.worker)
+        self.assertEqual(sorted(res), sorted(t.name for t in tasks))
+        self.assertEqual(self.started[:2], ["vpc", "subnet"])
+
+    def test_group_limits(self):
+        tasks = [Task("ec2-{0}".format(i), "ec2") for i in range(20)] + [Task("other{0}".format(i)) for i in range(5)]
+        run_dag(8, tasks, {}, lambda t: self.worker(t, duration=0.02),
+                group_fun=lambda t: t.group, group_limits={"ec2": 2})
+        self.assertEqual(len(self.started), 25)
+        self.assertEqual(self.max_running["ec2"], 2)
+        self.assertGreater(self.max_running[None], 1)
+
+    def test_invalid_group_limit(self):
+        tasks = [Task("ec2-0", "ec2")]
+        self.assertRaises(Exception, run_dag, 8, tasks, {}, self.worker,
+                          group_fun=lambda t: t.group, group_limits={"ec2": 0})
+        self.assertEqual(self.started, [])
+
+    def test_failures_skip_dependents(self):
+        tasks = [Task("fail1"), Task("fail2"), Task("a"), Task("b"), Task("c")]
+        deps = {"a": ["fail1"], "b": ["a"], "c": []}
+        try:
+            run_dag(-1, tasks, deps, self.worker)
+            self.fail("expected an exception")
+        except MultipleExceptions as e:
+            self.assertEqual(sorted(e.exceptions.keys()), ["fail1", "fail2"])
+        self.assertEqual(sorted(self.started), ["c", "fail1", "fail2"])
+
+    def test_cycle(self):
+        tasks = [Task("a"), Task("b"), Task("c")]
+        self.assertRaises(Exception, run_dag, 2, tasks, {"a": ["b"], "b": ["a"]}, self.worker)
+        self.assertEqual(self.started, [])
+
+class StageTest(RunDagTest):
+    def test_put_does_not_wait(self):
+        release = threading.Event()
+        stage = Stage(1, lambda t: release.wait(10) and self.worker(t))
+        run_tasks(2, [Task("a"), Task("b")], stage.put)
+        self.assertEqual(self.started, [])
+        release.set()
+        stage.join()
+        stage.check()
+        self.assertEqual(sorted(self.started), ["a", "b"])
+
+    def test_limit(self):
+        stage = Stage(2, lambda t: self.worker(t, duration=0.02))
+        for i in range(6): stage.put(Task("task{0}".format(i)))
+        stage.join()
+        self.assertEqual(len(self.started), 6)
+        self.assertEqual(self.max_running[None], 2)
+
+    def test_failures(self):
+        stage = Stage(2, self.worker)
+        for name in ["fail1", "a", "fail2"]: stage.put(Task(name))
+        stage.join()
+        self.assertRaises(MultipleExceptions, stage.check)
+        self.assertEqual(sorted(self.started), ["a", "fail1", "fail2"])
+
+class CancelTest(unittest.TestCase):
+    def worker(self, t):
+        if t.name == "fail":
+            time.sleep(0.1)
+            raise Exception("failed")
+        # Would time out after 600 seconds.
+        nixops.util.check_wait(lambda: False, initial=10, max_tries=60)
+
+    def test_fail_fast(self):
+        start = time.time()
+        tasks = [Task("fail")] + [Task("wait{0}".format(i)) for i in range(5)]
+        try:
+            run_tasks(-1, tasks, self.worker, cancel=nixops.util.CancelToken())
+            self.fail("expected an exception")
+        except Exception as e:
+            self.assertEqual(str(e), "failed")
+        self.assertLess(time.time() - start, 5)
+
+    def test_skip_after_cancel(self):
+        token = nixops.util.CancelToken()
+        tasks = [Task("fail")] + [Task("a"), Task("b")]
+        self.assertRaises(Exception, run_dag, 2, tasks, {"a": [], "b": ["a"]},
+                          self.worker, cancel=token)
+        self.assertTrue(token.cancelled)
+        self.assertIn("fail", token.reason)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+import nixops.closures
+import nixops.peer_copy
+from nixops.logger import Logger
+from tests.unit.network import NetworkTestBase, patch
+from StringIO import StringIO
+
+class FakeAgent(object):
+    def __init__(self): self.keys = []
+    def add_key(self, key_file): self.keys.append(key_file)
+    def shutdown(self): pass
+
+class FakeMachine(object):
+    lock = threading.Lock()
+
+    def __init__(self, name, scope, log):
+        self.name = name
+        self.scope = scope
+        self.log = log
+        self.new_toplevel = "/nix/store/" + name
+        self.public_host_key = "ssh-ed25519 AAAA" + name
+        self.logger = Logger(StringIO()).get_logger_for(name)
+
+    def peer_scope(self): return self.scope
+    def address_to(self, m): return "10.0.0." + m.name
+    def get_ssh_private_key_file(self): return "/key-" + self.name
+    def get_ssh_password(self): return None
+
+    def copy_closure_to(self, path, missing=None):
+        with self.lock:
+            self.log["local"] += 1
+            self.log["max_local"] = max(self.log["max_local"], self.log["local"])
+        time.sleep(0.02)
+        with self.lock:
+            self.log["local"] -= 1
+            self.log["copied"].append(self.name)
+            self.log.setdefault("missing", {})[self.name] = missing
+
+    def get_missing_paths(self, paths):
+        return set(p for p in paths if p != "/nix/store/glibc")
+
+    def copy_closure_from_peer(self, peer, paths, agent):
+        time.sleep(0.01)
+        with self.lock:
+            self.log["from_peers"].append((peer.name, self.name, len(paths)))
+            self.log["agent_keys"].append(agent.keys)
+
+class PeerCopyTest(unittest.TestCase):
+    def setUp(self):
+        patch(self, nixops.peer_copy, "get_closure",
+              side_effect=lambda path: set(["/nix/store/glibc", "/nix/store/nixos", path]))
+        patch(self, nixops.peer_copy.nixops.ssh_util, "SSHAgent", FakeAgent)
+
+    def test_fan_out(self):
+        log = {"local": 0, "max_local": 0, "copied": [], "from_peers": [], "agent_keys": []}
+        machines = [FakeMachine("m{0}".format(i), "ec2" if i < 16 else None, log) for i in range(20)]
+        machines[15].public_host_key = None
+        nixops.peer_copy.copy_closures(machines, 2, Logger(StringIO()))
+        self.assertEqual(sorted(log["copied"]), sorted(m.name for m in machines))
+        self.assertLessEqual(log["max_local"], 2)
+        self.assertTrue(log["from_peers"])
+        for ((peer, m, nr_paths), keys) in zip(log["from_peers"], log["agent_keys"]):
+            self.assertLess(int(peer[1:]), 15)
+            self.assertLess(int(m[1:]), 15)
+            self.assertEqual(nr_paths, 2)
+            self.assertEqual(keys, ["/key-" + m])
+
+class EC2PeerScopeTest(NetworkTestBase):
+    def test_regions_and_subnets(self):
+        depl = self.sf.create_deployment()
+        machines = []
+        with self.sf._db:
+            for (i, (region, subnet)) in enumerate([("eu-west-1", None), ("eu-west-1", ""), ("us-east-1", None),
+                                                    ("eu-west-1", "subnet-1"), ("eu-west-1", "subnet-2")]):
+                m = depl._create_resource("m{0}".format(i), "ec2")
+                (m.region, m.subnet_id, m.private_ipv4) = (region, subnet, "10.0.0.{0}".format(i))
+                machines.append(m)
+        self.assertEqual(machines[0].address_scope(), machines[2].address_scope())
+        self.assertTrue(nixops.peer_copy._can_serve(machines[0], machines[1]))
+        self.assertFalse(nixops.peer_copy._can_serve(machines[0], machines[2]))
+        self.assertFalse(nixops.peer_copy._can_serve(machines[0], machines[3]))
+        self.assertFalse(nixops.peer_copy._can_serve(machines[3], machines[4]))
+
+class CopyPlanTest(unittest.TestCase):
+    def setUp(self):
+        patch(self, nixops.closures, "get_closure",
+              side_effect=lambda path: set(["/nix/store/glibc", "/nix/store/nixos", path]))
+        patch(self, nixops.closures, "get_path_sizes",
+              side_effect=lambda paths: {p: 10 if p == "/nix/store/m2" else 1 for p in paths})
+
+    def test_plan(self):
+        log = {"local": 0, "max_local": 0, "copied": [], "from_peers": []}
+        machines = [FakeMachine("m{0}".format(i), None, log) for i in range(3)]
+        patch(self, machines[1], "get_missing_paths", return_value=set())
+        plan = nixops.closures.CopyPlan(machines)
+        self.assertEqual(plan.missing["m0"], set(["/nix/store/nixos", "/nix/store/m0"]))
+        self.assertEqual((plan.bytes_to_copy(machines[2]), plan.unique_bytes(machines[2])), (11, 10))
+        self.assertEqual([m.name for m in plan.order(machines)], ["m2", "m0"])
+
+        nixops.peer_copy.copy_closures(plan.order(machines), 2, Logger(StringIO()), plan=plan)
+        self.assertEqual(sorted(log["copied"]), ["m0", "m2"])
+        self.assertEqual(log["missing"]["m2"], set(["/nix/store/nixos", "/nix/store/m2"]))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from tests.unit.network import NetworkTestBase
+
+class PhysicalSpecTest(NetworkTestBase):
+    def test_shared_hosts(self):
+        spec = self.make_network(3).get_physical_spec()
+        self.assertEqual(spec.count("10.0.0.2 machine-2 machine-2-unencrypted"), 1)
+        self.assertEqual(spec.count("+ shared.hosts0"), 3)
+        self.assertIn('"127.0.0.1 machine-0-encrypted\\n192.168.105.1 machine-1 machine-1-encrypted\\n"', spec)
+
+    def test_size_is_linear(self):
+        small = len(self.make_network(50).get_physical_spec())
+        large = len(self.make_network(200).get_physical_spec())
+        self.assertLess(large, 4.5 * small)
+
+    def test_write_unchanged_files(self):
+        depl = self.make_network(3)
+        dir = os.path.join(self.tempdir, "physical")
+        os.mkdir(dir)
+        (phys_expr, phys_hash) = depl.write_physical_spec(dir)
+        self.assertEqual(sorted(os.listdir(dir)), ["physical.nix", "resource-machine-0.nix", "resource-machine-1.nix",
+                                                   "resource-machine-2.nix", "shared.nix"])
+        self.assertIn('"machine-2" = import ./resource-machine-2.nix shared;', open(phys_expr).read())
+        self.assertEqual(os.stat(phys_expr).st_mode & 0777, 0600)
+        mtimes = {f: os.stat(os.path.join(dir, f)).st_mtime for f in os.listdir(dir)}
+        for f in mtimes: os.utime(os.path.join(dir, f), (0, 0))
+        self.assertEqual(depl.write_physical_spec(dir), (phys_expr, phys_hash))
+        self.assertTrue(all(os.stat(os.path.join(dir, f)).st_mtime == 0 for f in mtimes))
+
+        depl.resources["machine-2"].public_ipv4 = "10.1.0.2"
+        (_, new_hash) = depl.write_physical_spec(dir)
+        self.assertNotEqual(new_hash, phys_hash)
+        changed = sorted(f for f in mtimes if os.stat(os.path.join(dir, f)).st_mtime != 0)
+        self.assertEqual(changed, ["resource-machine-2.nix", "shared.nix"])
+
+        depl.delete_resource(depl.resources["machine-2"])
+        depl.write_physical_spec(dir)
+        self.assertNotIn("resource-machine-2.nix", os.listdir(dir))
@@ -0,0 +1,31 @@
+import unittest
+
+from StringIO import StringIO
+
+from nixops.logger import Logger
+from nixops.ssh_util import SSH, SSHConnectionFailed, run_commands
+
+class FakeSSH(SSH):
+    def _get_command(self, command, flags, timeout, logged, allow_ssh_args, user):
+        if command is None:
+            raise SSHConnectionFailed("unable to start SSH master connection")
+        return ["sh", "-c", command]
+
+class RunCommandsTest(unittest.TestCase):
+    def setUp(self):
+        self.logfile = StringIO()
+        self.logger = Logger(self.logfile)
+
+    def ssh(self, name):
+        return FakeSSH(self.logger.get_logger_for(name))
+
+    def test_run_commands(self):
+        commands = [(self.ssh("m{0}".format(i)), "echo hello; printf 'part'; echo ial; exit {0}".format(i))
+                    for i in range(20)]
+        commands.append((self.ssh("unreachable"), None))
+        res = run_commands(commands, max_concurrent=4)
+        self.assertEqual(res, range(20) + [255])
+        lines = self.logfile.getvalue().splitlines()
+        self.assertEqual(sum(1 for l in lines if l.endswith("> hello")), 20)
+        self.assertEqual(sum(1 for l in lines if l.endswith("> partial")), 20)
+        self.assertIn("m7.........> partial", lines)
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nixops import ssh_util
+
+class ControlSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="nixops-test")
+        self.old_env = os.environ.get("NIXOPS_SSH_CONTROL_DIR")
+        os.environ["NIXOPS_SSH_CONTROL_DIR"] = os.path.join(self.tempdir, "control")
+
+    def tearDown(self):
+        if self.old_env is None:
+            del os.environ["NIXOPS_SSH_CONTROL_DIR"]
+        else:
+            os.environ["NIXOPS_SSH_CONTROL_DIR"] = self.old_env
+        shutil.rmtree(self.tempdir)
+
+    def test_control_dir(self):
+        path = ssh_util.get_control_dir()
+        self.assertEqual(path, os.path.join(self.tempdir, "control"))
+        self.assertEqual(os.stat(path).st_mode & 0777, 0700)
+        os.chmod(path, 0755)
+        self.assertRaises(Exception, ssh_util.get_control_dir)
+
+    def test_get_port(self):
+        self.assertEqual(ssh_util._get_port(["-i", "key"]), "22")
+        self.assertEqual(ssh_util._get_port(["-p", "2222", "-x"]), "2222")
+        self.assertEqual(ssh_util._get_port(["-p2222"]), "2222")
+        self.assertEqual(ssh_util._get_port(["-o", "Port=2200"]), "2200")
+
+    def test_control_socket(self):
+        flags = ["-p", "22", "-i", "key"]
+        socket = ssh_util._get_control_socket("root@host", flags, "ssh-ed25519 AAAA")
+        self.assertEqual(os.path.dirname(socket), os.path.join(self.tempdir, "control"))
+        self.assertEqual(ssh_util._get_control_socket(
+            "root@host", flags + ["-o", "ConnectTimeout=5"] + flags, "ssh-ed25519 AAAA"), socket)
+        self.assertNotEqual(ssh_util._get_control_socket("root@host", flags, "ssh-ed25519 BBBB"), socket)
+        self.assertNotEqual(ssh_util._get_control_socket(
+            "root@host", flags + ["-o", "UserKnownHostsFile=/tmp/known_hosts"], "ssh-ed25519 AAAA"), socket)
+        self.assertNotEqual(ssh_util._get_control_socket("root@host", ["-p", "2222", "-i", "key"], None), socket)
+
+    def test_control_socket_uses_key_contents(self):
+        def key_file(dir, contents):
+            os.mkdir(os.path.join(self.tempdir, dir))
+            path = os.path.join(self.tempdir, dir, "id_nixops")
+            with open(path, "w") as f: f.write(contents)
+            return path
+        (key1, key2, key3) = (key_file("a", "key"), key_file("b", "key"), key_file("c", "other key"))
+        socket = ssh_util._get_control_socket("root@host", ["-i", key1], None)
+        self.assertEqual(ssh_util._get_control_socket("root@host", ["-i", key2], None), socket)
+        self.assertEqual(ssh_util._get_control_socket("root@host", ["-i" + key2], None), socket)
+        self.assertNotEqual(ssh_util._get_control_socket("root@host", ["-i", key3], None), socket)
+
+    def test_find_master(self):
+        ssh = ssh_util.SSH(None)
+        ssh.register_host_fun(lambda: "host")
+        self.assertIsNone(ssh.find_master())
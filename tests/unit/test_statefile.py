@@ -0,0 +1,307 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import nixops.state
+import nixops.statefile
+from nixops.state import StateDict
+
+class StateFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="nixops-test")
+        self.db_file = os.path.join(self.tempdir, "test.nixops")
+        self.sf = nixops.statefile.StateFile(self.db_file)
+        self.depl = self.sf.create_deployment()
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tempdir)
+
+    def reopen(self):
+        self.sf.close()
+        self.sf = nixops.statefile.StateFile(self.db_file)
+        return self.sf.open_deployment(self.depl.uuid)
+
+    def count_queries(self, f):
+        db = self.sf._db
+        queries = []
+        def cursor():
+            queries.append(None)
+            return type(db).cursor(db)
+        db.cursor = cursor
+        try:
+            f()
+        finally:
+            del db.cursor
+        return len(queries)
+
+class AttrCacheTest(StateFileTest):
+    def test_deployment_attrs(self):
+        self.depl.name = "foo"
+        self.depl.args = {"x": "1"}
+        self.assertEqual(self.depl.name, "foo")
+        self.depl.description = self.depl.default_description
+        depl = self.reopen()
+        self.assertEqual(depl.name, "foo")
+        self.assertEqual(depl.args, {"x": "1"})
+        self.assertEqual(depl._get_attr("description"), nixops.util.undefined)
+
+    def test_resource_attrs(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        r.state = r.UP
+        r.index = 3
+        r.obsolete = True
+        r.public_key = "pub"
+        self.assertEqual((r.state, r.index, r.obsolete, r.public_key),
+                         (r.UP, 3, True, "pub"))
+        r.obsolete = False
+        r = self.reopen().resources["key"]
+        self.assertEqual((r.state, r.index, r.obsolete, r.public_key),
+                         (r.UP, 3, False, "pub"))
+
+    def test_reads_are_cached(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        r.public_key = "pub"
+        r = self.reopen().resources["key"]
+        def read():
+            for dummy in range(10):
+                r.public_key
+                r.private_key
+        r.state
+        self.assertEqual(self.count_queries(read), 0)
+
+    def test_state_dict_shares_cache(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        state = StateDict(self.depl, r.id)
+        state["publicKey"] = "pub"
+        state["tags"] = ["a", "b"]
+        self.assertEqual(r.public_key, "pub")
+        self.assertEqual(state["tags"], ["a", "b"])
+        r.public_key = None
+        self.assertNotIn("publicKey", state)
+        del state["tags"]
+        self.assertEqual(len(state), 0)
+
+    def test_state_dict_decodes_once(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        state = StateDict(self.depl, r.id)
+        state["id"] = "vpc-123"
+        state["count"] = 3
+        state["tags"] = ["a", "b"]
+        loads = []
+        real_loads = nixops.state.json.loads
+        def counting_loads(s):
+            loads.append(s)
+            return real_loads(s)
+        nixops.state.json.loads = counting_loads
+        try:
+            for dummy in range(10):
+                self.assertEqual((state["id"], state["count"]), ("vpc-123", 3))
+        finally:
+            nixops.state.json.loads = real_loads
+        self.assertEqual(loads, [])
+        state["tags"].append("c")
+        self.assertEqual(state["tags"], ["a", "b"])
+        self.depl._set_resource_attrs(r.id, {"count": "4"})
+        self.assertEqual(state["count"], 4)
+        self.depl._set_resource_attrs(r.id, {"tags": '["d"]', "id": "[vpc"})
+        self.assertEqual((state["tags"], state["id"]), (["d"], "[vpc"))
+
+    def test_open_preloads_attrs(self):
+        def open_with(n):
+            for i in range(n):
+                r = self.depl._create_resource("key-{0}-{1}".format(n, i), "ssh-keypair")
+                r.index = i
+                r.public_key = "pub"
+            return self.count_queries(lambda: self.sf.open_deployment(self.depl.uuid).resources)
+        few = open_with(2)
+        self.assertEqual(open_with(20), few)
+        depl = self.sf.open_deployment(self.depl.uuid)
+        self.assertEqual(sorted(r.index for r in depl.resources.itervalues()),
+                         sorted(range(2) + range(20)))
+
+class LazyDeploymentTest(StateFileTest):
+    def test_resources_are_loaded_on_first_access(self):
+        self.depl._create_resource("key", "ssh-keypair")
+        depl = self.reopen()
+        self.assertIsNone(depl._resources)
+        self.assertEqual(depl.resources.keys(), ["key"])
+        self.assertEqual(self.count_queries(lambda: depl.resources), 0)
+
+    def test_summaries(self):
+        self.depl.name = "foo"
+        self.depl._create_resource("key", "ssh-keypair")
+        self.depl._create_resource("a", "none")
+        self.depl._create_resource("b", "none")
+        other = self.sf.create_deployment()
+        other.description = "bar"
+        summaries = {s.uuid: s for s in self.sf.get_deployment_summaries()}
+        s = summaries[self.depl.uuid]
+        self.assertEqual((s.name, s.description, s.nr_machines, s.machine_types),
+                         ("foo", self.depl.default_description, 2, set(["none"])))
+        s = summaries[other.uuid]
+        self.assertEqual((s.name, s.description, s.nr_machines, s.machine_types),
+                         (None, "bar", 0, set()))
+
+    def test_unknown_types_are_skipped(self):
+        other = self.sf.create_deployment()
+        with self.sf._db:
+            self.sf._db.execute("insert into Resources(deployment, name, type) values (?, 'x', 'no-such-type')",
+                                (other.uuid,))
+        self.assertEqual([d.uuid for d in self.sf.get_all_deployments()], [self.depl.uuid])
+
+class UnitOfWorkTest(StateFileTest):
+    def stored_attrs(self, id):
+        sf = nixops.statefile.StateFile(self.db_file)
+        try:
+            c = sf._db.cursor()
+            c.execute("select name, value from ResourceAttrs where machine = ?", (id,))
+            return dict(c.fetchall())
+        finally:
+            sf.close()
+
+    def test_writes_are_deferred(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        with self.sf._db.unit_of_work():
+            r.public_key = "pub"
+            with self.sf._db.unit_of_work():
+                r.private_key = "priv"
+            r.public_key = "pub2"
+            self.assertEqual(r.public_key, "pub2")
+            self.assertEqual(self.stored_attrs(r.id), {})
+        self.assertEqual(self.stored_attrs(r.id),
+                         {"publicKey": "pub2", "privateKey": "priv"})
+
+    def test_writes_are_flushed_on_error(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        try:
+            with self.sf._db.unit_of_work():
+                r.public_key = "pub"
+                raise Exception("step failed")
+        except Exception:
+            pass
+        self.assertEqual(self.stored_attrs(r.id), {"publicKey": "pub"})
+
+    def test_with_block_is_one_transaction(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        with self.sf._db:
+            r.public_key = "pub"
+            self.assertEqual(self.stored_attrs(r.id), {})
+        self.assertEqual(self.stored_attrs(r.id), {"publicKey": "pub"})
+
+    def test_with_block_writes_inside_unit_of_work(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        with self.sf._db.unit_of_work():
+            r.private_key = "priv"
+            with self.sf._db:
+                r.public_key = "pub"
+            self.assertEqual(self.stored_attrs(r.id), {"publicKey": "pub", "privateKey": "priv"})
+            r.private_key = "priv2"
+            self.assertEqual(self.stored_attrs(r.id)["privateKey"], "priv")
+        self.assertEqual(self.stored_attrs(r.id)["privateKey"], "priv2")
+
+    def test_failed_with_block_writes_its_updates(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        with self.sf._db.unit_of_work():
+            try:
+                with self.sf._db:
+                    r.public_key = "pub"
+                    raise Exception("step failed")
+            except Exception:
+                pass
+            self.assertEqual(self.stored_attrs(r.id), {"publicKey": "pub"})
+        self.assertEqual(self.reopen().resources["key"].public_key, "pub")
+
+    def test_failed_flush_keeps_other_updates(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        db = self.sf._db
+        with db.unit_of_work():
+            r.public_key = "pub"
+            db.queue("bad", "insert into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                     (12345, "x", "y"))
+            r.private_key = "priv"
+            self.assertRaises(Exception, db.flush)
+            self.assertEqual(self.stored_attrs(r.id), {})
+        self.assertEqual(self.stored_attrs(r.id), {"publicKey": "pub", "privateKey": "priv"})
+
+    def test_delete_resource(self):
+        r = self.depl._create_resource("key", "ssh-keypair")
+        with self.sf._db.unit_of_work():
+            r.public_key = "pub"
+            self.depl.delete_resource(r)
+        self.assertEqual(self.reopen().resources, {})
+
+class ConnectionTest(StateFileTest):
+    def test_reads_do_not_wait_for_writer(self):
+        entered = threading.Event()
+        done = threading.Event()
+        def writer():
+            with self.sf._db:
+                self.sf._db.execute("insert into Deployments(uuid) values ('x')")
+                entered.set()
+                done.wait(10)
+        thr = threading.Thread(target=writer)
+        thr.start()
+        try:
+            entered.wait(10)
+            self.assertEqual(sorted(self.sf.query_deployments()), sorted([self.depl.uuid, 'x']))
+        finally:
+            done.set()
+            thr.join()
+
+    def test_parallel_writes(self):
+        resources = [self.depl._create_resource("key-{0}".format(i), "ssh-keypair")
+                     for i in range(10)]
+        def worker(r):
+            for i in range(20):
+                with self.sf._db.unit_of_work():
+                    r.index = i
+                    r.public_key = "pub-{0}".format(i)
+        threads = [threading.Thread(target=worker, args=(r,)) for r in resources]
+        for thr in threads: thr.start()
+        for thr in threads: thr.join()
+        depl = self.reopen()
+        for r in depl.resources.itervalues():
+            self.assertEqual((r.index, r.public_key), (19, "pub-19"))
+
+    def test_writes_outside_with_block_are_refused(self):
+        db = self.sf._db
+        self.assertRaises(Exception, db.execute, "insert into Deployments(uuid) values ('x')")
+        self.assertRaises(Exception, db.execute, "delete from Deployments")
+        self.assertEqual(self.sf.query_deployments(), [self.depl.uuid])
+        with db:
+            db.execute("insert into Deployments(uuid) values ('x')")
+        self.assertEqual(sorted(self.sf.query_deployments()), sorted([self.depl.uuid, 'x']))
+
+class SchemaTest(StateFileTest):
+    def query_plan(self, sql, params):
+        c = self.sf._db.cursor()
+        c.execute("explain query plan " + sql, params)
+        return " ".join(row[-1] for row in c.fetchall())
+
+    def test_find_by_name_uses_index(self):
+        self.depl.name = "foo"
+        self.assertEqual(self.sf.open_deployment("foo").uuid, self.depl.uuid)
+        plan = self.query_plan("select deployment from DeploymentAttrs where name = 'name' and value = ?", ("foo",))
+        self.assertIn("DeploymentsByName", plan)
+        plan = self.query_plan("select id, name, type from Resources where deployment = ?", (self.depl.uuid,))
+        self.assertIn("ResourcesByDeployment", plan)
+
+    def test_upgrade_3_to_4(self):
+        self.depl.name = "foo"
+        self.depl._create_resource("key", "ssh-keypair")
+        with self.sf._db:
+            self.sf._db.execute("drop index DeploymentsByName")
+            self.sf._db.execute("drop index ResourcesByDeployment")
+            self.sf._db.execute("update SchemaVersion set version = 3")
+        depl = self.reopen()
+        self.assertEqual(depl.resources.keys(), ["key"])
+        c = self.sf._db.cursor()
+        c.execute("select version from SchemaVersion")
+        self.assertEqual(c.fetchall(), [(4,)])
+        with self.sf._db:
+            self.assertRaises(Exception, self.sf._db.execute,
+                              "insert into Resources(deployment, name, type) values (?, 'key', 'ssh-keypair')",
+                              (depl.uuid,))